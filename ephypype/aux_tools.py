@@ -7,6 +7,13 @@
 
 from contextlib import contextmanager
 import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 
 # Define a context manager to suppress stdout and stderr.
@@ -68,6 +75,77 @@ def nostdout():
     sys.stdout = save_stdout
 
 
+@contextmanager
+def _file_lock(fname, timeout=None, poll_interval=1.):
+    """Hold an inter-process lock on a file.
+
+    The lock is taken on fname + '.lock', so that the processes (e.g. nipype
+    MultiProc workers) creating the same file wait for the one that is
+    writing it; once the lock is acquired, the file has to be checked again
+    and read if it exists.
+
+    Example
+    -------
+    >> with _file_lock(bem_fname):
+           if not op.isfile(bem_fname):
+               compute and write bem_fname
+
+    Parameters
+    ----------
+    fname : str
+        The file to protect
+    timeout : float | None
+        Maximum time to wait for the lock in seconds; if None wait forever
+    poll_interval : float
+        Time in seconds between two attempts to acquire the lock
+    """
+    lock_fname = fname + '.lock'
+    start = time.time()
+    is_waiting = False
+
+    with open(lock_fname, 'a') as lock_file:
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if timeout is not None and time.time() - start > timeout:
+                    raise RuntimeError('Timeout while waiting for the lock '
+                                       '{}'.format(lock_fname))
+                if not is_waiting:
+                    print(('*** waiting for {} ***'.format(lock_fname)))
+                    is_waiting = True
+                time.sleep(poll_interval)
+
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _get_n_threads(n_jobs):
+    """Get the number of threads of a pool from n_jobs.
+
+    As in joblib, a negative n_jobs counts from the number of CPUs, -1
+    meaning all the CPUs.
+    """
+    n_cpu = os.cpu_count() or 1
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(n_cpu + 1 + n_jobs, 1)
+    if n_jobs == 0:
+        raise ValueError('n_jobs cannot be 0')
+    return n_jobs
+
+
 def _get_freq_band(freq_band_name, freq_band_names, freq_bands):
     """Get frequency band."""
     if freq_band_name in freq_band_names:
@@ -9,9 +9,15 @@ import os.path as op
 
 from nipype.utils.filemanip import split_filename as split_f
 
+from .aux_tools import _file_lock
+
 
 def _create_bem_sol(subjects_dir, sbj_id):
-    """Create bem solution."""
+    """Create bem solution.
+
+    The bem files are shared by all the sessions of the subject: they are
+    created by the first process, the other ones wait for them.
+    """
     import mne
     import os.path as op
     from mne.report import Report
@@ -28,46 +34,50 @@ def _create_bem_sol(subjects_dir, sbj_id):
     bem_fname = op.join(bem_dir, '{}-5120-bem-sol.fif'.format(sbj_id))
     model_fname = op.join(bem_dir, '{}-5120-bem.fif'.format(sbj_id))
 
-    if not op.isfile(bem_fname):
-        # chek if inner_skull surf exists, if not BEM computation is
-        # performed by MNE python functions mne.bem.make_watershed_bem
-        if not (op.isfile(sbj_inner_skull_fname) or
-                op.isfile(inner_skull_fname)):
-            print("{} ---> FILE NOT FOUND!!!---> BEM "
-                  "computed".format(inner_skull_fname))
-            make_watershed_bem(sbj_id, subjects_dir, overwrite=True)
+    with _file_lock(bem_fname):
+        if not op.isfile(bem_fname):
+            # chek if inner_skull surf exists, if not BEM computation is
+            # performed by MNE python functions mne.bem.make_watershed_bem
+            if not (op.isfile(sbj_inner_skull_fname) or
+                    op.isfile(inner_skull_fname)):
+                print("{} ---> FILE NOT FOUND!!!---> BEM "
+                      "computed".format(inner_skull_fname))
+                make_watershed_bem(sbj_id, subjects_dir, overwrite=True)
+            else:
+                print(("\n*** inner skull {} surface "
+                       "exists!!!\n".format(inner_skull_fname)))
+
+            # Create a BEM model for a subject
+            surfaces = mne.make_bem_model(sbj_id, ico=4, conductivity=[0.3],
+                                          subjects_dir=subjects_dir)
+
+            # Write BEM surfaces to a fiff file
+            mne.write_bem_surfaces(model_fname, surfaces)
+
+            # Create a BEM solution using the linear collocation approach
+            bem = mne.make_bem_solution(surfaces)
+            mne.write_bem_solution(bem_fname, bem)
+
+            print(('\n*** BEM solution file {} written ***\n'.format(
+                bem_fname)))
+
+            # Add BEM figures to a Report
+            report.add_bem(
+                subject=sbj_id, subjects_dir=subjects_dir, title='BEM_report')
+            report_filename = op.join(bem_dir, "BEM_report.html")
+            print(('\n*** REPORT file {} written ***\n'.format(
+                report_filename)))
+            print(report_filename)
+            report.save(report_filename, open_browser=False, overwrite=True)
         else:
-            print(("\n*** inner skull {} surface "
-                   "exists!!!\n".format(inner_skull_fname)))
-
-        # Create a BEM model for a subject
-        surfaces = mne.make_bem_model(sbj_id, ico=4, conductivity=[0.3],
-                                      subjects_dir=subjects_dir)
-
-        # Write BEM surfaces to a fiff file
-        mne.write_bem_surfaces(model_fname, surfaces)
-
-        # Create a BEM solution using the linear collocation approach
-        bem = mne.make_bem_solution(surfaces)
-        mne.write_bem_solution(bem_fname, bem)
-
-        print(('\n*** BEM solution file {} written ***\n'.format(bem_fname)))
-
-        # Add BEM figures to a Report
-        report.add_bem(
-            subject=sbj_id, subjects_dir=subjects_dir, title='BEM_report')
-        report_filename = op.join(bem_dir, "BEM_report.html")
-        print(('\n*** REPORT file {} written ***\n'.format(report_filename)))
-        print(report_filename)
-        report.save(report_filename, open_browser=False, overwrite=True)
-    else:
-        bem = bem_fname
-        print(('\n*** BEM solution file {} exists!!! ***\n'.format(bem_fname)))
+            bem = bem_fname
+            print(('\n*** BEM solution file {} exists!!! ***\n'.format(
+                bem_fname)))
 
     return bem
 
 
-def _create_src_space(subjects_dir, sbj_id, spacing):
+def _create_src_space(subjects_dir, sbj_id, spacing, n_jobs=1):
     """Create a source space."""
     bem_dir = op.join(subjects_dir, sbj_id, 'bem')
 
@@ -76,65 +86,66 @@ def _create_src_space(subjects_dir, sbj_id, spacing):
     # True
     src_fname = op.join(bem_dir, '%s-%s-src.fif' % (sbj_id, spacing))
     print('*** subject dir {}'.format(subjects_dir))
-    if not op.isfile(src_fname):
-        src = mne.setup_source_space(sbj_id, subjects_dir=subjects_dir,
-                                     spacing=spacing.replace('-', ''),
-                                     add_dist=False, n_jobs=1)
-
-        mne.write_source_spaces(src_fname, src, overwrite=True)
-        print(('\n*** source space file %s written ***\n' % src_fname))
-    else:
-        print(('\n*** source space file %s exists!!!\n' % src_fname))
-        src = mne.read_source_spaces(src_fname)
+    with _file_lock(src_fname):
+        if not op.isfile(src_fname):
+            src = mne.setup_source_space(sbj_id, subjects_dir=subjects_dir,
+                                         spacing=spacing.replace('-', ''),
+                                         add_dist=False, n_jobs=n_jobs)
+
+            mne.write_source_spaces(src_fname, src, overwrite=True)
+            print(('\n*** source space file %s written ***\n' % src_fname))
+        else:
+            print(('\n*** source space file %s exists!!!\n' % src_fname))
+            src = mne.read_source_spaces(src_fname)
 
     return src
 
 
 def _create_mixed_source_space(subjects_dir, sbj_id, spacing, labels, src,
-                               save_mixed_src_space):
+                               save_mixed_src_space, n_jobs=1):
     """Create a miwed source space."""
 
     bem_dir = op.join(subjects_dir, sbj_id, 'bem')
 
     src_aseg_fname = op.join(bem_dir, '%s-%s-aseg-src.fif' % (sbj_id, spacing))
-    if not op.isfile(src_aseg_fname):
-
-        aseg_fname = op.join(subjects_dir, sbj_id, 'mri/aseg.mgz')
-
-        if spacing == 'oct-6':
-            pos = 5.0
-        elif spacing == 'oct-5':
-            pos = 7.0
-        elif spacing == 'ico-5':
-            pos = 3.0
-
-        model_fname = op.join(bem_dir, '%s-5120-bem.fif' % sbj_id)
-        for l in labels:
-            print(l)
-            vol_label = mne.setup_volume_source_space(sbj_id, mri=aseg_fname,
-                                                      pos=pos,
-                                                      bem=model_fname,
-                                                      volume_label=l,
-                                                      subjects_dir=subjects_dir)  # noqa
-            src += vol_label
-
-        if save_mixed_src_space:
-            mne.write_source_spaces(src_aseg_fname, src, overwrite=True)
-            print("\n*** source space file {} written "
-                  "***\n".format(src_aseg_fname))
-
-        # Export source positions to nift file
-        nii_fname = op.join(bem_dir, '%s-%s-aseg-src.nii' % (sbj_id, spacing))
-
-        # Combine the source spaces
-        src.export_volume(nii_fname, mri_resolution=True, overwrite=True)
-    else:
-        print("\n*** source space file {} "
-              "exists!!!\n".format(src_aseg_fname))
-        src = mne.read_source_spaces(src_aseg_fname)
-        print(('src contains {} src spaces'.format(len(src))))
-        for s in src[2:]:
-            print(('sub structure {} \n'.format(s['seg_name'])))
+    with _file_lock(src_aseg_fname):
+        if not op.isfile(src_aseg_fname):
+
+            aseg_fname = op.join(subjects_dir, sbj_id, 'mri/aseg.mgz')
+
+            if spacing == 'oct-6':
+                pos = 5.0
+            elif spacing == 'oct-5':
+                pos = 7.0
+            elif spacing == 'ico-5':
+                pos = 3.0
+
+            model_fname = op.join(bem_dir, '%s-5120-bem.fif' % sbj_id)
+            for l in labels:
+                print(l)
+                vol_label = mne.setup_volume_source_space(
+                    sbj_id, mri=aseg_fname, pos=pos, bem=model_fname,
+                    volume_label=l, subjects_dir=subjects_dir, n_jobs=n_jobs)
+                src += vol_label
+
+            if save_mixed_src_space:
+                mne.write_source_spaces(src_aseg_fname, src, overwrite=True)
+                print("\n*** source space file {} written "
+                      "***\n".format(src_aseg_fname))
+
+            # Export source positions to nift file
+            nii_fname = op.join(bem_dir,
+                                '%s-%s-aseg-src.nii' % (sbj_id, spacing))
+
+            # Combine the source spaces
+            src.export_volume(nii_fname, mri_resolution=True, overwrite=True)
+        else:
+            print("\n*** source space file {} "
+                  "exists!!!\n".format(src_aseg_fname))
+            src = mne.read_source_spaces(src_aseg_fname)
+            print(('src contains {} src spaces'.format(len(src))))
+            for s in src[2:]:
+                print(('sub structure {} \n'.format(s['seg_name'])))
 
     return src
 
@@ -182,12 +193,13 @@ def _get_fwd_filename(raw_fpath, aseg, spacing):
     return fwd_filename
 
 
-def _compute_fwd_sol(raw_fname, trans_fname, src, bem, fwd_filename):
+def _compute_fwd_sol(raw_fname, trans_fname, src, bem, fwd_filename,
+                     n_jobs=2):
     """Compute leadfield matrix by BEM."""
     mindist = 5.  # ignore sources <= 0mm from inner skull
     fwd = mne.make_forward_solution(raw_fname, trans_fname, src, bem,
                                     mindist=mindist, meg=True, eeg=False,
-                                    n_jobs=2)
+                                    n_jobs=n_jobs)
 
     mne.write_forward_solution(fwd_filename, fwd, overwrite=True)
     print(('\n*** FWD file {} written!!!\n'.format(fwd_filename)))
@@ -4,8 +4,12 @@
 #
 # License: BSD (3-clause)
 
+import os
 import mne
 import glob
+import shutil
+import hashlib
+import tempfile
 import os.path as op
 import numpy as np
 
@@ -14,7 +18,11 @@ from mne import read_epochs
 from mne.evoked import write_evokeds, read_evokeds
 from mne.minimum_norm import make_inverse_operator, apply_inverse_raw
 from mne.minimum_norm import apply_inverse_epochs, apply_inverse
-from mne.minimum_norm import write_inverse_operator
+from mne.minimum_norm import write_inverse_operator, read_inverse_operator
+from mne.minimum_norm import prepare_inverse_operator
+from mne.minimum_norm.inverse import (_assemble_kernel, is_fixed_orient,
+                                      _pick_channels_inverse_operator,
+                                      _check_reference)
 from mne.beamformer import apply_lcmv_raw, make_lcmv
 from mne import compute_raw_covariance, pick_types, write_cov
 
@@ -143,6 +151,121 @@ def compute_cov_identity(raw_filename):
 '''
 
 
+def _hash_file(fname, block_size=2 ** 20):
+    """Compute the sha1 of the content of a file."""
+    file_hash = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+def _get_inv_key(fwd_filename, cov_fname, info, loose, depth, fixed):
+    """Compute the key of an inverse operator.
+
+    The key hashes the content of the forward and noise covariance files,
+    the channels, bads and projections of the data and the loose, depth and
+    fixed parameters of make_inverse_operator.
+    """
+    key = hashlib.sha1()
+    key.update(_hash_file(fwd_filename).encode())
+    key.update(_hash_file(cov_fname).encode())
+    key.update(repr((info['ch_names'], sorted(info['bads']))).encode())
+    for proj in info['projs']:
+        key.update(repr((proj['desc'], proj['active'],
+                         proj['data']['col_names'])).encode())
+        key.update(np.ascontiguousarray(proj['data']['data']).tobytes())
+    key.update(repr((loose, depth, fixed)).encode())
+
+    return key.hexdigest()
+
+
+def _get_inverse_operator(inv_filename, info, forward, noise_cov,
+                          fwd_filename, cov_fname, loose, depth, fixed,
+                          cache_dir=None):
+    """Compute the inverse operator or read it from the cache.
+
+    The inverse operator is saved in inv_filename. If cache_dir is not None,
+    it is also saved in cache_dir in a <key>-inv.fif file, where key is
+    given by _get_inv_key, so that reruns and runs of the same subject
+    sharing the forward solution, the noise covariance and the channels do
+    not compute it again. The files of cache_dir are never removed.
+    """
+    if cache_dir is None:
+        inverse_operator = make_inverse_operator(info, forward, noise_cov,
+                                                 loose=loose, depth=depth,
+                                                 fixed=fixed)
+        write_inverse_operator(inv_filename, inverse_operator,
+                               overwrite=True)
+
+        return inverse_operator
+
+    inv_key = _get_inv_key(fwd_filename, cov_fname, info, loose, depth, fixed)
+    cache_fname = op.join(cache_dir, inv_key + '-inv.fif')
+
+    if op.isfile(cache_fname):
+        print(('\n*** READ INV OP {} ***\n'.format(cache_fname)))
+        inverse_operator = read_inverse_operator(cache_fname)
+        shutil.copyfile(cache_fname, inv_filename)
+
+        return inverse_operator
+
+    inverse_operator = make_inverse_operator(info, forward, noise_cov,
+                                             loose=loose, depth=depth,
+                                             fixed=fixed)
+    write_inverse_operator(inv_filename, inverse_operator, overwrite=True)
+
+    try:
+        # copy in a temporary file and rename it, so that concurrent
+        # pipelines never read a partially written inverse operator
+        fd, tmp_fname = tempfile.mkstemp(dir=cache_dir, suffix='-inv.fif')
+        os.close(fd)
+        shutil.copyfile(inv_filename, tmp_fname)
+        os.replace(tmp_fname, cache_fname)
+        print(('\n*** INV OP saved in cache {} ***\n'.format(cache_fname)))
+    except OSError:
+        print(('\n*** INV OP can not be saved in cache {} ***\n'.format(
+            cache_dir)))
+
+    return inverse_operator
+
+
+def _make_inverse_kernel(inverse_operator, inst, lambda2, inv_method,
+                         pick_ori=None, nave=1):
+    """Compute the imaging kernel of a linear inverse solution.
+
+    The source time series are given by kernel @ data[sel], as computed by
+    apply_inverse_raw and apply_inverse_epochs (noise normalization of
+    dSPM/sLORETA included). As for them, the EEG data of inst (Raw or
+    Epochs) must have an average reference projection.
+
+    Returns
+    -------
+    kernel : array, shape (n_sources, n_channels) | None
+        The imaging kernel; None if the inverse solution is not linear, i.e.
+        free orientation whose current components are combined
+    sel : array of int
+        The indices of the channels of the data used by the kernel
+    """
+    if not (is_fixed_orient(inverse_operator) or pick_ori == 'normal'):
+        print('\n*** free orientation: the imaging kernel is not used ***\n')
+        return None, None
+
+    _check_reference(inst, inverse_operator['info']['ch_names'])
+    inv = prepare_inverse_operator(inverse_operator, nave, lambda2,
+                                   inv_method)
+    sel = _pick_channels_inverse_operator(inst.info['ch_names'], inv)
+    kernel, noise_norm, _, _ = _assemble_kernel(inv, None, inv_method,
+                                                pick_ori)
+    if noise_norm is not None:
+        kernel *= noise_norm
+
+    print(('\n*** imaging kernel {} ***\n'.format(kernel.shape)))
+
+    return kernel, sel
+
+
 def _compute_inverse_solution(raw_filename, sbj_id, subjects_dir, fwd_filename,
                               cov_fname, is_epoched=False, events_id=None,
                               condition=None, is_ave=False,
@@ -150,7 +273,9 @@ def _compute_inverse_solution(raw_filename, sbj_id, subjects_dir, fwd_filename,
                               snr=1.0, inv_method='MNE',
                               parc='aparc', aseg=False, aseg_labels=[],
                               all_src_space=False, ROIs_mean=True,
-                              is_fixed=False):
+                              is_fixed=False, return_generator=False,
+                              compression=None, inv_cache_dir=None,
+                              use_kernel=False, container=False):
     """
     Compute the inverse solution on raw/epoched data and return the average
     time series computed in the N_r regions of the source space defined by
@@ -194,6 +319,27 @@ def _compute_inverse_solution(raw_filename, sbj_id, subjects_dir, fwd_filename,
             if True we compute the inverse for all points of the s0urce space
         ROIs_mean: bool
             if True we compute the mean of estimated time series on ROIs
+        return_generator: bool
+            if True the inverse solution of epoched data is computed one
+            epoch at a time and piped to the ROIs extraction and to the
+            .hdf5 writer, so that the stcs of all epochs are never kept in
+            memory
+        compression: str | None
+            compression filter of the .hdf5 file of all_src_space, 'lzf' or
+            'gzip'
+        inv_cache_dir: str | None
+            directory of the inverse operators cache; if None the inverse
+            operator is computed and not cached
+        use_kernel: bool
+            if True and the inverse solution is linear (fixed or normal
+            orientation), the imaging kernel is computed once and applied to
+            the raw/epoched data by a matrix product; if only ROIs_mean is
+            needed the kernel is collapsed to the labels so that the source
+            time series are never computed
+        container: bool
+            if True the ROIs time series, the label names and coordinates are
+            saved in a single .hdf5 container (see write_container) instead
+            of a .npy file, .txt files and a pickle
 
 
     Outputs
@@ -255,15 +401,15 @@ def _compute_inverse_solution(raw_filename, sbj_id, subjects_dir, fwd_filename,
         pick_ori = 'normal'
 
     print(('\n *** loose {}  depth {} ***\n'.format(loose, depth)))
-    inverse_operator = make_inverse_operator(info, forward, noise_cov,
-                                             loose=loose, depth=depth,
-                                             fixed=is_fixed)
     inv_filename = op.abspath(basename + '-inv.fif')
-    write_inverse_operator(inv_filename, inverse_operator)
+    inverse_operator = _get_inverse_operator(
+        inv_filename, info, forward, noise_cov, fwd_filename, cov_fname,
+        loose=loose, depth=depth, fixed=is_fixed, cache_dir=inv_cache_dir)
 
     # apply inverse operator to the time windows [t_start, t_stop]s
     print('\n*** APPLY INV OP ***\n')
     stc_files = list()
+    kernel = None
 
     if is_epoched and events_id != {}:
         if is_evoked:
@@ -296,12 +442,26 @@ def _compute_inverse_solution(raw_filename, sbj_id, subjects_dir, fwd_filename,
                 stc_files.append(stc_evo_file)
 
         else:
-            stc = apply_inverse_epochs(epochs, inverse_operator, lambda2,
-                                       inv_method, pick_ori=pick_ori)
+            if use_kernel:
+                kernel, sel = _make_inverse_kernel(
+                    inverse_operator, epochs, lambda2, inv_method, pick_ori)
+            if kernel is not None:
+                stc = (epo[sel] for epo in epochs)
+            else:
+                stc = apply_inverse_epochs(epochs, inverse_operator, lambda2,
+                                           inv_method, pick_ori=pick_ori,
+                                           return_generator=return_generator)
 
     elif is_epoched and events_id == {}:
-        stc = apply_inverse_epochs(epochs, inverse_operator, lambda2,
-                                   inv_method, pick_ori=pick_ori)
+        if use_kernel:
+            kernel, sel = _make_inverse_kernel(
+                inverse_operator, epochs, lambda2, inv_method, pick_ori)
+        if kernel is not None:
+            stc = (epo[sel] for epo in epochs)
+        else:
+            stc = apply_inverse_epochs(epochs, inverse_operator, lambda2,
+                                       inv_method, pick_ori=pick_ori,
+                                       return_generator=return_generator)
 
     elif is_ave:
         if events_id != condition and condition:
@@ -326,18 +486,26 @@ def _compute_inverse_solution(raw_filename, sbj_id, subjects_dir, fwd_filename,
             stc.append(stc_evo)
             stc_files.append(stc_evo_file)
     else:
-        print('^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^')
-        stc = apply_inverse_raw(raw, inverse_operator, lambda2, inv_method,
-                                label=None,
-                                start=None, stop=None,
-                                buffer_size=None,
-                                pick_ori=pick_ori)  # None 'normal'
-        print('^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^')
+        if use_kernel:
+            kernel, sel = _make_inverse_kernel(
+                inverse_operator, raw, lambda2, inv_method, pick_ori)
+        if kernel is not None:
+            stc = raw[sel][0]
+        else:
+            print('^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^')
+            stc = apply_inverse_raw(raw, inverse_operator, lambda2,
+                                    inv_method, label=None,
+                                    start=None, stop=None,
+                                    buffer_size=None,
+                                    pick_ori=pick_ori)  # None 'normal'
+            print('^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^')
 
     ts_file, labels_file, label_names_file, label_coords_file = \
         _process_stc(stc, basename, sbj_id, subjects_dir, parc, forward,
                      aseg, is_fixed, all_src_space=all_src_space,
-                     ROIs_mean=ROIs_mean)
+                     ROIs_mean=ROIs_mean, compression=compression,
+                     fwd_filename=fwd_filename, kernel=kernel,
+                     container=container)
 
     return ts_file, labels_file, label_names_file, \
         label_coords_file, stc_files
@@ -410,7 +578,8 @@ def _compute_LCMV_inverse_solution(raw_filename, sbj_id, subjects_dir,
 
     ts_file, labels_file, label_names_file, label_coords_file = \
         _process_stc(stc, basename, sbj_id, subjects_dir, parc, forward,
-                     False, is_fixed, all_src_space=False, ROIs_mean=True)
+                     False, is_fixed, all_src_space=False, ROIs_mean=True,
+                     fwd_filename=fwd_filename)
 
     return ts_file, labels_file, label_names_file, \
         label_coords_file
@@ -5,10 +5,15 @@
 # License: BSD (3-clause)
 
 import os
+import json
 import time
 import shutil
+import hashlib
+import tarfile
 import zipfile
 
+from concurrent.futures import ThreadPoolExecutor
+
 from tqdm import tqdm
 from urllib import parse, request
 
@@ -23,9 +28,8 @@ def fetch_omega_dataset(base_path):
     if not os.path.exists(data_path):
         if not os.path.exists(target):
             _fetch_file(src_url, target)
-        zf = zipfile.ZipFile(target, 'r')
         print('Extracting files. This may take a while ...')
-        zf.extractall(path=data_path)
+        _extract_archive(target, data_path)
         os.remove(target)
     return os.path.abspath(data_path)
 
@@ -54,14 +58,124 @@ def fetch_erpcore_dataset(base_path):
     if not os.path.exists(data_path):
         if not os.path.exists(target):
             _fetch_file(src_url, target)
-        zf = zipfile.ZipFile(target, 'r')
         print('Extracting files. This may take a while ...')
-        zf.extractall(path=data_path)
+        _extract_archive(target, data_path)
         os.remove(target)
     return os.path.abspath(data_path)
 
 
-def _fetch_file(url, file_name, resume=True, timeout=30.):
+def fetch_manifest(manifest, base_path, n_jobs=4, timeout=30.,
+                   keep_archives=False):
+    """Download and extract the files of a manifest concurrently.
+
+    Parameters
+    ----------
+    manifest : list of dict | str
+        The files to download, or the path of a json file containing them.
+        Each file is a dict with the keys 'url' and 'fname' (path relative
+        to base_path), and optionally 'sha256' (checksum of the file) and
+        'extract_dir' (directory relative to base_path where the zip/tar
+        archive is extracted)
+    base_path : str
+        The directory where the files are saved
+    n_jobs : int
+        Number of files downloaded at the same time
+    timeout : float
+        The URL open timeout
+    keep_archives : bool
+        If False, the archives are removed once extracted
+
+    Returns
+    -------
+    paths : list of str
+        The path of each downloaded file, or of its extraction directory
+    """
+    if isinstance(manifest, str):
+        with open(manifest, 'r') as f:
+            manifest = json.load(f)
+
+    for entry in manifest:
+        assert 'url' in entry and 'fname' in entry, (
+            "Error, manifest entry {} should have 'url' and 'fname' "
+            "keys".format(entry))
+
+    def _fetch_entry(entry):
+        target = os.path.join(base_path, entry['fname'])
+        extract_dir = entry.get('extract_dir')
+        if extract_dir is not None:
+            extract_dir = os.path.join(base_path, extract_dir)
+            # the archive is removed only once its files are extracted
+            if os.path.exists(extract_dir) and not os.path.exists(target):
+                return os.path.abspath(extract_dir)
+
+        if not os.path.exists(os.path.dirname(os.path.abspath(target))):
+            os.makedirs(os.path.dirname(os.path.abspath(target)),
+                        exist_ok=True)
+        _fetch_file(entry['url'], target, timeout=timeout,
+                    sha256=entry.get('sha256'))
+
+        if extract_dir is None:
+            return os.path.abspath(target)
+
+        print('Extracting %s ...' % target)
+        _extract_archive(target, extract_dir)
+        if not keep_archives:
+            os.remove(target)
+        return os.path.abspath(extract_dir)
+
+    # archives are extracted by the worker that downloaded them, while the
+    # other files are still being downloaded
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        paths = list(executor.map(_fetch_entry, manifest))
+
+    return paths
+
+
+def _hash_file(file_name, chunk_size=2 ** 20):
+    """Compute the SHA256 checksum of a file."""
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def _extract_archive(file_name, path):
+    """Extract a zip or tar archive member by member.
+
+    The tar archives are read as a stream, so that compressed archives are
+    decompressed once; the members already extracted with the same size
+    are skipped when the extraction is resumed.
+    """
+    if zipfile.is_zipfile(file_name):
+        with zipfile.ZipFile(file_name, 'r') as zf:
+            for member in zf.infolist():
+                member_fname = os.path.join(path, member.filename)
+                if not member.is_dir() and os.path.isfile(member_fname) \
+                        and os.path.getsize(member_fname) == member.file_size:
+                    continue
+                zf.extract(member, path=path)
+
+    elif tarfile.is_tarfile(file_name):
+        # 'data' filter rejects members extracted outside of path
+        kwargs = dict()
+        if hasattr(tarfile, 'data_filter'):
+            kwargs['filter'] = 'data'
+        with tarfile.open(file_name, 'r|*') as tf:
+            for member in tf:
+                member_fname = os.path.join(path, member.name)
+                if member.isfile() and os.path.isfile(member_fname) and \
+                        os.path.getsize(member_fname) == member.size:
+                    continue
+                tf.extract(member, path=path, **kwargs)
+
+    else:
+        raise RuntimeError('Cannot extract %s, unknown archive '
+                           'format' % file_name)
+
+
+def _fetch_file(url, file_name, resume=True, timeout=30., sha256=None):
     """Load requested file, downloading it if needed or requested.
 
     Parameters
@@ -74,7 +188,15 @@ def _fetch_file(url, file_name, resume=True, timeout=30.):
         If true, try to resume partially downloaded files.
     timeout : float
         The URL open timeout.
+    sha256 : str | None
+        If not None, the SHA256 checksum of the file; a complete file with
+        this checksum is not downloaded again, and a downloaded file with
+        another checksum is downloaded again from scratch once.
     """
+    if sha256 is not None and os.path.exists(file_name):
+        if _hash_file(file_name) == sha256:
+            print('File %s already downloaded.' % file_name)
+            return
     # Adapted from MNE version < 0.24:
     temp_file_name = file_name + ".part"
     try:
@@ -120,6 +242,16 @@ def _fetch_file(url, file_name, resume=True, timeout=30.):
                 raise NotImplementedError('Cannot use %s' % (scheme,))
             _get_http(url, temp_file_name, initial_size, file_size, timeout)
 
+        if sha256 is not None and _hash_file(temp_file_name) != sha256:
+            os.remove(temp_file_name)
+            if not resume:
+                raise RuntimeError('SHA256 checksum of %s does not match '
+                                   'the expected one' % url)
+            # the partial file may be corrupted, restart without resuming
+            print('SHA256 checksum mismatch, downloading %s again' % url)
+            return _fetch_file(url, file_name, resume=False,
+                               timeout=timeout, sha256=sha256)
+
         shutil.move(temp_file_name, file_name)
         print('File saved as %s.\n' % file_name)
     except Exception:
@@ -49,8 +49,18 @@ def _get_raw_array(raw_fname, save_data=True):
     """
     raw = read_raw_fif(raw_fname, preload=True)
     subj_path, basename, ext = split_f(raw_fname)
-    select_sensors = mne.pick_types(raw.info, meg=True, ref_meg=False,
-                                    exclude='bads')
+
+    return _save_raw_array(raw, basename, save_data=save_data)
+
+
+def _save_raw_array(raw, basename, save_data=True, select_sensors=None):
+    """Save the time series, the sensors coordinates and labels of raw.
+
+    See _get_raw_array; by default the MEG sensors are saved.
+    """
+    if select_sensors is None:
+        select_sensors = mne.pick_types(raw.info, meg=True, ref_meg=False,
+                                        exclude='bads')
 
     # save electrode locations
     sens_loc = [raw.info['chs'][i]['loc'][:3] for i in select_sensors]
@@ -1 +1,3 @@
-from .gather_results import get_results, get_channel_files  # noqa
+from .gather_results import (get_results, get_channel_files,  # noqa
+                             update_result_index, result_index_callback)
+from .gather_conmats import gather_conmats_to_store, read_conmat_store  # noqa
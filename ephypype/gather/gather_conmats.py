@@ -1,13 +1,18 @@
 """Gather conmats."""
+import os
 import re
+import fnmatch
+import h5py
 
 import numpy as np
-import itertools as iter
 from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
 
 from mne_connectivity.viz import plot_connectivity_circle
 from mne.viz import circular_layout
 
+from ..import_data import _is_container, _read_ch_names, read_container
+
 
 def _atoi(text):
     """Get digit."""
@@ -24,8 +29,52 @@ def natural_keys(text):
     return [_atoi(c) for c in re.split(r'(\d+)', str(text))]
 
 
+def _get_label_indices(elec_labels, all_elec_labels):
+    """Get the indices of the labels common to elec_labels and all_elec_labels.
+
+    Returns the indices in elec_labels and in all_elec_labels of the labels
+    of all_elec_labels that are in elec_labels (first occurrence of each
+    label).
+    """
+    elec_index = dict()
+    for i, lab in enumerate(elec_labels):
+        elec_index.setdefault(lab, i)
+
+    all_index = dict()
+    for i, lab in enumerate(all_elec_labels):
+        all_index.setdefault(lab, i)
+
+    common_labels = [lab for lab in all_index if lab in elec_index]
+
+    idx = np.array([elec_index[lab] for lab in common_labels], dtype=int)
+    all_idx = np.array([all_index[lab] for lab in common_labels], dtype=int)
+
+    return idx, all_idx
+
+
+def _symmetrize_mats(mats):
+    """Symmetrize the stacked matrices with only one triangular part."""
+    tril = np.tril_indices(mats.shape[-1], k=-1)
+    triu = np.triu_indices(mats.shape[-1], k=1)
+    tril_sum = np.sum(mats[:, tril[0], tril[1]], axis=-1)
+    triu_sum = np.sum(mats[:, triu[0], triu[1]], axis=-1)
+
+    # if undirected (values are not the same on both triangular parts)
+    to_sym = tril_sum != triu_sum
+    mats = mats.copy()
+    mats[to_sym] = mats[to_sym] + np.transpose(mats[to_sym], (0, 2, 1))
+
+    return mats
+
+
 def return_full_mat(mat, elec_labels, all_elec_labels):
-    """Get full mat."""
+    """Get full mat.
+
+    Return the matrix of shape (len(all_elec_labels), len(all_elec_labels))
+    where the values of mat are set at the positions of elec_labels; the
+    diagonal and the rows/columns of the labels missing in elec_labels are
+    NaN.
+    """
     n_labs = len(elec_labels)
     assert len(mat.shape) == 2 and mat.shape[0] == mat.shape[1], (
         "Error mat shape = {} should be a 2D squared ndarray "
@@ -35,29 +84,62 @@ def return_full_mat(mat, elec_labels, all_elec_labels):
         "elec_labels {}".format(mat.shape[0], mat.shape[1],
                                 len(elec_labels)))
 
-    # if undirected (values are not the same on both triangular parts)
-    if np.sum(mat[np.tril_indices(mat.shape[0], k=-1)]) != np.sum(mat[
-            np.triu_indices(mat.shape[0], k=1)]):
-        mat = mat + np.transpose(mat)
+    return return_full_mats(mat[np.newaxis], [elec_labels],
+                            all_elec_labels)[0]
+
+
+def return_full_mats(mats, list_elec_labels, all_elec_labels):
+    """Get full mats of a stack of matrices.
+
+    Batch version of return_full_mat: the matrices sharing the same labels
+    are scattered in the full matrices at once.
 
-    # building full_mat from all_elec_labels
+    Parameters
+    ----------
+    mats : array, shape (n_mats, n_labs, n_labs) | list of array
+        The connectivity matrices
+    list_elec_labels : list of list
+        The labels of each matrix
+    all_elec_labels : list
+        The labels of the full matrices
 
-    full_mat = np.empty((len(all_elec_labels), len(all_elec_labels)))
-    full_mat[:] = np.NAN
+    Returns
+    -------
+    full_mats : array, shape (n_mats, n_all_labs, n_all_labs)
+        The full matrices
+    """
+    assert len(mats) == len(list_elec_labels), (
+        "Error, the number of matrices {} should be the same as the number "
+        "of label lists {}".format(len(mats), len(list_elec_labels)))
+
+    n_all_labs = len(all_elec_labels)
+    full_mats = np.empty((len(mats), n_all_labs, n_all_labs))
+    full_mats[:] = np.nan
 
-    for pair_lab in iter.permutations(all_elec_labels, 2):
+    # group the matrices by label list
+    groups = dict()
+    for i_mat, elec_labels in enumerate(list_elec_labels):
+        groups.setdefault(tuple(elec_labels), list()).append(i_mat)
 
-        all_i, all_j = all_elec_labels.index(
-            pair_lab[0]), all_elec_labels.index(pair_lab[1])
+    for elec_labels, i_mats in groups.items():
+        group_mats = np.array([mats[i_mat] for i_mat in i_mats])
+        assert group_mats.ndim == 3 and \
+            group_mats.shape[1:] == (len(elec_labels), len(elec_labels)), (
+                "Error mats shape = {} should be the same as elec_labels "
+                "{}".format(group_mats.shape[1:], len(elec_labels)))
 
-        if pair_lab[0] in elec_labels and pair_lab[1] in elec_labels:
+        group_mats = _symmetrize_mats(group_mats)
 
-            i, j = elec_labels.index(
-                pair_lab[0]), elec_labels.index(pair_lab[1])
+        idx, all_idx = _get_label_indices(elec_labels, all_elec_labels)
 
-            full_mat[all_i, all_j] = mat[i, j]
+        # one fancy-index scatter for all the matrices of the group
+        group_full_mats = full_mats[i_mats]
+        group_full_mats[:, all_idx[:, np.newaxis], all_idx] = \
+            group_mats[:, idx[:, np.newaxis], idx]
+        group_full_mats[:, all_idx, all_idx] = np.nan
+        full_mats[i_mats] = group_full_mats
 
-    return full_mat
+    return full_mats
 
 
 def plot_tab_circular_connectivity(list_list_conmat, all_elec_labels,
@@ -150,3 +232,255 @@ def plot_tab_circular_connectivity(list_list_conmat, all_elec_labels,
     plt.close(fig)
     # fig1.close()
     del fig
+
+
+_STORE_DIMS = ('subject_id', 'session_id', 'freq_band_name')
+
+_METADATA_DTYPE = np.dtype([('subject_id', h5py.string_dtype()),
+                            ('session_id', h5py.string_dtype()),
+                            ('freq_band_name', h5py.string_dtype()),
+                            ('conmat_file', h5py.string_dtype()),
+                            ('labels_file', h5py.string_dtype()),
+                            ('mtime', float),
+                            ('n_labels', int)])
+
+
+def _parse_iterables_dir(dir_name, fields=_STORE_DIMS):
+    """Get the values of the iterables from a nipype iteration directory.
+
+    E.g. '_freq_band_name_alpha_session_id_ses-01_subject_id_sub-01' gives
+    {'freq_band_name': 'alpha', 'session_id': 'ses-01',
+    'subject_id': 'sub-01'}; the fields that are not in dir_name are set to
+    ''.
+    """
+    pattern = '_({0})_(.*?)(?=_(?:{0})_|$)'.format(
+        '|'.join(re.escape(field) for field in fields))
+    values = dict(re.findall(pattern, dir_name))
+
+    return {field: values.get(field, '') for field in fields}
+
+
+def _scan_workflow_dir(workflow_dir, conmat_pattern, labels_fname):
+    """Find the conmat and labels files of each iteration directory."""
+    entries = list()
+    for iter_dir in sorted(os.scandir(workflow_dir), key=lambda d: d.name):
+        if not iter_dir.is_dir() or not iter_dir.name.startswith('_'):
+            continue
+
+        conmat_files = list()
+        labels_file = ''
+        for root, _, files in os.walk(iter_dir.path):
+            for fname in files:
+                if fnmatch.fnmatch(fname, conmat_pattern):
+                    conmat_files.append(os.path.join(root, fname))
+                elif fname == labels_fname:
+                    labels_file = os.path.join(root, fname)
+
+        if not conmat_files:
+            continue
+        if len(conmat_files) > 1:
+            # e.g. multi_con conmat_{i}_*.npy files would be written at the
+            # same index of the store
+            raise ValueError('Error, {} conmat files match {} in {}: only one '
+                             'conmat per iteration directory is supported, '
+                             'conmat_pattern should be more specific'.format(
+                                 len(conmat_files), conmat_pattern,
+                                 iter_dir.name))
+
+        entry = _parse_iterables_dir(iter_dir.name)
+        entry['conmat_file'] = conmat_files[0]
+        entry['labels_file'] = labels_file
+        entry['mtime'] = os.path.getmtime(conmat_files[0])
+        entries.append(entry)
+
+    return entries
+
+
+def _load_full_mat(entry, all_elec_labels):
+    """Load a conmat and align it to all_elec_labels."""
+    if _is_container(entry['conmat_file']):
+        container = read_container(entry['conmat_file'], mmap=False)
+        mat, ch_names = container['data'], container['ch_names']
+    else:
+        mat, ch_names = np.load(entry['conmat_file']), None
+
+    if entry['labels_file']:
+        elec_labels = _read_ch_names(entry['labels_file'])
+    elif ch_names is not None:
+        elec_labels = ch_names
+    else:
+        elec_labels = list(all_elec_labels)
+
+    return return_full_mat(mat, elec_labels, all_elec_labels), \
+        len(elec_labels)
+
+
+def _read_str_dataset(hf, name):
+    return [val.decode() if isinstance(val, bytes) else str(val)
+            for val in hf[name][()]]
+
+
+def gather_conmats_to_store(workflow_path, workflow_name, store_fname,
+                            all_elec_labels=None,
+                            conmat_pattern='conmat_*.npy',
+                            labels_fname='correct_channel_names.txt',
+                            n_jobs=1):
+    """Gather the conmats of a workflow in a single stacked hdf5 store.
+
+    The iteration directories of the workflow (e.g.
+    _freq_band_name_alpha_session_id_ses-01_subject_id_sub-01) are scanned
+    once, the conmats are aligned to all_elec_labels as in return_full_mat
+    and written in the 'conmats' dataset of shape (n_subjects, n_sessions,
+    n_bands, n_nodes, n_nodes), chunked by matrix; missing matrices are NaN.
+    The store also contains the 'subject_id', 'session_id',
+    'freq_band_name' and 'labels' datasets that index its dimensions and a
+    'metadata' table with one row per gathered conmat file.
+
+    If the store exists, only the conmat files that are not in its metadata
+    (or that have been modified) are read and added to the store; the
+    metadata row of a modified conmat file is replaced.
+
+    Only one conmat file per iteration directory is supported: if several
+    files match conmat_pattern (e.g. the conmat_{i}_*.npy files of
+    multi_con), a ValueError is raised and conmat_pattern should select one
+    of them, e.g. 'conmat_0_coh.npy'.
+
+    Parameters
+    ----------
+    workflow_path : str
+        Path of the connectivity workflow
+    workflow_name : str
+        Name of the connectivity workflow
+    store_fname : str
+        Name of the .hdf5 store
+    all_elec_labels : list of str | None
+        The labels of the nodes of the store; if None the union of the
+        labels of all conmats, sorted in natural order. Ignored if the store
+        exists
+    conmat_pattern : str
+        Pattern of the name of the conmat files
+    labels_fname : str
+        Name of the file with the labels of the conmat, in the same
+        iteration directory, e.g. 'label_names.txt' for inverse workflows
+    n_jobs : int
+        Number of threads loading the conmat files
+
+    Returns
+    -------
+    n_new : int
+        Number of conmats added to the store
+    """
+    workflow_dir = os.path.join(workflow_path, workflow_name)
+    entries = _scan_workflow_dir(workflow_dir, conmat_pattern, labels_fname)
+
+    indices = [tuple(entry[dim] for dim in _STORE_DIMS) for entry in entries]
+    if len(set(indices)) < len(indices):
+        raise ValueError('Error, several iteration directories have the same '
+                         '{}'.format(', '.join(_STORE_DIMS)))
+
+    with h5py.File(store_fname, 'a') as hf:
+        if 'conmats' in hf:
+            all_elec_labels = _read_str_dataset(hf, 'labels')
+            done = {(row['conmat_file'].decode(), row['mtime'])
+                    for row in hf['metadata'][()]}
+            entries = [entry for entry in entries if
+                       (entry['conmat_file'], entry['mtime']) not in done]
+        elif all_elec_labels is None:
+            labels = set()
+            for entry in entries:
+                if entry['labels_file']:
+                    labels.update(_read_ch_names(entry['labels_file']))
+            if not labels:
+                raise ValueError('Error, no {} file found: all_elec_labels '
+                                 'should be given'.format(labels_fname))
+            all_elec_labels = sorted(labels, key=natural_keys)
+
+        print(('*** {} new conmats to gather ***'.format(len(entries))))
+        if not entries:
+            return 0
+
+        n_nodes = len(all_elec_labels)
+        if 'conmats' not in hf:
+            hf.create_dataset('labels', data=np.array(all_elec_labels,
+                                                      dtype=object),
+                              dtype=h5py.string_dtype())
+            for dim in _STORE_DIMS:
+                hf.create_dataset(dim, shape=(0,), maxshape=(None,),
+                                  dtype=h5py.string_dtype())
+            hf.create_dataset('conmats', shape=(0, 0, 0, n_nodes, n_nodes),
+                              maxshape=(None, None, None, n_nodes, n_nodes),
+                              chunks=(1, 1, 1, n_nodes, n_nodes),
+                              dtype='f8', fillvalue=np.nan)
+            hf.create_dataset('metadata', shape=(0,), maxshape=(None,),
+                              dtype=_METADATA_DTYPE)
+
+        # add the new subjects, sessions and bands to the dimensions
+        dim_values = dict()
+        for dim in _STORE_DIMS:
+            values = _read_str_dataset(hf, dim)
+            for entry in entries:
+                if entry[dim] not in values:
+                    values.append(entry[dim])
+            hf[dim].resize((len(values),))
+            hf[dim][:] = np.array(values, dtype=object)
+            dim_values[dim] = values
+
+        conmats = hf['conmats']
+        conmats.resize(tuple(len(dim_values[dim]) for dim in _STORE_DIMS) +
+                       (n_nodes, n_nodes))
+
+        # the conmats are loaded in parallel and written as they come
+        metadata = list()
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            full_mats = executor.map(
+                lambda entry: _load_full_mat(entry, all_elec_labels), entries)
+            for entry, (full_mat, n_labels) in zip(entries, full_mats):
+                index = tuple(dim_values[dim].index(entry[dim])
+                              for dim in _STORE_DIMS)
+                conmats[index] = full_mat
+                metadata.append(tuple(entry[dim] for dim in _STORE_DIMS) + (
+                    entry['conmat_file'], entry['labels_file'],
+                    entry['mtime'], n_labels))
+
+        # the row of a modified conmat file is replaced
+        rows = {row['conmat_file'].decode(): i_row
+                for i_row, row in enumerate(hf['metadata'][()])}
+        for entry in entries:
+            rows.setdefault(entry['conmat_file'], len(rows))
+        hf['metadata'].resize((len(rows),))
+        for entry, row in zip(entries, metadata):
+            hf['metadata'][rows[entry['conmat_file']]] = np.array(
+                row, dtype=_METADATA_DTYPE)
+
+    return len(entries)
+
+
+def read_conmat_store(store_fname):
+    """Read a store written by gather_conmats_to_store.
+
+    Parameters
+    ----------
+    store_fname : str
+        Name of the .hdf5 store
+
+    Returns
+    -------
+    conmats : array, shape (n_subjects, n_sessions, n_bands, n_nodes, n_nodes)
+        The conmats
+    dims : dict
+        The values of 'subject_id', 'session_id', 'freq_band_name' and
+        'labels' indexing the dimensions of conmats
+    metadata : list of dict
+        One dict per gathered conmat file
+    """
+    with h5py.File(store_fname, 'r') as hf:
+        conmats = hf['conmats'][()]
+        dims = {dim: _read_str_dataset(hf, dim)
+                for dim in _STORE_DIMS + ('labels',)}
+        metadata = list()
+        for row in hf['metadata'][()]:
+            metadata.append({
+                name: row[name].decode() if isinstance(row[name], bytes)
+                else row[name].item() for name in _METADATA_DTYPE.names})
+
+    return conmats, dims, metadata
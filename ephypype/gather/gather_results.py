@@ -4,11 +4,261 @@
 #
 # License: BSD (3-clause)
 
+import os
 import glob
+import sqlite3
 import os.path as op
 
+from .gather_conmats import _parse_iterables_dir
 
-def get_channel_files(workflow_path, workflow_name):
+# name of the result index saved in the workflow directory
+RESULT_INDEX_FNAME = 'result_index.sqlite'
+
+# (result file, label file, depth of the files in the workflow directory)
+_PIPELINE_FILES = {
+    'connectivity': ('*.npy', None, 4),
+    'power': ('*.npz', '*coords.txt', 4),
+    'inverse': ('*.npy', '*.pkl', 4),
+    'ica': ('*ica_solution.fif', '*ica.fif', 4),
+    'tfr_morlet': ('*-tfr.h*5', None, 3),
+    'compute_evoked': ('*-ave.fif', None, 4)}
+
+# depths of the files recorded in the index
+_INDEX_DEPTHS = (3, 4)
+
+
+def _iter_workflow_dirs(workflow_dir, depth=1,
+                        max_depth=max(_INDEX_DEPTHS) - 1):
+    """Walk the directories of the workflow directory with os.scandir.
+
+    Yields (path, depth, mtime) of the directories up to max_depth; hidden
+    entries are skipped as with glob.
+    """
+    try:
+        entries = list(os.scandir(workflow_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        return
+
+    for entry in entries:
+        if entry.name.startswith('.') or not entry.is_dir():
+            continue
+        yield entry.path, depth, entry.stat().st_mtime
+        if depth < max_depth:
+            yield from _iter_workflow_dirs(entry.path, depth + 1, max_depth)
+
+
+def _get_index_dirs(workflow_dir):
+    """Get the (path, depth, mtime) of the directories of indexed files."""
+    return [(path, depth, mtime) for path, depth, mtime
+            in _iter_workflow_dirs(workflow_dir)
+            if depth + 1 in _INDEX_DEPTHS]
+
+
+def _file_record(workflow_dir, path, depth):
+    """Get the row of the result index of a file."""
+    rel_path = op.relpath(path, workflow_dir)
+    iter_dir = rel_path.split(os.sep)[0]
+    iterables = _parse_iterables_dir(iter_dir,
+                                     fields=('subject_id', 'session_id'))
+
+    return (path, op.dirname(path), op.basename(path), depth,
+            iterables['subject_id'], iterables['session_id'],
+            op.getmtime(path))
+
+
+def _connect_result_index(workflow_dir):
+    """Open the result index of the workflow, creating the tables if needed.
+
+    The 'files' table records the files and the 'dirs' table the mtime of
+    the directories containing them when they were scanned.
+    """
+    conn = sqlite3.connect(op.join(workflow_dir, RESULT_INDEX_FNAME),
+                           timeout=60.)
+    conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                 'path TEXT PRIMARY KEY, dir TEXT, name TEXT, '
+                 'depth INTEGER, subject_id TEXT, session_id TEXT, '
+                 'mtime REAL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_name '
+                 'ON files (depth, name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_dir ON files (dir)')
+    conn.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                 'path TEXT PRIMARY KEY, mtime REAL)')
+
+    return conn
+
+
+def _scan_dirs(conn, workflow_dir, dirs):
+    """Replace the files of the (path, depth, mtime) dirs in the index."""
+    records = list()
+    for dir_path, depth, _ in dirs:
+        try:
+            entries = list(os.scandir(dir_path))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        records.extend(
+            _file_record(workflow_dir, entry.path, depth + 1)
+            for entry in entries
+            if entry.is_file() and not entry.name.startswith('.'))
+
+    with conn:
+        conn.executemany('DELETE FROM files WHERE dir = ?',
+                         [(dir_path,) for dir_path, _, _ in dirs])
+        conn.executemany('INSERT OR REPLACE INTO files VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?)', records)
+        conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                         [(dir_path, mtime) for dir_path, _, mtime in dirs])
+
+    return len(records)
+
+
+def _refresh_result_index(conn, workflow_dir):
+    """Rescan the directories whose mtime changed since they were indexed.
+
+    The mtime of a directory changes when files are added to or removed
+    from it, e.g. by a rerun or the nodes of a new subject.
+    """
+    dirs = _get_index_dirs(workflow_dir)
+    indexed_dirs = dict(conn.execute('SELECT path, mtime FROM dirs'))
+
+    changed_dirs = [(path, depth, mtime) for path, depth, mtime in dirs
+                    if indexed_dirs.pop(path, None) != mtime]
+    if changed_dirs:
+        print(('*** {} directories scanned for the result index ***'.format(
+            len(changed_dirs))))
+        _scan_dirs(conn, workflow_dir, changed_dirs)
+
+    # removed directories
+    with conn:
+        conn.executemany('DELETE FROM files WHERE dir = ?',
+                         [(path,) for path in indexed_dirs])
+        conn.executemany('DELETE FROM dirs WHERE path = ?',
+                         [(path,) for path in indexed_dirs])
+
+
+def update_result_index(workflow_path, workflow_name, node_dir=None):
+    """Build or update the result index of a workflow.
+
+    The index is a sqlite file saved in the workflow directory, which
+    records the files of the node directories, so that get_results and
+    get_channel_files with use_index=True do not have to glob the whole
+    workflow directory.
+
+    Parameters
+    ----------
+       workflow_path : str
+           Path of the workflow
+       workflow_name : str
+           Name of the workflow
+       node_dir : str | None
+           If None, the whole workflow directory is scanned once and the
+           index is rebuilt; otherwise only the files of this node
+           directory are added to the index
+
+    Returns
+    -------
+        n_files : int
+            Number of indexed files
+    """
+    workflow_dir = op.join(workflow_path, workflow_name)
+
+    if node_dir is None:
+        dirs = _get_index_dirs(workflow_dir)
+    else:
+        depth = len(op.relpath(node_dir, workflow_dir).split(os.sep))
+        dirs = [(node_dir, depth, op.getmtime(node_dir))]
+        dirs = [d for d in dirs if d[1] + 1 in _INDEX_DEPTHS]
+
+    conn = _connect_result_index(workflow_dir)
+    if node_dir is None:
+        with conn:
+            conn.execute('DELETE FROM files')
+            conn.execute('DELETE FROM dirs')
+    n_files = _scan_dirs(conn, workflow_dir, dirs)
+    conn.close()
+
+    return n_files
+
+
+def result_index_callback(workflow_path, workflow_name):
+    """Get a nipype status callback adding the node files to the index.
+
+    The callback can be passed to the MultiProc or Linear plugins, e.g.
+    workflow.run(plugin='MultiProc', plugin_args={'status_callback':
+    result_index_callback(workflow.base_dir, workflow.name)}), so that the
+    index is updated as the nodes finish.
+    """
+    def _status_callback(node, status):
+        if status == 'end':
+            update_result_index(workflow_path, workflow_name,
+                                node_dir=node.output_dir())
+
+    return _status_callback
+
+
+def _query_result_index(workflow_path, workflow_name, depth, pattern,
+                        subject_id=None, session_id=None, refresh=False):
+    """Get the indexed files matching the pattern at depth.
+
+    The index is built if it does not exist. Otherwise it is trusted, as
+    kept up to date by result_index_callback, unless refresh is True: the
+    directories modified since they were indexed are then scanned again
+    before the query, which walks the whole workflow directory.
+    """
+    workflow_dir = op.join(workflow_path, workflow_name)
+    if not op.isdir(workflow_dir):
+        return list()
+
+    if not op.isfile(op.join(workflow_dir, RESULT_INDEX_FNAME)):
+        update_result_index(workflow_path, workflow_name)
+        refresh = False
+
+    conn = _connect_result_index(workflow_dir)
+    if refresh:
+        _refresh_result_index(conn, workflow_dir)
+
+    query = 'SELECT path FROM files WHERE depth = ? AND name GLOB ?'
+    params = [depth, pattern]
+    if subject_id is not None:
+        query += ' AND subject_id = ?'
+        params.append(subject_id)
+    if session_id is not None:
+        query += ' AND session_id = ?'
+        params.append(session_id)
+
+    paths = [row[0] for row in conn.execute(query + ' ORDER BY path',
+                                            params)]
+    conn.close()
+
+    return paths
+
+
+def _get_list(workflow_path, workflow_name, depth, result_file,
+              subject_id=None, session_id=None, use_index=False,
+              refresh=False):
+    """Get the files matching result_file at depth in the workflow."""
+    if use_index:
+        return _query_result_index(workflow_path, workflow_name, depth,
+                                   result_file, subject_id=subject_id,
+                                   session_id=session_id, refresh=refresh)
+
+    workflow_dir = op.join(workflow_path, workflow_name)
+    file_path = op.join(workflow_dir, *(['*'] * (depth - 1) + [result_file]))
+    results_files = list()
+    for path in sorted(glob.glob(file_path)):
+        iter_dir = op.relpath(path, workflow_dir).split(os.sep)[0]
+        iterables = _parse_iterables_dir(iter_dir,
+                                         fields=('subject_id', 'session_id'))
+        if subject_id is not None and iterables['subject_id'] != subject_id:
+            continue
+        if session_id is not None and iterables['session_id'] != session_id:
+            continue
+        results_files.append(path)
+
+    return results_files
+
+
+def get_channel_files(workflow_path, workflow_name, subject_id=None,
+                      session_id=None, use_index=False, refresh=False):
     """Get channel files.
 
     Parameters
@@ -17,6 +267,17 @@ def get_channel_files(workflow_path, workflow_name):
            Path of connectivity workflow
        workflow_name : str
            Name of the connectivity workflows
+       subject_id : str | None
+           If not None, only the files of this subject are returned
+       session_id : str | None
+           If not None, only the files of this session are returned
+       use_index : bool
+           If True, the files are searched in the result index of the
+           workflow (see update_result_index) instead of globbing the
+           workflow directory
+       refresh : bool
+           If True and use_index, the directories modified since they were
+           indexed are scanned again before the query
 
     Returns
     -------
@@ -28,15 +289,19 @@ def get_channel_files(workflow_path, workflow_name):
     channels_fname = 'correct_channel_coords.txt'
     channels_name_fname = 'correct_channel_names.txt'
 
-    node_path = op.join(workflow_path, workflow_name, '*', '*')
-
-    channels_files = _get_list(node_path, channels_fname)
-    channels_name_files = _get_list(node_path, channels_name_fname)
+    kwargs = dict(subject_id=subject_id, session_id=session_id,
+                  use_index=use_index)
+    channels_files = _get_list(workflow_path, workflow_name, 3,
+                               channels_fname, refresh=refresh, **kwargs)
+    channels_name_files = _get_list(workflow_path, workflow_name, 3,
+                                    channels_name_fname, **kwargs)
 
     return channels_files, channels_name_files
 
 
-def get_results(workflow_path, workflow_name, pipeline=None):
+def get_results(workflow_path, workflow_name, pipeline=None, subject_id=None,
+                session_id=None, file_pattern=None, use_index=False,
+                refresh=False):
     """Get results files.
 
     Parameters
@@ -47,58 +312,44 @@ def get_results(workflow_path, workflow_name, pipeline=None):
            Name of the connectivity workflow
        pipeline : str
            name of the pipeline (possible values: 'connectivity', 'inverse',
-           'psd', 'ica')
+           'power', 'ica', 'tfr_morlet', 'compute_evoked')
+       subject_id : str | None
+           If not None, only the files of this subject are returned
+       session_id : str | None
+           If not None, only the files of this session are returned
+       file_pattern : str | None
+           If not None, glob pattern of the result files used instead of
+           the default one of the pipeline
+       use_index : bool
+           If True, the files are searched in the result index of the
+           workflow (see update_result_index), which is created in the
+           workflow directory at the first call and then kept up to date by
+           result_index_callback. Otherwise the workflow directory is
+           globbed
+       refresh : bool
+           If True and use_index, the directories modified since they were
+           indexed (e.g. by a rerun without result_index_callback) are
+           scanned again before the query; this walks the whole workflow
+           directory
 
     Returns
     -------
         matrices : list of str
             List of path of results
     """
-    if pipeline == 'connectivity':
-        result_file = '*.npy'
-        label_file = None
-        node_path = op.join(workflow_path, workflow_name, '*', '*', '*')
-
-    elif pipeline == 'power':
-        result_file = '*.npz'
-        label_file = '*coords.txt'
-        node_path = op.join(workflow_path, workflow_name, '*', '*', '*')
-
-    elif pipeline == 'inverse':
-        result_file = '*.npy'
-        label_file = '*.pkl'
-        node_path = op.join(workflow_path, workflow_name, '*', '*', '*')
-
-    elif pipeline == 'ica':
-        result_file = '*ica_solution.fif'
-        label_file = '*ica.fif'
-        node_path = op.join(workflow_path, workflow_name, '*', '*', '*')
-
-    elif pipeline == 'tfr_morlet':
-        result_file = '*-tfr.h5'
-        label_file = None
-        node_path = op.join(workflow_path, workflow_name, '*', '*')
-
-    elif pipeline == 'compute_evoked':
-        result_file = '*-ave.fif'
-        label_file = None
-        node_path = op.join(workflow_path, workflow_name, '*', '*', '*')
-
-    results_files = _get_list(node_path, result_file)
+    result_file, label_file, depth = _PIPELINE_FILES[pipeline]
+    if file_pattern is not None:
+        result_file = file_pattern
+
+    kwargs = dict(subject_id=subject_id, session_id=session_id,
+                  use_index=use_index)
+    results_files = _get_list(workflow_path, workflow_name, depth,
+                              result_file, refresh=refresh, **kwargs)
 
     if label_file:
-        labels_file = _get_list(node_path, label_file)
+        labels_file = _get_list(workflow_path, workflow_name, depth,
+                                label_file, **kwargs)
     else:
         labels_file = None
 
     return results_files, labels_file
-
-
-def _get_list(node_path, result_file):
-
-    file_path = op.join(node_path, result_file)
-    results_files = glob.glob(file_path)
-
-    return results_files
-
-# TODO add get figs on connectivity (*.png) and psd wf
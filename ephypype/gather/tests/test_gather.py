@@ -1,6 +1,14 @@
 """Test gather."""
+import numpy as np
+import pytest
 
-from ephypype.gather.gather_results import get_results
+from ephypype.gather import gather_results
+from ephypype.gather.gather_results import (get_results, get_channel_files,
+                                            update_result_index,
+                                            RESULT_INDEX_FNAME)
+from ephypype.gather.gather_conmats import (return_full_mat, return_full_mats,
+                                            gather_conmats_to_store,
+                                            read_conmat_store)
 
 
 def test_get_results():
@@ -11,3 +19,171 @@ def test_get_results():
         res = get_results('',  '', name)
 
         assert res
+
+
+def test_return_full_mats():
+    """Test scattering conmats with their labels in the full matrices."""
+    all_elec_labels = ['A', 'B', 'C', 'D']
+    mat = np.array([[0., 0., 0.],
+                    [1., 0., 0.],
+                    [2., 3., 0.]])
+    elec_labels = ['C', 'A', 'E']
+
+    full_mat = return_full_mat(mat, elec_labels, all_elec_labels)
+
+    # lower triangular mat is symmetrized, diagonal and missing labels NaN
+    assert full_mat[0, 2] == full_mat[2, 0] == 1.
+    assert np.all(np.isnan(np.diag(full_mat)))
+    assert np.all(np.isnan(full_mat[[1, 3]]))
+    assert np.all(np.isnan(full_mat[:, [1, 3]]))
+
+    full_mats = return_full_mats([mat, mat.T * 2, mat[:2, :2]],
+                                 [elec_labels, elec_labels, ['B', 'D']],
+                                 all_elec_labels)
+    assert full_mats.shape == (3, 4, 4)
+    np.testing.assert_array_equal(full_mats[0], full_mat)
+    np.testing.assert_array_equal(full_mats[1], full_mat * 2)
+    assert full_mats[2, 1, 3] == full_mats[2, 3, 1] == 1.
+    assert np.sum(~np.isnan(full_mats[2])) == 2
+
+
+def test_gather_conmats_to_store(tmpdir):
+    """Test gathering conmats of a workflow in a stacked store."""
+    import os
+
+    def _write_conmat(sbj, ses, band, labels):
+        iter_dir = tmpdir.join('wf', '_freq_band_name_{}_session_id_{}_'
+                                     'subject_id_{}'.format(band, ses, sbj))
+        conmat_dir = iter_dir.join('ts_to_conmat', 'spectral')
+        labels_dir = iter_dir.join('create_array_node')
+        os.makedirs(str(conmat_dir))
+        os.makedirs(str(labels_dir))
+        mat = np.tril(np.random.rand(len(labels), len(labels)), k=-1)
+        np.save(str(conmat_dir.join('conmat_0_coh.npy')), mat)
+        np.savetxt(str(labels_dir.join('correct_channel_names.txt')),
+                   np.array(labels), fmt='%s')
+        return mat
+
+    store_fname = str(tmpdir.join('conmats.hdf5'))
+
+    mat = _write_conmat('sub-01', 'ses-01', 'alpha', ['A', 'B', 'C'])
+    _write_conmat('sub-02', 'ses-01', 'alpha', ['B', 'C'])
+    assert gather_conmats_to_store(str(tmpdir), 'wf', store_fname) == 2
+
+    # only the new conmat is gathered on rerun
+    _write_conmat('sub-01', 'ses-01', 'beta', ['A', 'B', 'C'])
+    assert gather_conmats_to_store(str(tmpdir), 'wf', store_fname,
+                                   n_jobs=2) == 1
+    assert gather_conmats_to_store(str(tmpdir), 'wf', store_fname) == 0
+
+    conmats, dims, metadata = read_conmat_store(store_fname)
+    assert conmats.shape == (2, 1, 2, 3, 3)
+    assert dims['subject_id'] == ['sub-01', 'sub-02']
+    assert dims['freq_band_name'] == ['alpha', 'beta']
+    assert dims['labels'] == ['A', 'B', 'C']
+    assert len(metadata) == 3
+
+    np.testing.assert_array_equal(
+        conmats[0, 0, 0], return_full_mat(mat, ['A', 'B', 'C'],
+                                          ['A', 'B', 'C']))
+    # missing label and missing band are NaN
+    assert np.all(np.isnan(conmats[1, 0, 0, 0]))
+    assert not np.isnan(conmats[1, 0, 0, 1, 2])
+    assert np.all(np.isnan(conmats[1, 0, 1]))
+
+    # the metadata row of a modified conmat is replaced
+    conmat_fname = metadata[0]['conmat_file']
+    mat = np.tril(np.random.rand(3, 3), k=-1)
+    np.save(conmat_fname, mat)
+    os.utime(conmat_fname, (0., 1e9))
+    assert gather_conmats_to_store(str(tmpdir), 'wf', store_fname) == 1
+
+    conmats, _, metadata = read_conmat_store(store_fname)
+    assert len(metadata) == 3
+    assert [row['mtime'] for row in metadata].count(1e9) == 1
+    np.testing.assert_array_equal(
+        conmats[0, 0, 0], return_full_mat(mat, ['A', 'B', 'C'],
+                                          ['A', 'B', 'C']))
+
+    # several conmats of an iteration directory need a specific pattern
+    conmat_dir = os.path.dirname(conmat_fname)
+    np.save(os.path.join(conmat_dir, 'conmat_1_coh.npy'), mat)
+    with pytest.raises(ValueError, match='only one conmat'):
+        gather_conmats_to_store(str(tmpdir), 'wf', store_fname)
+    assert gather_conmats_to_store(str(tmpdir), 'wf', store_fname,
+                                   conmat_pattern='conmat_0_coh.npy') == 0
+
+
+def test_result_index(tmpdir, monkeypatch):
+    """Test the result index matches the glob of the workflow directory."""
+    import os
+    import glob
+
+    for sbj in ['sub-01', 'sub-02']:
+        iter_dir = tmpdir.join(
+            'wf', '_session_id_ses-01_subject_id_{}'.format(sbj))
+        node_dir = iter_dir.join('ts_to_conmat', 'spectral')
+        os.makedirs(str(node_dir))
+        np.save(str(node_dir.join('conmat_0_coh.npy')), np.zeros((2, 2)))
+        iter_dir.join('ts_to_conmat', 'correct_channel_names.txt').write('A')
+
+    # the workflow directory is globbed by default, without index
+    conmat_files, _ = get_results(str(tmpdir), 'wf', 'connectivity')
+    assert conmat_files == sorted(
+        glob.glob(str(tmpdir.join('wf', '*', '*', '*', '*.npy'))))
+    assert not tmpdir.join('wf', RESULT_INDEX_FNAME).check()
+    assert get_results(str(tmpdir), 'wf', 'connectivity',
+                       subject_id='sub-02')[0] == conmat_files[1:]
+
+    index_files, _ = get_results(str(tmpdir), 'wf', 'connectivity',
+                                 use_index=True)
+    assert index_files == conmat_files
+    assert tmpdir.join('wf', RESULT_INDEX_FNAME).check()
+
+    conmat_files, _ = get_results(str(tmpdir), 'wf', 'connectivity',
+                                  subject_id='sub-02', use_index=True)
+    assert len(conmat_files) == 1 and 'sub-02' in conmat_files[0]
+    for use_index in (False, True):
+        _, channel_name_files = get_channel_files(
+            str(tmpdir), 'wf', session_id='ses-01', use_index=use_index)
+        assert len(channel_name_files) == 2
+
+    # the index is trusted without walking the workflow directory
+    node_dir = tmpdir.join('wf', '_session_id_ses-01_subject_id_sub-01',
+                           'ts_to_conmat', 'spectral')
+    np.save(str(node_dir.join('conmat_0_plv.npy')), np.zeros((2, 2)))
+    os.utime(str(node_dir), (0., 1e9))
+
+    def _fail(*args, **kwargs):
+        raise RuntimeError('the workflow directory should not be walked')
+
+    with monkeypatch.context() as m:
+        m.setattr(gather_results, '_iter_workflow_dirs', _fail)
+        m.setattr(gather_results.os, 'scandir', _fail)
+        assert len(get_results(str(tmpdir), 'wf', 'connectivity',
+                               use_index=True)[0]) == 2
+
+    # new files are found by a refresh, e.g. after a rerun
+    assert len(get_results(str(tmpdir), 'wf', 'connectivity',
+                           use_index=True, refresh=True)[0]) == 3
+    assert len(get_results(str(tmpdir), 'wf', 'connectivity',
+                           file_pattern='*plv.npy', use_index=True)[0]) == 1
+
+    # and those of a new subject, while the files of a removed node are not
+    node_dir = tmpdir.join('wf', '_session_id_ses-01_subject_id_sub-03',
+                           'ts_to_conmat', 'spectral')
+    os.makedirs(str(node_dir))
+    np.save(str(node_dir.join('conmat_0_coh.npy')), np.zeros((2, 2)))
+    tmpdir.join('wf', '_session_id_ses-01_subject_id_sub-02').remove()
+    conmat_files, _ = get_results(str(tmpdir), 'wf', 'connectivity',
+                                  use_index=True, refresh=True)
+    assert conmat_files == get_results(str(tmpdir), 'wf',
+                                       'connectivity')[0]
+    assert len(conmat_files) == 3 and 'sub-03' in conmat_files[-1]
+
+    # the files of a finished node are added to the index
+    np.save(str(node_dir.join('conmat_0_pli.npy')), np.zeros((2, 2)))
+    assert update_result_index(str(tmpdir), 'wf', node_dir=str(node_dir)) == 2
+    assert len(get_results(str(tmpdir), 'wf', 'connectivity',
+                           file_pattern='*pli.npy', use_index=True)[0]) == 1
+    assert update_result_index(str(tmpdir), 'wf') == 5
@@ -1,6 +1,9 @@
 """Import data."""
+import datetime
 import h5py
 import os
+import struct
+import zipfile
 import mne
 import numpy as np
 
@@ -44,7 +47,8 @@ def _read_fieldtrip_epochs(epo_mat_file, data_field_name='data'):
     return epo_fif_file
 
 
-def write_hdf5(filename, data, dataset_name='dataset', dtype='f'):
+def write_hdf5(filename, data, dataset_name='dataset', dtype='f',
+               compression=None):
     """
     Create hdf5 file
 
@@ -57,15 +61,223 @@ def write_hdf5(filename, data, dataset_name='dataset', dtype='f'):
             name of dataset to create
         dtype : str
             data type for new dataset
+        compression : str | None
+            compression filter of the dataset, 'lzf' or 'gzip'
 
     """
 
     hf = h5py.File(filename, 'w')
-    hf.create_dataset(dataset_name, data=data, dtype=dtype)
+    hf.create_dataset(dataset_name, data=data, dtype=dtype,
+                      compression=compression)
     hf.close()
 
 
-def _read_hdf5(filename, dataset_name='dataset', transpose=False):
+class _HDF5Writer(object):
+    """Append arrays of the same shape to a resizable hdf5 dataset.
+
+    The dataset has shape (n_arrays, ...) and grows along its first axis each
+    time an array (e.g. the data of the stc of one epoch) is appended, so
+    that only one array needs to be in memory. It is chunked by blocks of
+    rows of the appended arrays, so that a range of arrays and of rows (e.g.
+    vertices) can be read without reading the whole dataset.
+
+    Inputs
+        filename : str
+            hdf5 filename
+        dataset_name : str
+            name of dataset to create
+        dtype : str
+            data type for new dataset
+        compression : str | None
+            compression filter of the dataset, 'lzf' (fast) or 'gzip'
+        compression_opts : int | None
+            compression level if compression is 'gzip' (0-9)
+        chunk_bytes : int
+            approximate size in bytes of the chunks of the dataset
+    """
+
+    def __init__(self, filename, dataset_name='dataset', dtype='f',
+                 compression=None, compression_opts=None, chunk_bytes=2 ** 20):
+        if compression not in (None, 'lzf', 'gzip'):
+            raise ValueError('compression should be None, "lzf" or "gzip", '
+                             'got {}'.format(compression))
+
+        self.filename = filename
+        self.dataset_name = dataset_name
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunk_bytes = chunk_bytes
+        self._hf = h5py.File(filename, 'w')
+        self._dset = None
+
+    def append(self, data):
+        """Append an array to the dataset."""
+        data = np.asarray(data)
+
+        if self._dset is None:
+            # chunks of several rows of one array
+            row_bytes = max(1, int(np.prod(data.shape[1:])) *
+                            self.dtype.itemsize)
+            n_rows = max(1, min(data.shape[0] if data.ndim else 1,
+                                self.chunk_bytes // row_bytes))
+            chunks = (1,) + ((n_rows,) + data.shape[1:] if data.ndim else ())
+
+            self._dset = self._hf.create_dataset(
+                self.dataset_name, shape=(0,) + data.shape,
+                maxshape=(None,) + data.shape, dtype=self.dtype,
+                chunks=chunks, compression=self.compression,
+                compression_opts=self.compression_opts)
+
+        if data.shape != self._dset.shape[1:]:
+            raise ValueError('Error, shape {} should be {}'.format(
+                data.shape, self._dset.shape[1:]))
+
+        n_arrays = self._dset.shape[0]
+        self._dset.resize(n_arrays + 1, axis=0)
+        self._dset[n_arrays] = data
+
+    @property
+    def shape(self):
+        """Shape of the dataset."""
+        return None if self._dset is None else self._dset.shape
+
+    def close(self):
+        """Close the hdf5 file."""
+        self._hf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# attribute identifying the hdf5 files written by write_container
+CONTAINER_FORMAT = 'ephypype-container'
+
+
+def write_container(filename, data=None, freqs=None, ch_names=None,
+                    ch_coords=None, extra=None, mode='w', **attrs):
+    """
+    Write the output of a node in a self-describing hdf5 container
+
+    The container replaces the .npy/.npz file of the data and the .txt files
+    of the channel names and coordinates written next to it.
+
+    Inputs
+        filename : str
+            hdf5 filename
+        data : array | None
+            the data (e.g. psds or connectivity matrix), stored in the
+            'data' dataset
+        freqs : array | None
+            the frequencies of the last dimension of data
+        ch_names : list of str | None
+            the names of the channels (or labels) of the data
+        ch_coords : array, shape (n_channels, 3) | None
+            the coordinates of the channels (or labels)
+        extra : dict | None
+            other arrays to store, with their dataset names as keys
+        mode : str
+            'w' to create the file, 'a' to add the datasets and attributes
+            to an existing hdf5 file, e.g. whose 'data' dataset has been
+            written by _HDF5Writer
+        attrs : dict
+            provenance attributes (e.g. method, fmin, fmax, source file);
+            the format, the ephypype and mne versions and the creation date
+            are added to them
+    Outputs
+        filename : str
+            the absolute hdf5 filename
+    """
+    from . import __version__
+
+    filename = os.path.abspath(filename)
+    datasets = dict(data=data, freqs=freqs, ch_coords=ch_coords)
+    if ch_names is not None:
+        datasets['ch_names'] = np.array(ch_names, dtype=h5py.string_dtype())
+    if extra is not None:
+        datasets.update(extra)
+
+    with h5py.File(filename, mode) as hf:
+        for name, value in datasets.items():
+            if value is not None:
+                hf.create_dataset(name, data=value)
+
+        hf.attrs['format'] = CONTAINER_FORMAT
+        hf.attrs['ephypype_version'] = __version__
+        hf.attrs['mne_version'] = mne.__version__
+        hf.attrs['created'] = datetime.datetime.now().isoformat()
+        for name, value in attrs.items():
+            if value is not None:
+                hf.attrs[name] = value
+
+    print(('*** save {} ***'.format(filename)))
+    return filename
+
+
+def _is_container(filename):
+    """Check if filename is a container written by write_container."""
+    if split_f(filename)[2] not in ('.hdf5', '.h5') or \
+            not h5py.is_hdf5(filename):
+        return False
+
+    with h5py.File(filename, 'r') as hf:
+        return hf.attrs.get('format') == CONTAINER_FORMAT
+
+
+def read_container(filename, mmap=True):
+    """
+    Read a container written by write_container in one call
+
+    Inputs
+        filename : str
+            hdf5 filename
+        mmap : bool
+            if True the datasets are not loaded in memory: h5py datasets are
+            returned, which are read when they are sliced; the channel names
+            and the attributes are always loaded
+    Outputs
+        container : dict
+            the datasets of the container ('data', 'freqs', 'ch_names',
+            'ch_coords' and the extra ones) and its attributes ('attrs')
+    """
+    # the file stays open as long as the datasets are referenced
+    hf = h5py.File(filename, 'r')
+    if hf.attrs.get('format') != CONTAINER_FORMAT:
+        hf.close()
+        raise ValueError('{} is not a container written by '
+                         'write_container'.format(filename))
+
+    container = dict(data=None, freqs=None, ch_names=None, ch_coords=None)
+    for name, dset in hf.items():
+        if name == 'ch_names':
+            container[name] = [str(val) for val in dset.asstr()[()]]
+        elif mmap:
+            container[name] = dset
+        else:
+            container[name] = dset[()]
+    container['attrs'] = dict(hf.attrs)
+
+    if not mmap:
+        hf.close()
+
+    return container
+
+
+def _read_ch_names(filename):
+    """Read the channel (or label) names of a .txt file or a container."""
+    if _is_container(filename):
+        with h5py.File(filename, 'r') as hf:
+            return [str(name) for name in hf['ch_names'].asstr()[()]]
+
+    return [str(name) for name in np.genfromtxt(
+        filename, dtype=str, delimiter='\n', ndmin=1)]
+
+
+def _read_hdf5(filename, dataset_name='dataset', transpose=False,
+               epoch_range=None, vertex_range=None):
 
     """
     Read hdf5 file
@@ -77,13 +289,38 @@ def _read_hdf5(filename, dataset_name='dataset', transpose=False):
             name of dataset to create
         transpose: bool
             if the data needs to be transpose or not
+        epoch_range : tuple of int | None
+            (start, stop) of the epochs to read, i.e. of the first axis of
+            a dataset of shape (n_epochs, n_vertices, n_times); if None all
+            epochs are read
+        vertex_range : tuple of int | None
+            (start, stop) of the vertices to read, i.e. of the first axis of
+            a dataset of shape (n_vertices, n_times) or of the second one of
+            a dataset of shape (n_epochs, n_vertices, n_times); if None all
+            vertices are read
     Outputs
         data : array, shape (n_vertices, n_times)
             raw data for whose the dataset is created
     """
 
-    hf = h5py.File(filename, 'r')
-    data = hf[dataset_name][()]
+    with h5py.File(filename, 'r') as hf:
+        dset = hf[dataset_name]
+
+        if epoch_range is None and vertex_range is None:
+            data = dset[()]
+        else:
+            if dset.ndim == 3:
+                index = (slice(*epoch_range) if epoch_range else slice(None),)
+            elif epoch_range is not None:
+                raise ValueError('Error, epoch_range needs a dataset of '
+                                 'shape (n_epochs, n_vertices, n_times)')
+            else:
+                index = ()
+            if vertex_range is not None:
+                index += (slice(*vertex_range),)
+
+            # only the chunks of the selected epochs and vertices are read
+            data = dset[index]
 
     if transpose:
         data = np.transpose(data)
@@ -95,6 +332,153 @@ def _read_hdf5(filename, dataset_name='dataset', transpose=False):
     return data
 
 
+def _read_ts(filename, dataset_name='stc_data', mmap=True):
+    """
+    Read time series from .npy or .hdf5 file
+
+    Inputs
+        filename : str
+            .npy or .hdf5 filename
+        dataset_name : str
+            name of the dataset in the hdf5 file; the 'data' dataset of a
+            container written by write_container is always read
+        mmap : bool
+            if True the data are not loaded in memory: a memory-mapped array
+            is returned for .npy files and a h5py dataset for .hdf5 files;
+            the data are read when they are sliced
+    Outputs
+        data : array | memmap | h5py.Dataset
+            the time series
+    """
+
+    _, _, ext = split_f(filename)
+
+    if _is_container(filename):
+        return read_container(filename, mmap=mmap)['data']
+
+    if ext == '.hdf5':
+        if mmap:
+            # the file stays open as long as the dataset is referenced
+            return h5py.File(filename, 'r')[dataset_name]
+        return _read_hdf5(filename, dataset_name=dataset_name)
+
+    if mmap:
+        try:
+            return np.load(filename, mmap_mode='r')
+        except ValueError:
+            # arrays of python objects can not be memory-mapped
+            print('*** {} can not be memory-mapped ***'.format(filename))
+
+    return np.load(filename, allow_pickle=True)
+
+
+def _read_npz_array(filename, name, mmap=True):
+    """
+    Read an array of a .npz file
+
+    Inputs
+        filename : str
+            .npz filename
+        name : str
+            name of the array in the .npz file
+        mmap : bool
+            if True and the array is stored uncompressed (np.savez), a
+            memory-mapped array is returned, otherwise it is loaded
+    Outputs
+        data : array | memmap
+            the array
+    """
+
+    with zipfile.ZipFile(filename) as zf:
+        zinfo = zf.getinfo(name + '.npy')
+
+    if not mmap or zinfo.compress_type != zipfile.ZIP_STORED:
+        with np.load(filename) as npzfile:
+            return npzfile[name]
+
+    with open(filename, 'rb') as f:
+        # the .npy data start after the local header of the zip member,
+        # whose name and extra field lengths are its last 4 bytes
+        f.seek(zinfo.header_offset)
+        name_len, extra_len = struct.unpack('<HH', f.read(30)[26:])
+        f.seek(zinfo.header_offset + 30 + name_len + extra_len)
+
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                     order='F' if fortran_order else 'C', offset=offset)
+
+
+class _EpochsView(object):
+    """Lazy view of continuous time series split in epochs of equal length.
+
+    Indexing the view reads only the time points of the selected epochs,
+    from a memory-mapped array or a h5py dataset.
+
+    Inputs
+        data : array | memmap | h5py.Dataset, shape (n_nodes, n_times)
+            the continuous time series; a shape (1, n_nodes, n_times) is
+            also accepted
+        epoch_length : int
+            number of time points of each epoch; the last time points that
+            do not fill an epoch are dropped
+    """
+
+    def __init__(self, data, epoch_length):
+        if len(data.shape) == 3:
+            assert data.shape[0] == 1, ("Error, data should have only one "
+                                        "sample")
+            self._prefix = (0,)
+        else:
+            self._prefix = ()
+
+        self.data = data
+        self.epoch_length = epoch_length
+
+        n_nodes, n_times = data.shape[-2:]
+        self.shape = (n_times // epoch_length, n_nodes, epoch_length)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def _read(self, start, stop):
+        time_slice = slice(start * self.epoch_length, stop * self.epoch_length)
+        return np.asarray(self.data[self._prefix + (slice(None), time_slice)])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError('only contiguous epochs can be selected')
+            stop = max(start, stop)
+            data = self._read(start, stop)
+            return data.reshape(
+                self.shape[1], stop - start, self.epoch_length).swapaxes(0, 1)
+
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('epoch index out of range')
+        return self._read(idx, idx + 1)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+
 def import_mat_to_conmat(mat_file, data_field_name='F',
                          orig_channel_names_file=None,
                          orig_channel_coords_file=None):
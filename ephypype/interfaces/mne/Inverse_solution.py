@@ -9,7 +9,7 @@ import os.path as op
 from nipype.utils.filemanip import split_filename as split_f
 
 from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec
-from nipype.interfaces.base import traits, File, TraitedSpec
+from nipype.interfaces.base import traits, File, TraitedSpec, isdefined
 
 from ...compute_inv_problem import _compute_inverse_solution, compute_noise_cov
 from ...compute_inv_problem import _compute_LCMV_inverse_solution
@@ -60,6 +60,24 @@ class InverseSolutionConnInputSpec(BaseInterfaceInputSpec):
                                 mandatory=False)
     ROIs_mean = traits.Bool(True, desc='if true compute mean on ROIs',
                             usedefault=True, mandatory=False)
+    return_generator = traits.Bool(False, desc='if true the stcs of the \
+                                   epochs are computed one at a time and \
+                                   piped to the ROIs extraction',
+                                   usedefault=True, mandatory=False)
+    compression = traits.Enum(None, 'lzf', 'gzip', usedefault=True,
+                              desc='compression of the all_src_space .hdf5 \
+                              file', mandatory=False)
+    inv_cache_dir = traits.Directory(exists=True, desc='directory of the \
+                                     inverse operators cache (default: no \
+                                     cache)', mandatory=False)
+    use_kernel = traits.Bool(False, desc='if true the imaging kernel is \
+                             applied to the data (collapsed to the ROIs if \
+                             only ROIs_mean)', usedefault=True,
+                             mandatory=False)
+    save_container = traits.Bool(False, desc='if true the ROIs time series \
+                                 and the labels are saved in a single .hdf5 \
+                                 container', usedefault=True,
+                                 mandatory=False)
 
 
 class InverseSolutionConnOutputSpec(TraitedSpec):
@@ -123,6 +141,29 @@ class InverseSolution(BaseInterface):
             If True we compute the inverse for all points of the s0urce space
         ROIs_mean: bool
             If True we compute the mean of estimated time series on ROIs
+        return_generator: bool
+            If True the inverse solution of epoched data is computed one
+            epoch at a time and piped to the ROIs extraction and to the .hdf5
+            writer, so that only the ROIs time series of all epochs are kept
+            in memory
+        compression: str | None
+            Compression filter of the .hdf5 file written if all_src_space,
+            'lzf' or 'gzip'
+        inv_cache_dir: str
+            Directory where the inverse operators are cached, keyed by a hash
+            of the forward, the noise covariance, the channels/bads/projs of
+            the data and the loose/depth/fixed parameters; if not given the
+            inverse operator is not cached. The cached files are never
+            removed, the directory is managed by the user
+        use_kernel: bool
+            If True and the inverse solution is linear (fixed or normal
+            orientation), the imaging kernel is computed once and applied to
+            the raw/epoched data; if only ROIs_mean, the kernel is collapsed
+            to the ROIs and the source time series are never computed
+        save_container: bool
+            If True the ROIs time series, the label names, centroids, colors
+            and MNI coordinates are saved in a single .hdf5 container, which
+            is returned for ts_file and the labels files
 
     Returns
     -------
@@ -162,6 +203,14 @@ class InverseSolution(BaseInterface):
         aseg_labels = self.inputs.aseg_labels
         all_src_space = self.inputs.all_src_space
         ROIs_mean = self.inputs.ROIs_mean
+        return_generator = self.inputs.return_generator
+        compression = self.inputs.compression
+        if isdefined(self.inputs.inv_cache_dir):
+            inv_cache_dir = self.inputs.inv_cache_dir
+        else:
+            inv_cache_dir = None
+        use_kernel = self.inputs.use_kernel
+        save_container = self.inputs.save_container
 
         if inv_method != 'LCMV':
             self.ts_file, self.labels, self.label_names, \
@@ -177,7 +226,12 @@ class InverseSolution(BaseInterface):
                                           aseg=aseg, aseg_labels=aseg_labels,
                                           all_src_space=all_src_space,
                                           ROIs_mean=ROIs_mean,
-                                          is_fixed=is_fixed)
+                                          is_fixed=is_fixed,
+                                          return_generator=return_generator,
+                                          compression=compression,
+                                          inv_cache_dir=inv_cache_dir,
+                                          use_kernel=use_kernel,
+                                          container=save_container)
         else:
             self.ts_file, self.labels, self.label_names, \
                 self.label_coords = \
@@ -13,6 +13,7 @@ from ...compute_fwd_problem import _create_mixed_source_space
 from ...compute_fwd_problem import _create_bem_sol, _create_src_space
 from ...compute_fwd_problem import _compute_fwd_sol
 from ...compute_fwd_problem import _get_fwd_filename
+from ...aux_tools import _file_lock
 
 
 class LFComputationConnInputSpec(BaseInterfaceInputSpec):
@@ -32,6 +33,8 @@ class LFComputationConnInputSpec(BaseInterfaceInputSpec):
     save_mixed_src_space = traits.Bool(False, desc='if true save src space',
                                        usedefault=True,
                                        mandatory=False)
+    n_jobs = traits.Int(2, desc='number of jobs to run in parallel',
+                        usedefault=True, mandatory=False)
 
 
 class LFComputationConnOutputSpec(TraitedSpec):
@@ -60,6 +63,18 @@ class LFComputation(BaseInterface):
         list of substructures we want to include in the mixed source space
     save_mixed_src_space: bool (default False)
         if True save the mixed src space
+    n_jobs: int (default 2)
+        number of jobs used to set up the source spaces and to compute the
+        forward solution; the forward solution was always computed with 2
+        jobs, which is kept as default, while the source spaces were set up
+        with 1 job and now also use n_jobs
+
+    Notes
+    -----
+    The BEM and source space files of the subject are shared by all its
+    sessions: the first process creates them while holding an inter-process
+    lock, the other ones wait and read them. The forward solution file is
+    locked in the same way.
 
     Returns
     -------
@@ -81,31 +96,35 @@ class LFComputation(BaseInterface):
         spacing = self.inputs.spacing
         aseg_labels = self.inputs.aseg_labels
         save_mixed_src_space = self.inputs.save_mixed_src_space
+        n_jobs = self.inputs.n_jobs
 
         self.fwd_filename = _get_fwd_filename(raw_fname, aseg,
                                               spacing)
 
         # check if we have just created the fwd matrix
-        if not op.isfile(self.fwd_filename):
-            print('\n*** Computing FWD matrix {} ***\n'.format(
-                  self.fwd_filename))
-            bem = _create_bem_sol(subjects_dir, sbj_id)  # bem solution
-
-            src = _create_src_space(subjects_dir, sbj_id, spacing)  # src space
-
-            if aseg:
-                src = _create_mixed_source_space(subjects_dir, sbj_id, spacing,
-                                                 aseg_labels, src,
-                                                 save_mixed_src_space)
-
-            n = sum(src[i]['nuse'] for i in range(len(src)))
-            print('src space contains {} spaces and {} vertices'.format(
-                len(src), n))
-
-            _compute_fwd_sol(raw_fname, trans_file, src, bem,
-                             self.fwd_filename)
-        else:
-            print(('\n*** FWD file {} exists!!!\n'.format(self.fwd_filename)))
+        with _file_lock(self.fwd_filename):
+            if not op.isfile(self.fwd_filename):
+                print('\n*** Computing FWD matrix {} ***\n'.format(
+                      self.fwd_filename))
+                bem = _create_bem_sol(subjects_dir, sbj_id)  # bem solution
+
+                src = _create_src_space(subjects_dir, sbj_id, spacing,
+                                        n_jobs=n_jobs)  # src space
+
+                if aseg:
+                    src = _create_mixed_source_space(
+                        subjects_dir, sbj_id, spacing, aseg_labels, src,
+                        save_mixed_src_space, n_jobs=n_jobs)
+
+                n = sum(src[i]['nuse'] for i in range(len(src)))
+                print('src space contains {} spaces and {} vertices'.format(
+                    len(src), n))
+
+                _compute_fwd_sol(raw_fname, trans_file, src, bem,
+                                 self.fwd_filename, n_jobs=n_jobs)
+            else:
+                print(('\n*** FWD file {} exists!!!\n'.format(
+                    self.fwd_filename)))
 
         return runtime
 
@@ -6,9 +6,14 @@
 # License: BSD (3-clause)
 
 
+import os
+
+from mne import read_labels_from_annot
 from nipype.interfaces.base import BaseInterface, \
-    BaseInterfaceInputSpec, traits, File, TraitedSpec
-from ...power import _compute_and_save_psd, _compute_and_save_src_psd
+    BaseInterfaceInputSpec, traits, File, TraitedSpec, isdefined
+from nipype.utils.filemanip import split_filename
+from ...power import (_compute_and_save_psd, _compute_and_save_src_psd,
+                      _compute_and_save_src_kernel_psd, _plot_psd_file)
 
 
 class PowerInputSpec(BaseInterfaceInputSpec):
@@ -44,13 +49,33 @@ class PowerInputSpec(BaseInterfaceInputSpec):
                                   mandatory=False)
     snr = traits.Float(3.0, usedefault=True, desc='use smaller SNR for \
                        raw data', mandatory=False)
+    chunk_duration = traits.Float(60., usedefault=True,
+                                  desc='duration in seconds of the chunks '
+                                  'of sensor data read at a time')
+    save_container = traits.Bool(False, usedefault=True,
+                                 desc='if true the psd is saved in a .hdf5 '
+                                 'container instead of a .npz file')
+    save_img = traits.Bool(False, usedefault=True,
+                           desc='if true the image of the psd is saved; '
+                           'it can also be saved later by PlotPsd')
+    src_psd_mode = traits.Enum('compute_source_psd', 'labels', 'vertices',
+                               usedefault=True,
+                               desc='how the source space psd is computed')
+    sbj_id = traits.String(desc='subject id, if src_psd_mode is labels')
+    subjects_dir = traits.Directory(exists=True,
+                                    desc='freesurfer subjects directory, if '
+                                    'src_psd_mode is labels')
+    parc = traits.String('aparc', usedefault=True,
+                         desc='parcellation defining the labels')
 
 
 class PowerOutputSpec(TraitedSpec):
     """Power output spec."""
 
     psds_file = File(exists=True,
-                     desc='psd tensor and frequencies in .npz format')
+                     desc='psd tensor and frequencies in .npz format or in '
+                     'a .hdf5 container')
+    psds_img_file = File(exists=True, desc='image of the psd in .png format')
 
 
 class Power(BaseInterface):
@@ -77,11 +102,35 @@ class Power(BaseInterface):
             If true input data are mne.Epochs
         is_sensor_space : bool
             True for PSD on sensor space, False for PSD on source
+        chunk_duration : float
+            Duration in seconds of the chunks of sensor data read at a time
+        save_container : bool
+            If True the psd, the frequencies, the channel names and
+            coordinates are saved in a single .hdf5 container (see
+            write_container) instead of .npz and .txt files
+        save_img : bool
+            If True the image of the psd is saved; by default it is not, it
+            can be saved afterwards by PlotPsd
+        src_psd_mode : str
+            How the source space psd is computed: 'compute_source_psd' uses
+            mne compute_source_psd on the whole raw data; 'labels' applies
+            the imaging kernel collapsed to the labels of parc to the data
+            read by chunks, so that the psd is computed on n_labels signals;
+            'vertices' applies the imaging kernel of all the sources
+        sbj_id : str
+            Subject id, if src_psd_mode is 'labels'
+        subjects_dir : str
+            Freesurfer subjects directory, if src_psd_mode is 'labels'
+        parc : str
+            The parcellation defining the labels
 
     Outputs
     -------
         psds_file : str
-            Name of the .npz file containing psd tensor and frequencies
+            Name of the .npz file (or .hdf5 container) containing psd tensor
+            and frequencies
+        psds_img_file : str
+            Name of the .png file with the image of the psd, if save_img
     """
 
     input_spec = PowerInputSpec
@@ -101,18 +150,98 @@ class Power(BaseInterface):
         is_epoched = self.inputs.is_epoched
         is_sensor_space = self.inputs.is_sensor_space
         if is_sensor_space:
-            self.psds_file = _compute_and_save_psd(data_file, fmin, fmax,
-                                                   method, is_epoched)
+            self.psds_file = _compute_and_save_psd(
+                data_file, fmin, fmax, method, is_epoched, n_fft=nfft,
+                n_overlap=int(overlap),
+                chunk_duration=self.inputs.chunk_duration,
+                container=self.inputs.save_container,
+                save_img=self.inputs.save_img)
+        elif self.inputs.src_psd_mode != 'compute_source_psd':
+            if self.inputs.src_psd_mode == 'labels':
+                labels = read_labels_from_annot(
+                    self.inputs.sbj_id, parc=self.inputs.parc,
+                    subjects_dir=self.inputs.subjects_dir)
+            else:
+                labels = None
+
+            self.psds_file = _compute_and_save_src_kernel_psd(
+                data_file, inv_file, fmin, fmax,
+                method=method if isdefined(method) else 'welch',
+                is_epoched=is_epoched, inv_method=inv_method, snr=snr,
+                n_fft=nfft, n_overlap=int(overlap), labels=labels,
+                sbj_id=self.inputs.sbj_id, parc=self.inputs.parc,
+                chunk_duration=self.inputs.chunk_duration,
+                container=self.inputs.save_container,
+                save_img=self.inputs.save_img)
         else:
-            self.psds_file = _compute_and_save_src_psd(data_file, sfreq, inv_file,
-                                                       fmin=fmin, fmax=fmax,
-                                                       n_fft=nfft, snr=snr,
-                                                       n_overlap=overlap,
-                                                       is_epoched=is_epoched,
-                                                       inv_method=inv_method)
+            self.psds_file = _compute_and_save_src_psd(
+                data_file, sfreq, inv_file, fmin=fmin, fmax=fmax, n_fft=nfft,
+                snr=snr, n_overlap=overlap, is_epoched=is_epoched,
+                inv_method=inv_method,
+                container=self.inputs.save_container,
+                save_img=self.inputs.save_img)
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['psds_file'] = self.psds_file
+        if self.inputs.save_img:
+            _, basename, _ = split_filename(self.inputs.data_file)
+            outputs['psds_img_file'] = os.path.abspath(basename + '-psds.png')
+        return outputs
+
+
+class PlotPsdInputSpec(BaseInterfaceInputSpec):
+    """PlotPsd input spec."""
+
+    psds_file = File(exists=True,
+                     desc='psd tensor and frequencies in .npz format or in '
+                     'a .hdf5 container', mandatory=True)
+    is_epoched = traits.Bool(False, usedefault=True,
+                             desc='if true the psds are computed on epochs')
+    method = traits.String('', usedefault=True,
+                           desc='psd computation method shown in the title')
+
+
+class PlotPsdOutputSpec(TraitedSpec):
+    """PlotPsd output spec."""
+
+    psds_img_file = File(exists=True, desc='image of the psd in .png format')
+
+
+class PlotPsd(BaseInterface):
+    """Save the image of the power spectral density computed by Power.
+
+    The mean and the standard deviation over channels of the psd in dB are
+    plotted; this node can be run after the fact on the psds files of a
+    batch run computed with save_img=False.
+
+    Inputs
+    ------
+        psds_file : str
+            Name of the .npz file (or .hdf5 container) containing psd tensor
+            and frequencies
+        is_epoched : bool
+            If true the psds are computed on epochs
+        method : str
+            Power spectral density computation method shown in the title
+
+    Outputs
+    -------
+        psds_img_file : str
+            Name of the .png file with the image of the psd
+    """
+
+    input_spec = PlotPsdInputSpec
+    output_spec = PlotPsdOutputSpec
+
+    def _run_interface(self, runtime):
+        self.psds_img_file = _plot_psd_file(self.inputs.psds_file,
+                                            self.inputs.is_epoched,
+                                            self.inputs.method)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['psds_img_file'] = self.psds_img_file
         return outputs
@@ -6,11 +6,22 @@
 
 
 from nipype.interfaces.base import BaseInterface,\
-    BaseInterfaceInputSpec, traits, TraitedSpec
+    BaseInterfaceInputSpec, traits, TraitedSpec, isdefined
 
 from ...preproc import _compute_ica,\
     _preprocess_fif,\
-    _create_epochs, _define_epochs, _compute_evoked
+    _create_epochs, _define_epochs, _compute_evoked, \
+    _preprocess_ica_fif_to_ts, _generate_ica_report
+
+
+def _get_ica_fit_params(interface):
+    """Get the ICA fit parameters of the interface inputs."""
+    fit_params = dict(n_jobs=interface.inputs.n_jobs)
+    for name in ['decim', 'fit_tmax', 'fit_annotations']:
+        value = getattr(interface.inputs, name)
+        fit_params[name] = value if isdefined(value) else None
+
+    return fit_params
 
 
 class CompIcaInputSpec(BaseInterfaceInputSpec):
@@ -28,6 +39,23 @@ class CompIcaInputSpec(BaseInterfaceInputSpec):
     n_components = traits.Int(desc='number of ica components')
     variance = traits.Float(desc='number of ica components')
     reject = traits.Dict(desc='rejection parameters', mandatory=False)
+    method = traits.Enum('fastica', 'picard', 'infomax', 'extended-infomax',
+                         usedefault=True, desc='ICA method')
+    decim = traits.Int(desc='ICA is fitted on one sample every decim '
+                       'samples')
+    fit_tmax = traits.Float(desc='ICA is fitted on the first fit_tmax '
+                            'seconds of the data')
+    fit_annotations = traits.List(traits.String,
+                                  desc='ICA is fitted on the segments with '
+                                  'these annotation descriptions')
+    n_jobs = traits.Int(1, usedefault=True,
+                        desc='number of jobs to filter the data')
+    make_report = traits.Bool(True, usedefault=True,
+                              desc='if False, the report is not generated '
+                              'and can be generated later by IcaReport')
+    fast_report = traits.Bool(False, usedefault=True,
+                              desc='if True, the report shows decimated '
+                              'time series of the first 30 s')
 
 
 class CompIcaOutputSpec(TraitedSpec):
@@ -47,6 +75,11 @@ class CompIcaOutputSpec(TraitedSpec):
     report_file = traits.File(exists=True,
                               desc='ica report in .html',
                               mandatory=True)
+    ica_scores_file = traits.File(exists=True,
+                                  desc='ECG/EOG scores of ica components '
+                                  'in .npz')
+    ica_evoked_file = traits.File(exists=True,
+                                  desc='ECG/EOG evoked in -ave.fif')
 
 
 class CompIca(BaseInterface):
@@ -66,6 +99,21 @@ class CompIca(BaseInterface):
         Number of ica components
     reject : dict
         Rejection parameters
+    method : str
+        ICA method ('fastica', 'picard', 'infomax' or 'extended-infomax')
+    decim : int
+        ICA is fitted on one sample every decim samples
+    fit_tmax : float
+        ICA is fitted on the first fit_tmax seconds of the data
+    fit_annotations : list of str
+        ICA is fitted on the segments with these annotation descriptions
+    n_jobs : int
+        Number of jobs to filter the data
+    make_report : bool
+        If False, the report is not generated and can be generated later
+        by IcaReport
+    fast_report : bool
+        If True, the report shows decimated time series of the first 30 s
 
     Outputs
     -------
@@ -76,7 +124,11 @@ class CompIca(BaseInterface):
     ica_ts_file : str
         Name of .fif file with ica components
     report_file : str
-        Name of html file with ica report
+        Name of html file with ica report, if make_report
+    ica_scores_file : str
+        Name of .npz file with the ECG/EOG scores of ica components
+    ica_evoked_file : str
+        Name of -ave.fif file with the ECG/EOG evoked
     """
 
     input_spec = CompIcaInputSpec
@@ -98,11 +150,16 @@ class CompIca(BaseInterface):
         n_components = variance if variance else n_components
         ica_output = _compute_ica(
             fif_file, raw_fif_file, data_type, ecg_ch_name,
-            eog_ch_name, n_components, reject)
+            eog_ch_name, n_components, reject, method=self.inputs.method,
+            make_report=self.inputs.make_report,
+            fast_report=self.inputs.fast_report,
+            **_get_ica_fit_params(self))
         self.ica_file = ica_output[0]
         self.ica_sol_file = ica_output[1]
         self.ica_ts_file = ica_output[2]
         self.report_file = ica_output[3]
+        self.ica_scores_file = ica_output[4]
+        self.ica_evoked_file = ica_output[5]
 
         return runtime
 
@@ -111,6 +168,87 @@ class CompIca(BaseInterface):
         outputs['ica_file'] = self.ica_file
         outputs['ica_sol_file'] = self.ica_sol_file
         outputs['ica_ts_file'] = self.ica_ts_file
+        if self.report_file:
+            outputs['report_file'] = self.report_file
+        outputs['ica_scores_file'] = self.ica_scores_file
+        if self.ica_evoked_file:
+            outputs['ica_evoked_file'] = self.ica_evoked_file
+        return outputs
+
+
+class IcaReportInputSpec(BaseInterfaceInputSpec):
+    """Input specification for IcaReport."""
+
+    ica_sol_file = traits.File(exists=True,
+                               desc='file with ica solution in .fif',
+                               mandatory=True)
+    ica_ts_file = traits.File(exists=True,
+                              desc='file with ica components in .fif',
+                              mandatory=True)
+    ica_scores_file = traits.File(exists=True,
+                                  desc='ECG/EOG scores of ica components '
+                                  'in .npz')
+    ica_evoked_file = traits.File(exists=True,
+                                  desc='ECG/EOG evoked in -ave.fif')
+    fast = traits.Bool(True, usedefault=True,
+                       desc='if True, plot decimated time series of a '
+                       'bounded time span')
+    tmax = traits.Float(desc='end of the time span of the time series in '
+                        'seconds (30 s if fast, else the whole data)')
+
+
+class IcaReportOutputSpec(TraitedSpec):
+    """Output specification for IcaReport."""
+
+    report_file = traits.File(exists=True,
+                              desc='ica report in .html')
+
+
+class IcaReport(BaseInterface):
+    """Generate the report of an ICA solution computed by CompIca.
+
+    Inputs
+    ------
+    ica_sol_file : str
+        Name of .fif file with ica solution
+    ica_ts_file : str
+        Name of .fif file with ica components
+    ica_scores_file : str
+        Name of .npz file with the ECG/EOG scores of ica components
+    ica_evoked_file : str
+        Name of -ave.fif file with the ECG/EOG evoked
+    fast : bool
+        If True, the time series are decimated thumbnails of a bounded time
+        span and the topographies have a lower resolution
+    tmax : float
+        End of the time span of the time series in seconds
+
+    Outputs
+    -------
+    report_file : str
+        Name of html file with ica report
+    """
+
+    input_spec = IcaReportInputSpec
+    output_spec = IcaReportOutputSpec
+
+    def _run_interface(self, runtime):
+        ica_scores_file = self.inputs.ica_scores_file
+        ica_evoked_file = self.inputs.ica_evoked_file
+        tmax = self.inputs.tmax
+
+        self.report_file = _generate_ica_report(
+            self.inputs.ica_sol_file, self.inputs.ica_ts_file,
+            ica_scores_file=ica_scores_file if isdefined(ica_scores_file)
+            else None,
+            ica_evoked_file=ica_evoked_file if isdefined(ica_evoked_file)
+            else None,
+            fast=self.inputs.fast, tmax=tmax if isdefined(tmax) else None)
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
         outputs['report_file'] = self.report_file
         return outputs
 
@@ -212,6 +350,227 @@ class PreprocFif(BaseInterface):
         return outputs
 
 
+class PreprocIcaFifInputSpec(BaseInterfaceInputSpec):
+    """Input specification for PreprocIcaFif."""
+
+    fif_file = traits.File(exists=True,
+                           desc='raw meg data in fif format',
+                           mandatory=True)
+    l_freq = traits.Float(desc='lower bound for filtering')
+    h_freq = traits.Float(
+        None, desc='upper bound for filtering', mandatory=False)
+    down_sfreq = traits.Int(None, desc='downsampling frequency',
+                            mandatory=False)
+    data_type = traits.String('fif', desc='data type', usedefault=True)
+    montage = traits.String(desc='EEG layout')
+    misc = traits.List(desc='EEG misc channels')
+    bipolar = traits.Dict(desc='set EEG bipolar channels')
+    ch_new_names = traits.Dict(desc='new channel name')
+    ecg_ch_name = traits.String('', desc='name of ecg channel',
+                                usedefault=True)
+    eog_ch_name = traits.List(desc='name of eog channel')
+    n_components = traits.Int(desc='number of ica components')
+    variance = traits.Float(desc='number of ica components')
+    reject = traits.Dict(desc='rejection parameters', mandatory=False)
+    save_fif = traits.Bool(False, usedefault=True,
+                           desc='if True, save the cleaned raw data in '
+                           '.fif format')
+    save_ica_ts = traits.Bool(False, usedefault=True,
+                              desc='if True, save the ica components in '
+                              '.fif format')
+    method = traits.Enum('fastica', 'picard', 'infomax', 'extended-infomax',
+                         usedefault=True, desc='ICA method')
+    decim = traits.Int(desc='ICA is fitted on one sample every decim '
+                       'samples')
+    fit_tmax = traits.Float(desc='ICA is fitted on the first fit_tmax '
+                            'seconds of the data')
+    fit_annotations = traits.List(traits.String,
+                                  desc='ICA is fitted on the segments with '
+                                  'these annotation descriptions')
+    n_jobs = traits.Int(1, usedefault=True,
+                        desc='number of jobs to filter the data')
+    make_report = traits.Bool(True, usedefault=True,
+                              desc='if False, the report is not generated '
+                              'and can be generated later by IcaReport')
+    fast_report = traits.Bool(False, usedefault=True,
+                              desc='if True, the report shows decimated '
+                              'time series of the first 30 s')
+
+
+class PreprocIcaFifOutputSpec(TraitedSpec):
+    """Output specification for PreprocIcaFif."""
+
+    array_file = traits.File(exists=True,
+                             desc='cleaned time series in .npy format')
+    channel_coords_file = traits.File(
+        exists=True, desc='channels coordinates in .txt format')
+    channel_names_file = traits.File(
+        exists=True, desc='channels labels in .txt format')
+    sfreq = traits.Float(desc='sampling frequency')
+    ica_file = traits.File(exists=True,
+                           desc='file with cleaned raw file in .fif')
+    ica_sol_file = traits.File(exists=True,
+                               desc='file with ica solution in .fif')
+    ica_ts_file = traits.File(exists=True,
+                              desc='file with ica components in .fif')
+    report_file = traits.File(exists=True,
+                              desc='ica report in .html')
+    ica_scores_file = traits.File(exists=True,
+                                  desc='ECG/EOG scores of ica components '
+                                  'in .npz')
+    ica_evoked_file = traits.File(exists=True,
+                                  desc='ECG/EOG evoked in -ave.fif')
+
+
+class PreprocIcaFif(BaseInterface):
+    """Preprocess, clean with ICA and convert raw data to array in one node.
+
+    Same as PreprocFif, CompIca and Fif2Array in a row, but the raw data are
+    read once and kept in memory along the steps.
+
+    Inputs
+    ------
+    fif_file : str
+        Filename of raw meg data in fif format
+    l_freq : float
+        Lower bound for filtering
+    h_freq : float
+        Upper bound for filtering
+    down_sfreq : int
+        Downsampling frequency
+    data_type : str
+        Data type (.fif, .set)
+    montage : str
+        EEG montage
+    misc : str
+        miscellaneous channles
+    bipolar : dict
+        EEG bipolar channels
+    ch_new_names : dict
+        rename channels
+    ecg_ch_name : str
+        Name of ecg channel
+    eog_ch_name : str
+        Name of eog channel
+    variance : float
+        Number of ica components
+    n_components : float
+        Number of ica components
+    reject : dict
+        Rejection parameters
+    method : str
+        ICA method ('fastica', 'picard', 'infomax' or 'extended-infomax')
+    decim : int
+        ICA is fitted on one sample every decim samples
+    fit_tmax : float
+        ICA is fitted on the first fit_tmax seconds of the data
+    fit_annotations : list of str
+        ICA is fitted on the segments with these annotation descriptions
+    n_jobs : int
+        Number of jobs to filter the data
+    make_report : bool
+        If False, the report is not generated and can be generated later
+        by IcaReport
+    fast_report : bool
+        If True, the report shows decimated time series of the first 30 s
+    save_fif : bool
+        If True, the cleaned raw data are also saved in .fif format
+    save_ica_ts : bool
+        If True, the ica components are saved in .fif format
+
+    Outputs
+    -------
+    array_file : str
+        Name of the .npy file with cleaned data time series
+    channel_coords_file : str
+        Name of the .txt file with channels coordinates
+    channel_names_file : str
+        Name of the .txt file with channels names
+    sfreq : float
+        Sampling frequency
+    ica_file : str
+        Name of .fif file with cleaned raw data, if save_fif
+    ica_sol_file : str
+        Name of .fif file with ica solution
+    ica_ts_file : str
+        Name of .fif file with ica components, if save_ica_ts
+    report_file : str
+        Name of html file with ica report, if make_report
+    ica_scores_file : str
+        Name of .npz file with the ECG/EOG scores of ica components
+    ica_evoked_file : str
+        Name of -ave.fif file with the ECG/EOG evoked
+    """
+
+    input_spec = PreprocIcaFifInputSpec
+    output_spec = PreprocIcaFifOutputSpec
+
+    def _run_interface(self, runtime):
+        fif_file = self.inputs.fif_file
+        l_freq = self.inputs.l_freq
+        h_freq = self.inputs.h_freq
+        down_sfreq = self.inputs.down_sfreq
+        data_type = self.inputs.data_type
+        ecg_ch_name = self.inputs.ecg_ch_name
+        eog_ch_name = self.inputs.eog_ch_name
+        n_components = self.inputs.n_components
+        variance = self.inputs.variance
+        reject = self.inputs.reject
+
+        if data_type == 'eeg':
+            montage = self.inputs.montage
+            misc = self.inputs.misc
+            bipolar = self.inputs.bipolar
+            ch_new_names = self.inputs.ch_new_names
+        else:
+            montage, misc, bipolar, ch_new_names = None, None, None, None
+
+        if not isdefined(eog_ch_name):
+            eog_ch_name = []
+        if not isdefined(reject):
+            reject = dict(mag=4e-12, grad=4000e-13)
+
+        n_components = variance if variance else n_components
+        output = _preprocess_ica_fif_to_ts(
+            fif_file, data_type, l_freq=l_freq, h_freq=h_freq,
+            down_sfreq=down_sfreq, ecg_ch_name=ecg_ch_name,
+            eog_ch_name=eog_ch_name, n_components=n_components,
+            reject=reject, montage=montage, misc=misc,
+            ch_new_names=ch_new_names, bipolar=bipolar,
+            save_fif=self.inputs.save_fif,
+            save_ica_ts=self.inputs.save_ica_ts,
+            method=self.inputs.method,
+            make_report=self.inputs.make_report,
+            fast_report=self.inputs.fast_report,
+            **_get_ica_fit_params(self))
+
+        self.array_file, self.channel_coords_file, \
+            self.channel_names_file, self.sfreq = output[:4]
+        self.ica_sol_file, self.ica_ts_file, self.report_file, \
+            self.ica_file, self.ica_scores_file, \
+            self.ica_evoked_file = output[4:]
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['array_file'] = self.array_file
+        outputs['channel_coords_file'] = self.channel_coords_file
+        outputs['channel_names_file'] = self.channel_names_file
+        outputs['sfreq'] = self.sfreq
+        outputs['ica_sol_file'] = self.ica_sol_file
+        outputs['ica_scores_file'] = self.ica_scores_file
+        if self.report_file:
+            outputs['report_file'] = self.report_file
+        if self.ica_evoked_file:
+            outputs['ica_evoked_file'] = self.ica_evoked_file
+        if self.ica_file:
+            outputs['ica_file'] = self.ica_file
+        if self.ica_ts_file:
+            outputs['ica_ts_file'] = self.ica_ts_file
+        return outputs
+
+
 class CreateEpInputSpec(BaseInterfaceInputSpec):
     """Input specification for CreateEp."""
 
@@ -219,14 +578,23 @@ class CreateEpInputSpec(BaseInterfaceInputSpec):
                            desc='raw meg data in fif format',
                            mandatory=True)
     ep_length = traits.Float(desc='epoch length in seconds')
+    overlap = traits.Float(0., usedefault=True,
+                           desc='overlap between epochs in seconds')
+    lazy = traits.Bool(False, usedefault=True,
+                       desc='if True, epochs are written in a -epo.npy '
+                       'file by chunks instead of being preloaded')
+    chunk_size = traits.Int(100, usedefault=True,
+                            desc='number of epochs written at a time if '
+                            'lazy')
 
 
 class CreateEpOutputSpec(TraitedSpec):
     """Output specification for CreateEp."""
 
     epo_fif_file = traits.File(exists=True,
-                               desc='-epo.fif file',
-                               mandatory=True)
+                               desc='-epo.fif file if not lazy')
+    epo_ts_file = traits.File(exists=True,
+                              desc='-epo.npy file if lazy')
 
 
 class CreateEp(BaseInterface):
@@ -238,11 +606,21 @@ class CreateEp(BaseInterface):
         Filename of raw meg data in fif format
     ep_length : str
         Epoch length in seconds
+    overlap : float
+        Overlap between epochs in seconds
+    lazy : bool
+        If True, the epochs are written in a .npy file by chunks
+    chunk_size : int
+        Number of epochs written at a time if lazy
 
     Outputs
     -------
     epo_fif_file : str
-        Name of .fif file with epoched data
+        Name of .fif file with epoched data, if not lazy
+    epo_ts_file : str
+        Name of .npy file with epoched data, of shape
+        (n_epochs, n_channels, n_times), if lazy; the lazy mode only
+        produces this file
     """
 
     input_spec = CreateEpInputSpec
@@ -251,15 +629,25 @@ class CreateEp(BaseInterface):
     def _run_interface(self, runtime):
         fif_file = self.inputs.fif_file
         ep_length = self.inputs.ep_length
+        overlap = self.inputs.overlap
+        lazy = self.inputs.lazy
+        chunk_size = self.inputs.chunk_size
 
-        result_fif = _create_epochs(fif_file, ep_length)
+        result_file = _create_epochs(fif_file, ep_length, overlap=overlap,
+                                     lazy=lazy, chunk_size=chunk_size)
 
-        self.epo_fif_file = result_fif
+        if lazy:
+            self.epo_ts_file = result_file
+        else:
+            self.epo_fif_file = result_file
         return runtime
 
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['epo_fif_file'] = self.epo_fif_file
+        if self.inputs.lazy:
+            outputs['epo_ts_file'] = self.epo_ts_file
+        else:
+            outputs['epo_fif_file'] = self.epo_fif_file
         return outputs
 
 
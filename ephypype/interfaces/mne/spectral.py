@@ -5,7 +5,6 @@
 # License: BSD (3-clause)
 
 
-import pickle
 import numpy as np
 
 from nipype.interfaces.base import BaseInterface, \
@@ -15,8 +14,11 @@ from nipype.utils.filemanip import split_filename as split_f
 
 from ...spectral import (_compute_and_save_spectral_connectivity,
                          _compute_and_save_multi_spectral_connectivity,
-                         _plot_circular_connectivity, _compute_tfr_morlet)
-from ...import_data import _read_hdf5
+                         _plot_circular_connectivity, _compute_tfr_morlet,
+                         _get_conmat_file)
+from ...import_data import (_read_ts, _EpochsView, _is_container,
+                            _read_ch_names, read_container)
+from ...source_space import _read_labels_file
 
 
 # -------------------------- SpectralConn -------------------------- #
@@ -55,6 +57,18 @@ class SpectralConnInputSpec(BaseInterfaceInputSpec):
     gathering_method = traits.Enum("mean", "max", "none",
                                    desc='gathering_method', usedefault=True)
 
+    save_stack = traits.Bool(
+        False, desc='If multiple connectivity matrices are also exported \
+        stacked in one .npy file', usedefault=True)
+
+    mmap = traits.Bool(
+        True, desc='If True the time series are memory-mapped (.npy) or read \
+        by chunks (.hdf5) instead of being loaded in memory', usedefault=True)
+
+    save_container = traits.Bool(
+        False, desc='If True the connectivity matrices are saved in .hdf5 \
+        containers instead of .npy files', usedefault=True)
+
 
 class SpectralConnOutputSpec(TraitedSpec):
     """Output specification."""
@@ -66,6 +80,10 @@ class SpectralConnOutputSpec(TraitedSpec):
         File(exists=False),
         desc="all spectral connectivty matrices in .npy format")
 
+    conmat_stack_file = File(
+        exists=False,
+        desc="all spectral connectivty matrices stacked in one .npy file")
+
 
 class SpectralConn(BaseInterface):
     """Compute spectral connectivity in a given frequency bands.
@@ -91,11 +109,28 @@ class SpectralConn(BaseInterface):
         What to add to the name of the file
     multi_con : bool
         If True multiple connectivity matrices are exported
+    save_stack : bool
+        If True and multi_con, the connectivity matrices are also exported
+        stacked in one .npy file
+    mmap : bool
+        If True (default) the time series are memory-mapped (.npy) or read
+        by chunks (.hdf5), and the epochs are views on them, so that only
+        the samples being processed are loaded in memory
+    save_container : bool
+        If True the connectivity matrices are saved in self-describing .hdf5
+        containers (see write_container) with the frequency band, the
+        method and the sampling frequency as attributes
 
     Outputs
     -------
     conmat_file : str
         Name of .npy file with spectral connectivty matrix
+    conmat_files : list of str
+        If multi_con, names of .npy files with the connectivity matrix of
+        each sample
+    conmat_stack_file : str
+        If save_stack, name of .npy file with all connectivity matrices
+        stacked in an array of shape (n_samples, n_nodes, n_nodes)
     """
 
     input_spec = SpectralConnInputSpec
@@ -105,6 +140,7 @@ class SpectralConn(BaseInterface):
         BaseInterface.__init__(self)
         self.conmat_files = []
         self.conmat_file = []
+        self.conmat_stack_file = []
 
     def _run_interface(self, runtime):
 
@@ -118,43 +154,30 @@ class SpectralConn(BaseInterface):
         index = self.inputs.index
         mode = self.inputs.mode
         multi_con = self.inputs.multi_con
+        save_stack = self.inputs.save_stack
+        save_container = self.inputs.save_container
 
         print(mode)
-        _, _, ext = split_f(self.inputs.ts_file)
+
+        ts = _read_ts(self.inputs.ts_file, dataset_name='stc_data',
+                      mmap=self.inputs.mmap)
 
         if epoch_window_length == traits.Undefined:
             print('*** NO epoch_window_length ***')
 
-            if ext == '.hdf5':
-                data = _read_hdf5(self.inputs.ts_file, dataset_name='stc_data')
-            else:
-                data = np.load(self.inputs.ts_file, allow_pickle=True)
+            data = ts
         else:
-            if ext == '.hdf5':
-                raw_data = \
-                    _read_hdf5(self.inputs.ts_file, dataset_name='stc_data')
-            else:
-                raw_data = np.load(self.inputs.ts_file, allow_pickle=True)
-
-            print(raw_data.shape)
+            print(ts.shape)
             print(int(epoch_window_length * sfreq))
 
-            if len(raw_data.shape) == 3:
-                if raw_data.shape[0] == 1:
-                    raw_data = raw_data[0, :, :]
-
-            print(raw_data.shape)
-
-            nb_splits = raw_data.shape[1] // (epoch_window_length * sfreq)
-            reste = raw_data.shape[1] % int(epoch_window_length * sfreq)
-
-            if reste != 0:
-                raw_data = raw_data[:, :-reste]
+            # epochs are views on the time series, they are read only when
+            # the connectivity is computed
+            data = _EpochsView(ts, int(epoch_window_length * sfreq))
+            reste = ts.shape[-1] % data.epoch_length
 
             print(("epoching data with {}s by window," +
                    "resulting in {} epochs (rest = {})").format(
-                       epoch_window_length, nb_splits, reste))
-            data = np.array(np.array_split(raw_data, nb_splits, axis=1))
+                       epoch_window_length, len(data), reste))
 
             print(data.shape)
 
@@ -162,13 +185,20 @@ class SpectralConn(BaseInterface):
             self.conmat_files = _compute_and_save_multi_spectral_connectivity(
                 all_data=data, con_method=con_method, sfreq=sfreq,
                 fmin=freq_band[0], fmax=freq_band[1],
-                export_to_matlab=export_to_matlab, mode=mode)
+                export_to_matlab=export_to_matlab, mode=mode,
+                save_stack=save_stack, container=save_container)
+            if save_stack:
+                self.conmat_stack_file = _get_conmat_file(
+                    "conmat_stack_{}.{}".format(
+                        con_method, 'hdf5' if save_container else 'npy'))
 
         else:
             self.conmat_file = _compute_and_save_spectral_connectivity(
-                data=data, con_method=con_method, index=index, sfreq=sfreq,
+                data=np.asarray(data), con_method=con_method, index=index,
+                sfreq=sfreq,
                 fmin=freq_band[0], fmax=freq_band[1],
-                export_to_matlab=export_to_matlab, mode=mode)
+                export_to_matlab=export_to_matlab, mode=mode,
+                container=save_container)
 
         return runtime
 
@@ -178,6 +208,8 @@ class SpectralConn(BaseInterface):
 
         if self.inputs.multi_con:
             outputs["conmat_files"] = self.conmat_files
+            if self.inputs.save_stack:
+                outputs["conmat_stack_file"] = self.conmat_stack_file
 
         else:
             outputs["conmat_file"] = self.conmat_file
@@ -220,7 +252,7 @@ class PlotSpectralConn(BaseInterface):
     Inputs
     ------
     conmat_file : str
-        Name of .npy file with connectivity matrix
+        Name of .npy file (or .hdf5 container) with connectivity matrix
     is_sensor_space : bool
         If True uses labels as returned from mne
     vmin : float
@@ -230,7 +262,9 @@ class PlotSpectralConn(BaseInterface):
     nb_lines : int
         Nb lines kept in the representation
     labels_file : str
-        List of labels associated with nodes
+        List of labels associated with nodes (.txt file, pickle or .hdf5
+        container); if not defined, the names of the nodes stored in the
+        conmat container are used
 
     Outputs
     -------
@@ -253,7 +287,12 @@ class PlotSpectralConn(BaseInterface):
         _, fname, _ = split_f(self.inputs.conmat_file)
         print(fname)
 
-        conmat = np.load(self.inputs.conmat_file, allow_pickle=True)
+        conmat_names = None
+        if _is_container(self.inputs.conmat_file):
+            container = read_container(self.inputs.conmat_file, mmap=False)
+            conmat, conmat_names = container['data'], container['ch_names']
+        else:
+            conmat = np.load(self.inputs.conmat_file, allow_pickle=True)
         print(conmat.shape)
 
         assert conmat.ndim == 2, \
@@ -264,19 +303,18 @@ class PlotSpectralConn(BaseInterface):
             "Warning, conmat should be a squared matrix, {} != {}".format(
                 conmat.shape[0], conmat.shape[1])
 
-        if isdefined(self.inputs.labels_file):
+        labels_file = self.inputs.labels_file
+        if isdefined(labels_file):
 
             if self.inputs.is_sensor_space:
-                label_names = [line.strip() for line in
-                               open(self.inputs.labels_file)]
+                label_names = _read_ch_names(labels_file)
 
                 node_order = label_names
                 node_colors = None
                 print(label_names)
 
             else:
-                with open(self.inputs.labels_file, 'rb') as f:
-                    roi = pickle.load(f)
+                roi = _read_labels_file(labels_file)
 
                 label_coords = roi['ROI_coords']
                 node_colors = roi['ROI_colors']
@@ -325,6 +363,10 @@ class PlotSpectralConn(BaseInterface):
                 print(lh_labels)
                 print(rh_labels)
                 print('\n ********************** \n')
+        elif conmat_names is not None:
+            label_names = conmat_names
+            node_order = label_names
+            node_colors = None
         else:
             label_names = list(range(conmat.shape[0]))
             node_order = label_names
@@ -357,11 +399,36 @@ class TFRmorletInputSpec(BaseInterfaceInputSpec):
 
     n_cycles = traits.Array(desc='the number of cycles globally or for each frequency')  # noqa
 
+    decim = traits.Int(3, desc='decimation factor of the TFR',
+                       usedefault=True)
+
+    n_jobs = traits.Int(
+        1, desc='number of threads computing the blocks of epochs',
+        usedefault=True)
+
+    average = traits.Bool(
+        True, desc='If True the power is averaged over epochs, otherwise \
+        the TFR of each epoch is saved', usedefault=True)
+
+    dtype = traits.Enum(
+        'float64', 'float32', 'complex64', 'complex128', usedefault=True,
+        desc='dtype of the TFR; power if real, complex coefficients (single \
+        trial only) if complex')
+
+    chunk_size = traits.Int(
+        10, desc='number of epochs transformed at a time by each thread',
+        usedefault=True)
+
+    compression = traits.Enum(
+        None, 'lzf', 'gzip', usedefault=True,
+        desc='compression of the single trial .hdf5 file')
+
 
 class TFRmorletOutputSpec(TraitedSpec):
     """Output specification."""
 
-    power_file = File(exists=True, desc="the average power file in npy format")
+    power_file = File(exists=True, desc="the average power in -tfr.h5 file \
+                      or the single trial TFR in a .hdf5 container")
 
 
 class TFRmorlet(BaseInterface):
@@ -379,10 +446,32 @@ class TFRmorlet(BaseInterface):
     n_cycles : int
         the number of cycles globally or for each frequency
 
+    decim : int
+        decimation factor of the TFR
+
+    n_jobs : int
+        number of threads, each computing the TFR of a block of epochs
+
+    average : bool
+        If True (default) the power averaged over epochs is saved; otherwise
+        the TFR of each epoch is appended to a .hdf5 container, so that the
+        single trial TFRs are never all in memory
+
+    dtype : str
+        dtype of the TFR: 'float64' or 'float32' for the power, 'complex64'
+        or 'complex128' for the complex coefficients (single trial only)
+
+    chunk_size : int
+        number of epochs transformed at a time by each thread
+
+    compression : str | None
+        compression filter of the single trial .hdf5 file, 'lzf' or 'gzip'
+
     Outputs
     -------
     power_file : str
-        Name of .npy file with average power
+        Name of -tfr.h5 file with average power, or of the -tfr.hdf5
+        container with the single trial TFR if not average
     """
 
     input_spec = TFRmorletInputSpec
@@ -404,9 +493,12 @@ class TFRmorlet(BaseInterface):
             n_cycles = self.inputs.freqs / 2.
         else:
             n_cycles = self.inputs.n_cycles
-        self.power_file = \
-            _compute_tfr_morlet(
-                    self.inputs.epo_file, self.inputs.freqs, n_cycles)  # noqa
+        self.power_file = _compute_tfr_morlet(
+            self.inputs.epo_file, self.inputs.freqs, n_cycles,
+            decim=self.inputs.decim, n_jobs=self.inputs.n_jobs,
+            average=self.inputs.average, dtype=self.inputs.dtype,
+            chunk_size=self.inputs.chunk_size,
+            compression=self.inputs.compression)
 
         return runtime
 
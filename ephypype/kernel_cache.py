@@ -0,0 +1,164 @@
+"""Process-wide cache of spectral kernels (DPSS tapers, Morlet wavelets)."""
+
+# License: BSD (3-clause)
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+from collections import OrderedDict
+
+from mne.time_frequency import morlet
+from mne.time_frequency.multitaper import _compute_mt_params
+
+# environment variable defining the directory of the on-disk .npz tier; it is
+# read by every worker process, e.g. when nipype runs with MultiProc plugin
+KERNEL_CACHE_DIR_ENV = 'EPHYPYPE_KERNEL_CACHE_DIR'
+
+
+class _KernelCache(object):
+    """Bounded LRU cache of kernels with an optional on-disk .npz tier.
+
+    Each kernel is a tuple of arrays identified by its kind and by the
+    parameters used to build it.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of kernels kept in memory
+    cache_dir : str | None
+        Directory where the kernels are saved as .npz files; if None the
+        kernels are only kept in memory
+    """
+
+    def __init__(self, maxsize=32, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.n_hits = 0
+        self.n_misses = 0
+        self._kernels = OrderedDict()
+
+    def get(self, kind, params, compute):
+        """Return the kernel, calling compute() only if not cached."""
+        key = _kernel_key(kind, params)
+
+        if key in self._kernels:
+            self._kernels.move_to_end(key)
+            self.n_hits += 1
+            return self._kernels[key]
+
+        self.n_misses += 1
+        kernel = self._load(key)
+        if kernel is None:
+            kernel = tuple(np.asarray(arr) for arr in compute())
+            self._save(key, kernel)
+
+        # kernels are shared by all callers
+        for arr in kernel:
+            arr.flags.writeable = False
+
+        self._kernels[key] = kernel
+        while len(self._kernels) > self.maxsize:
+            self._kernels.popitem(last=False)
+
+        return kernel
+
+    def clear(self):
+        """Remove all kernels kept in memory."""
+        self._kernels.clear()
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def _get_fname(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.isfile(self._get_fname(key)):
+            return None
+
+        with np.load(self._get_fname(key)) as npzfile:
+            return tuple(npzfile['arr_{}'.format(i)]
+                         for i in range(len(npzfile.files)))
+
+    def _save(self, key, kernel):
+        if self.cache_dir is None:
+            return
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write in a temporary file and rename it, so that concurrent
+        # workers never read a partially written kernel
+        fd, tmp_fname = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, *kernel)
+        os.replace(tmp_fname, self._get_fname(key))
+
+
+def _kernel_key(kind, params):
+    """Hash the kernel kind and parameters into a file-name safe key."""
+    params = sorted((name, np.asarray(value).tolist())
+                    for name, value in params.items())
+    params_hash = hashlib.sha1(repr(params).encode()).hexdigest()
+
+    return '{}_{}'.format(kind, params_hash)
+
+
+_kernel_cache = _KernelCache(cache_dir=os.environ.get(KERNEL_CACHE_DIR_ENV))
+
+
+def set_kernel_cache(maxsize=None, cache_dir=None):
+    """Configure the process-wide cache of spectral kernels.
+
+    Parameters
+    ----------
+    maxsize : int | None
+        Maximum number of kernels kept in memory; if None it is unchanged
+    cache_dir : str | None
+        Directory of the on-disk .npz tier; if None it is unchanged. The
+        directory can also be set by the EPHYPYPE_KERNEL_CACHE_DIR
+        environment variable, which is inherited by nipype workers
+    """
+    if maxsize is not None:
+        _kernel_cache.maxsize = maxsize
+    if cache_dir is not None:
+        _kernel_cache.cache_dir = cache_dir
+
+
+def _get_dpss_windows(n_times, sfreq, bandwidth=None, low_bias=True):
+    """Get DPSS tapers as computed by MNE multitaper functions.
+
+    Returns
+    -------
+    window_fun : array, shape (n_tapers, n_times)
+        The DPSS tapers
+    eigvals : array, shape (n_tapers,)
+        The eigenvalues of the tapers
+    """
+    params = dict(n_times=n_times, sfreq=sfreq, bandwidth=bandwidth,
+                  low_bias=low_bias)
+
+    def _compute():
+        window_fun, eigvals, _ = _compute_mt_params(
+            n_times, sfreq, bandwidth, low_bias, False)
+        return window_fun, eigvals
+
+    return _kernel_cache.get('dpss', params, _compute)
+
+
+def _get_morlet_wavelets(sfreq, freqs, n_cycles=7., zero_mean=True):
+    """Get the Morlet wavelets, one for each frequency.
+
+    Returns
+    -------
+    Ws : tuple of array
+        The wavelets time series
+    """
+    params = dict(sfreq=sfreq, freqs=freqs, n_cycles=n_cycles,
+                  zero_mean=zero_mean)
+
+    def _compute():
+        return morlet(sfreq, freqs, n_cycles=n_cycles, zero_mean=zero_mean)
+
+    return _kernel_cache.get('morlet', params, _compute)
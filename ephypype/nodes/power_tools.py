@@ -14,11 +14,15 @@ class PowerBandInputSpec(BaseInterfaceInputSpec):
     """Input specification for PowerBand."""
 
     psds_file = traits.File(exists=True,
-                            desc='psd tensor and frequencies in .npz format',
+                            desc='psd tensor and frequencies in .npz format '
+                            'or in a .hdf5 container',
                             mandatory=True)
 
     freq_bands = traits.List(desc='frequency bands', mandatory=True)
 
+    mode = traits.Enum('mean', 'median', 'integral', usedefault=True,
+                       desc='reduction of the psd in each frequency band')
+
 
 class PowerBandOutputSpec(TraitedSpec):
     """Output spec for PowerBand."""
@@ -30,7 +34,9 @@ class PowerBandOutputSpec(TraitedSpec):
 class PowerBand(BaseInterface):
     """Compute mean power spectral density for each frequency band.
 
-    Then, it's save in a  numpy file .npy
+    Then, it's save in a  numpy file .npy. The psds can be epoched, i.e.
+    of shape (n_epochs, n_channels, n_freqs); the median or the integral of
+    the psd in each band can be computed instead of the mean.
 
     Parameters
     ----------
@@ -39,6 +45,9 @@ class PowerBand(BaseInterface):
                format', mandatory=True
     freq_bands
         type = List of Float, desc='frequency bands', mandatory=True
+    mode
+        type = Enum('mean', 'median', 'integral'), desc='reduction of the
+               psd in each frequency band', default='mean'
 
     Returns
     -------
@@ -53,9 +62,11 @@ class PowerBand(BaseInterface):
 
         psds_file = self.inputs.psds_file
         freq_bands = self.inputs.freq_bands
+        mode = self.inputs.mode
 
         self.mean_power_band_file = _compute_mean_band_psd(psds_file,
-                                                           freq_bands)
+                                                           freq_bands,
+                                                           mode=mode)
 
         return runtime
 
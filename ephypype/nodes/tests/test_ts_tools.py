@@ -0,0 +1,52 @@
+"""Test ts_tools."""
+import os
+import h5py
+import pytest
+import numpy as np
+
+import nipype.pipeline.engine as pe
+
+from ephypype.nodes.ts_tools import SplitWindows
+
+from numpy.testing import assert_array_equal
+
+
+@pytest.mark.usefixtures("change_wd")
+def test_split_windows_node():
+    """Test SplitWindows Node, one file per window or a single file."""
+    ts = np.random.randn(3, 4, 200)
+    ts_file = os.path.abspath('ts.npy')
+    np.save(ts_file, ts)
+
+    n_windows = [(0, 50), (100, 150)]
+
+    split_node = pe.Node(interface=SplitWindows(), name='split_windows')
+    split_node.inputs.ts_file = ts_file
+    split_node.inputs.n_windows = n_windows
+    split_node.run()
+
+    win_ts_files = split_node.result.outputs.win_ts_files
+    assert len(win_ts_files) == len(n_windows)
+    for win_ts_file, n_win in zip(win_ts_files, n_windows):
+        assert_array_equal(np.load(win_ts_file), ts[:, :, n_win[0]:n_win[1]])
+
+    for single_file in ('npy', 'hdf5'):
+        split_node = pe.Node(interface=SplitWindows(),
+                             name='split_windows_' + single_file)
+        split_node.inputs.ts_file = ts_file
+        split_node.inputs.n_windows = n_windows
+        split_node.inputs.single_file = single_file
+        split_node.run()
+
+        outputs = split_node.result.outputs
+        if single_file == 'npy':
+            win_ts = np.load(outputs.win_ts_file)
+            win_index = np.load(outputs.win_index_file)
+        else:
+            with h5py.File(outputs.win_ts_file, 'r') as hf:
+                win_ts = hf['win_ts'][()]
+                win_index = hf['win_index'][()]
+
+        assert_array_equal(win_index, n_windows)
+        for i, n_win in enumerate(n_windows):
+            assert_array_equal(win_ts[i], ts[:, :, n_win[0]:n_win[1]])
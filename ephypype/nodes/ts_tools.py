@@ -2,10 +2,13 @@
 """All nodes for import that are NOT specific to a ephy package."""
 import numpy as np
 import os
+import h5py
 
 from nipype.interfaces.base import (BaseInterface, BaseInterfaceInputSpec,
                                     traits, TraitedSpec)
 
+from ..import_data import _read_ts
+
 
 class SplitWindowsInputSpec(BaseInterfaceInputSpec):
     """Split window input spec."""
@@ -17,6 +20,15 @@ class SplitWindowsInputSpec(BaseInterfaceInputSpec):
                             (tuple of two integers) of temporal windows',
                             mandatory=True)
 
+    mmap = traits.Bool(True, desc='if True the time series are memory-mapped \
+                       and only the windows are loaded in memory',
+                       usedefault=True)
+
+    single_file = traits.Enum('none', 'npy', 'hdf5', usedefault=True,
+                              desc='if set, all windows are saved stacked in \
+                              one .npy or .hdf5 file instead of one file per \
+                              window')
+
 
 class SplitWindowsOutputSpec(TraitedSpec):
     """Split window output spec."""
@@ -24,11 +36,19 @@ class SplitWindowsOutputSpec(TraitedSpec):
     win_ts_files = traits.List(traits.File(
         exists=True), desc="List of files with splitted timeseries by windows")
 
+    win_ts_file = traits.File(
+        exists=True, desc="File with all windows stacked, if single_file")
+
+    win_index_file = traits.File(
+        exists=True, desc="File with start and stop points of the stacked \
+        windows, if single_file is 'npy'")
+
 
 class SplitWindows(BaseInterface):
     """Split time series in several windows for all trials.
 
-    Then save each ndarray as an independant numpy file .npy
+    Then save each ndarray as an independant numpy file .npy, or all windows
+    stacked in a single file
 
     Parameters
     ----------
@@ -38,11 +58,25 @@ class SplitWindows(BaseInterface):
     n_windows
         type = List(Tuple), desc='List of start and stop points (tuple of two
         integers)of temporal windows', mandatory = True
+    mmap
+        type = Bool, default = True, desc='if True the time series are
+        memory-mapped and only the windows are loaded in memory'
+    single_file
+        type = Enum('none', 'npy', 'hdf5'), default = 'none', desc='if set, all
+        windows (that must have the same length) are saved in win_ts.npy or
+        win_ts.hdf5 as an array of shape (n_windows, n_trials, n_nodes,
+        n_times); the start and stop points are saved in win_index.npy or in
+        the 'win_index' dataset of the .hdf5 file (windows in 'win_ts')'
 
     Returns
     -------
-    ts_file
-        type = File, exists=True, desc="time series in .npy format"
+    win_ts_files
+        type = List(File), desc="time series of each window in .npy format"
+    win_ts_file
+        type = File, desc="all windows stacked, if single_file"
+    win_index_file
+        type = File, desc="start and stop points of the windows in .npy
+        format, if single_file is 'npy'"
 
     """
 
@@ -53,55 +87,81 @@ class SplitWindows(BaseInterface):
 
         print('in SplitWindows')
 
-        np_ts = np.load(self.inputs.ts_file)
+        np_ts = _read_ts(self.inputs.ts_file, mmap=self.inputs.mmap)
 
         print((np_ts.shape))
 
         self.win_ts_files = []
+        self.win_ts_file = None
+        self.win_index_file = None
 
-        print((self.inputs.n_windows))
+        n_windows = self.inputs.n_windows
+        print(n_windows)
 
-        for i, n_win in enumerate(self.inputs.n_windows):
+        for n_win in n_windows:
+            if not (0 <= n_win[0] and n_win[1] <= np_ts.shape[2]):
+                raise ValueError("Error, should be : 0 <= {} and {} <= "
+                                 "{}".format(n_win[0], n_win[1],
+                                             np_ts.shape[2]))
 
-            print(i)
-            print(n_win)
+        if self.inputs.single_file == 'none':
+            for i, n_win in enumerate(n_windows):
 
-            if 0 <= n_win[0] and n_win[1] <= np_ts.shape[2]:
+                # only the window of all trials is read from the file
+                win_ts = np_ts[:, :, n_win[0]:n_win[1]]
 
-                # print "OK for : 0 <= {} and {} <= {}".format(n_win[0],
-                # n_win[1],np_ts.shape[2])
+                print((win_ts.shape))
 
-                win_ts = []
+                win_ts_file = os.path.abspath("win_ts_{}.npy".format(i))
 
-                for trial_index in range(np_ts.shape[0]):
+                np.save(win_ts_file, win_ts)
 
-                    # print trial_index
+                self.win_ts_files.append(win_ts_file)
 
-                    # print np_ts[trial_index,:,n_win[0]:n_win[1]]
+            print(("Generated {} win files".format(len(self.win_ts_files))))
 
-                    win_ts.append(np_ts[trial_index, :, n_win[0]:n_win[1]])
+        else:
+            self._save_stacked_windows(np_ts, n_windows)
 
-                win_ts = np.array(win_ts)
+        return runtime
 
-                # win_ts = np.array([np_ts[trial_index,:,n_win[0]:n_win[1]]]
-                # for trial_index in range(np_ts.shape[0]))
+    def _save_stacked_windows(self, np_ts, n_windows):
+        """Save all windows in one file, window by window."""
+        win_index = np.array(n_windows, dtype=int)
+        win_lengths = win_index[:, 1] - win_index[:, 0]
+        if np.any(win_lengths != win_lengths[0]):
+            raise ValueError("Error, all windows should have the same length "
+                             "to be saved in a single file")
 
-                print((win_ts.shape))
+        shape = (len(n_windows), np_ts.shape[0], np_ts.shape[1],
+                 int(win_lengths[0]))
 
-                win_ts_file = os.path.abspath("win_ts_{}.npy".format(i))
+        if self.inputs.single_file == 'npy':
+            self.win_ts_file = os.path.abspath("win_ts.npy")
+            self.win_index_file = os.path.abspath("win_index.npy")
 
-                np.save(win_ts_file, win_ts)
+            win_ts = np.lib.format.open_memmap(
+                self.win_ts_file, mode='w+', dtype=np_ts.dtype, shape=shape)
+            for i, n_win in enumerate(n_windows):
+                win_ts[i] = np_ts[:, :, n_win[0]:n_win[1]]
+            win_ts.flush()
+            del win_ts
 
-                self.win_ts_files.append(win_ts_file)
+            np.save(self.win_index_file, win_index)
 
-            else:
-                print(("Warning, should be : 0 <= {} and {} <= {}".format(
-                    n_win[0], n_win[1], np_ts.shape[2])))
-                0 / 0
+        else:
+            self.win_ts_file = os.path.abspath("win_ts.hdf5")
 
-        print(("Generated {} win files".format(len(self.win_ts_files))))
+            with h5py.File(self.win_ts_file, 'w') as hf:
+                win_ts = hf.create_dataset('win_ts', shape=shape,
+                                           dtype=np_ts.dtype,
+                                           chunks=(1,) + shape[1:])
+                for i, n_win in enumerate(n_windows):
+                    win_ts[i] = np_ts[:, :, n_win[0]:n_win[1]]
+                hf.create_dataset('win_index', data=win_index)
 
-        return runtime
+        print(("Generated {} with {} windows".format(self.win_ts_file,
+                                                     len(n_windows))))
 
     def _list_outputs(self):
 
@@ -109,4 +169,9 @@ class SplitWindows(BaseInterface):
 
         outputs["win_ts_files"] = self.win_ts_files
 
+        if self.inputs.single_file != 'none':
+            outputs["win_ts_file"] = self.win_ts_file
+            if self.inputs.single_file == 'npy':
+                outputs["win_index_file"] = self.win_index_file
+
         return outputs
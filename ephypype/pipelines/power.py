@@ -14,7 +14,7 @@ from ephypype.nodes.power_tools import PowerBand
 
 def create_pipeline_power(main_path, freq_bands, pipeline_name='power_pipeline',  # noqa
                           fmin=0, fmax=300, method='welch',
-                          is_epoched=False):
+                          is_epoched=False, save_img=False):
     """Power pipeline.
 
     Wraps functions of MNE to compute PSD of epoch or raw data.
@@ -38,6 +38,8 @@ def create_pipeline_power(main_path, freq_bands, pipeline_name='power_pipeline',
     is_epoched : bool (default False)
         True if the input data are in epoch format (-epo.fif); False
         if the input data are raw data (-raw.fif)
+    save_img : bool (default False)
+        if True the image of the PSD is saved by the power node
 
     fif_file (inputnode): str
         path to raw or epoched meg data in fif format
@@ -60,6 +62,7 @@ def create_pipeline_power(main_path, freq_bands, pipeline_name='power_pipeline',
     power_node.inputs.fmax = fmax
     power_node.inputs.method = method
     power_node.inputs.is_epoched = is_epoched
+    power_node.inputs.save_img = save_img
 
     pipeline.connect(inputnode, 'fif_file', power_node, 'data_file')
 
@@ -75,7 +78,9 @@ def create_pipeline_power_src_space(main_path, sfreq, freq_bands,
                                     pipeline_name='source_power',
                                     fmin=0, fmax=300, nfft=256, overlap=0,
                                     is_epoched=False, inv_method='MNE',
-                                    snr=3.0):
+                                    snr=3.0, save_img=False,
+                                    src_psd_mode='compute_source_psd',
+                                    subjects_dir=None, parc='aparc'):
     """Power pipeline: wraps functions of MNE to compute source PSD.
 
     Parameters
@@ -98,11 +103,26 @@ def create_pipeline_power_src_space(main_path, sfreq, freq_bands,
         The number of points of overlap between segments
     is_epoched : bool (default False)
         True if the input data are in epoch format
+    save_img : bool (default False)
+        if True the image of the PSD is saved by the power node
+    src_psd_mode : str (default 'compute_source_psd')
+        'compute_source_psd' computes the PSD of all the sources by MNE;
+        'labels' computes the PSD of the labels of parc by the imaging
+        kernel collapsed to the labels, applied to the raw data read by
+        chunks; 'vertices' computes the PSD of all the sources by the
+        imaging kernel
+    subjects_dir : str | None
+        the freesurfer subjects directory, needed if src_psd_mode is
+        'labels'
+    parc : str (default 'aparc')
+        the parcellation defining the labels
 
     Inputs (inputnode)
     ------------------
     src_file : str
         path to source reconstruction matrix (.npy format)
+    sbj_id : str
+        subject id, needed if src_psd_mode is 'labels'
 
     Returns
     -------
@@ -118,7 +138,7 @@ def create_pipeline_power_src_space(main_path, sfreq, freq_bands,
     #                     name='inputnode')
 
     inputnode = pe.Node(IdentityInterface(fields=['raw_file',
-                                                  'inv_file']),
+                                                  'inv_file', 'sbj_id']),
                         name='inputnode')
 
     power_node = pe.Node(interface=Power(), name='power')
@@ -131,6 +151,12 @@ def create_pipeline_power_src_space(main_path, sfreq, freq_bands,
     power_node.inputs.is_epoched = is_epoched
     power_node.inputs.inv_method = inv_method
     power_node.inputs.is_sensor_space = False
+    power_node.inputs.save_img = save_img
+    power_node.inputs.src_psd_mode = src_psd_mode
+    if src_psd_mode == 'labels':
+        power_node.inputs.subjects_dir = subjects_dir
+        power_node.inputs.parc = parc
+        pipeline.connect(inputnode, 'sbj_id', power_node, 'sbj_id')
 
     pipeline.connect(inputnode, 'raw_file', power_node, 'data_file')
     pipeline.connect(inputnode, 'inv_file', power_node, 'inv_file')
@@ -8,7 +8,7 @@ import nipype.pipeline.engine as pe
 from nipype.interfaces.utility import IdentityInterface, Function
 from nipype.utils.filemanip import split_filename
 
-from ..interfaces.mne.preproc import PreprocFif
+from ..interfaces.mne.preproc import PreprocFif, PreprocIcaFif
 from ..interfaces.mne.preproc import CompIca
 from ..nodes.import_data import ConvertDs2Fif
 from ..preproc import _preprocess_set_ica_comp_fif_to_ts
@@ -46,7 +46,7 @@ def create_pipeline_preproc_meeg(main_path, pipeline_name='preproc_meeg_pipeline
                                  is_set_ICA_components=False, mapnode=False,
                                  n_comp_exclude=[], is_sensor_space=True,
                                  montage=None, misc=None, bipolar=None,
-                                 ch_new_names=None):
+                                 ch_new_names=None, fused=False):
     """Preprocessing pipeline.
 
     Parameters
@@ -89,6 +89,10 @@ def create_pipeline_preproc_meeg(main_path, pipeline_name='preproc_meeg_pipeline
     is_sensor_space: boolean (default True)
         True if we perform the analysis in sensor space and we use the
         pipeline as lego with the connectivity or inverse pipeline
+    fused: boolean (default False)
+        if True, filtering, ICA and conversion to array are done by a single
+        node 'preproc_ica' (PreprocIcaFif) reading the raw data once; the
+        cleaned time series are in its 'array_file' output
 
     raw_file (inputnode): str
         path to raw meg data in fif format
@@ -109,6 +113,58 @@ def create_pipeline_preproc_meeg(main_path, pipeline_name='preproc_meeg_pipeline
     inputnode = pe.Node(IdentityInterface(fields=['raw_file', 'subject_id']),
                         name='inputnode')
 
+    if fused:
+        assert is_ICA and not is_set_ICA_components, (
+            'fused pipeline only computes ICA on the preprocessed data')
+
+        if mapnode:
+            preproc_ica_node = pe.MapNode(interface=PreprocIcaFif(),
+                                          iterfield=['fif_file'],
+                                          name='preproc_ica')
+        else:
+            preproc_ica_node = pe.Node(interface=PreprocIcaFif(),
+                                       name='preproc_ica')
+
+        preproc_ica_node.inputs.l_freq = l_freq
+        if h_freq:
+            preproc_ica_node.inputs.h_freq = h_freq
+        if down_sfreq:
+            preproc_ica_node.inputs.down_sfreq = down_sfreq
+        preproc_ica_node.inputs.data_type = data_type
+        if variance:
+            preproc_ica_node.inputs.variance = variance
+        elif n_components:
+            preproc_ica_node.inputs.n_components = n_components
+        preproc_ica_node.inputs.ecg_ch_name = ECG_ch_name
+        preproc_ica_node.inputs.eog_ch_name = EoG_ch_name
+        if reject:
+            preproc_ica_node.inputs.reject = reject
+
+        if data_type == 'ds':
+            if mapnode:
+                ds2fif_node = pe.MapNode(interface=ConvertDs2Fif(),
+                                         iterfield=['ds_file'], name='ds2fif')
+            else:
+                ds2fif_node = pe.Node(interface=ConvertDs2Fif(),
+                                      name='ds2fif')
+            pipeline.connect(inputnode, 'raw_file', ds2fif_node, 'ds_file')
+            pipeline.connect(ds2fif_node, 'fif_file',
+                             preproc_ica_node, 'fif_file')
+            preproc_ica_node.inputs.data_type = 'fif'
+        else:
+            if data_type == 'eeg':
+                preproc_ica_node.inputs.montage = montage
+                if bipolar:
+                    preproc_ica_node.inputs.bipolar = bipolar
+                if misc:
+                    preproc_ica_node.inputs.misc = misc
+                if ch_new_names:
+                    preproc_ica_node.inputs.ch_new_names = ch_new_names
+            pipeline.connect(inputnode, 'raw_file',
+                             preproc_ica_node, 'fif_file')
+
+        return pipeline
+
     if mapnode:
 
         if data_type == 'ds':
@@ -5,75 +5,287 @@
 import os
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+
 from nipype.utils.filemanip import split_filename
-from mne import read_epochs
+from mne import read_epochs, pick_types
 from mne.io import read_raw_fif
 from mne.minimum_norm import compute_source_psd, read_inverse_operator
-from scipy.signal import welch
+from mne.time_frequency.multitaper import _mt_spectra, _psd_from_mt
+from scipy import sparse
+from scipy.signal import welch, spectrogram
 
-from .fif2array import _get_raw_array
-from .import_data import _read_hdf5
+from .aux_tools import _get_n_threads
+from .fif2array import _save_raw_array
+from .import_data import (_read_ts, _read_npz_array, _is_container,
+                          read_container, write_container)
+from .kernel_cache import _get_dpss_windows
+from .compute_inv_problem import _make_inverse_kernel
+from .source_space import _get_label_projection
 
 
 def _compute_and_save_psd(data_fname, fmin=0, fmax=120,
                           method='welch', is_epoched=False,
                           n_fft=256, n_overlap=0,
-                          picks=None, proj=False, n_jobs=1, verbose=None):
-    """Load epochs/raw from file, compute psd and save the result."""
-
+                          picks=None, proj=False, n_jobs=1, verbose=None,
+                          chunk_duration=60., container=False,
+                          save_img=False):
+    """Load epochs/raw from file, compute psd and save the result.
+
+    The data are read once, by chunks of about chunk_duration seconds: the
+    Welch psd of raw data accumulates the periodograms of the segments of
+    each chunk, so that the memory used does not depend on the length of
+    the recording. The multitaper psd of raw data needs the whole time
+    series. The channel files are written from the info of the same file.
+
+    By default the psd is computed on all the data channels (MEG, EEG,
+    sEEG, ECoG) but the bad ones. If container is True, the psd, the
+    channel names and coordinates are saved in a single -psds.hdf5
+    container (see write_container) instead of the .npz and .txt files.
+    The image of the psd is saved only if save_img is True (see
+    _plot_psd_file to plot it afterwards).
+    """
     if is_epoched:
-        epochs = read_epochs(data_fname)
+        inst = read_epochs(data_fname, preload=False)
     else:
-        epochs = read_raw_fif(data_fname, preload=True)
-
-    epochs_meg = epochs.pick_types(meg=True, eeg=False, eog=False, ecg=False)
-
-    if method == 'welch':
-        from mne.time_frequency import psd_welch
-        psds, freqs = psd_welch(epochs_meg, fmin=fmin, fmax=fmax)
+        inst = read_raw_fif(data_fname, preload=False)
+
+    if picks is None:
+        picks = pick_types(inst.info, meg=True, eeg=True, seeg=True,
+                           ecog=True, ref_meg=False, exclude='bads')
+
+    sfreq = inst.info['sfreq']
+    if method == 'welch' and not is_epoched:
+        psds, freqs = _psd_welch_raw(inst, picks, fmin=fmin, fmax=fmax,
+                                     n_fft=n_fft, n_overlap=n_overlap,
+                                     chunk_duration=chunk_duration)
+    elif method == 'welch':
+        psds, freqs = _psd_epochs(inst, picks, _psd_welch, chunk_duration,
+                                  fmin=fmin, fmax=fmax, n_fft=n_fft,
+                                  n_overlap=n_overlap)
+    elif method == 'multitaper' and not is_epoched:
+        psds, freqs = _psd_multitaper(inst.get_data(picks), sfreq,
+                                      fmin=fmin, fmax=fmax)
     elif method == 'multitaper':
-        from mne.time_frequency import psd_multitaper
-        psds, freqs = psd_multitaper(epochs_meg, fmin=fmin, fmax=fmax)
+        psds, freqs = _psd_epochs(inst, picks, _psd_multitaper,
+                                  chunk_duration, fmin=fmin, fmax=fmax)
     else:
         raise Exception('nonexistent method for psd computation')
 
-    _get_raw_array(data_fname, save_data=False)
-
-    psds_fname = _save_psd(data_fname, psds, freqs)
-    _save_psd_img(data_fname, psds, freqs, is_epoched, method)
+    if container:
+        ch_names = [inst.ch_names[pick] for pick in picks]
+        ch_coords = np.array([inst.info['chs'][pick]['loc'][:3]
+                              for pick in picks])
+        psds_fname = _save_psd(data_fname, psds, freqs, container=True,
+                               ch_names=ch_names, ch_coords=ch_coords,
+                               method=method, sfreq=sfreq, n_fft=n_fft,
+                               n_overlap=n_overlap, is_epoched=is_epoched)
+    else:
+        _, basename, _ = split_filename(data_fname)
+        _save_raw_array(inst, basename, save_data=False,
+                        select_sensors=picks)
+        psds_fname = _save_psd(data_fname, psds, freqs)
+    if save_img:
+        _save_psd_img(data_fname, psds, freqs, is_epoched, method)
 
     return psds_fname
 
 
+def _psd_welch(data, sfreq, fmin=0, fmax=np.inf, n_fft=256, n_overlap=0,
+               average=True):
+    """Compute the Welch psd of data along the last axis.
+
+    Same as mne psd_array_welch (hamming window, constant detrending). If
+    average is False, the sum of the segment periodograms and the number of
+    segments are returned instead of their mean. The segments containing
+    NaN (e.g. BAD annotations read with reject_by_annotation='NaN') are
+    dropped.
+    """
+    n_per_seg = min(n_fft, data.shape[-1])
+    freqs, _, periodograms = spectrogram(
+        data, fs=sfreq, window='hamming', nperseg=n_per_seg,
+        noverlap=n_overlap, nfft=max(n_fft, n_per_seg), detrend='constant',
+        mode='psd')
+    freq_mask = (freqs >= fmin) & (freqs <= fmax)
+    periodograms = periodograms[..., freq_mask, :]
+
+    good_segs = ~np.isnan(periodograms).any(
+        axis=tuple(range(periodograms.ndim - 1)))
+    if not good_segs.all():
+        periodograms = periodograms[..., good_segs]
+
+    if average:
+        return periodograms.mean(-1), freqs[freq_mask]
+    return periodograms.sum(-1), periodograms.shape[-1], freqs[freq_mask]
+
+
+def _apply_kernel_psd(psd_func, data, kernel=None, block_size=1000,
+                      **kwargs):
+    """Compute the psd of kernel @ data by blocks of rows of the kernel.
+
+    If kernel is None the psd of data is computed; the psd of each block of
+    block_size rows (e.g. sources) is computed as soon as its time series
+    are, so that the time series of all the rows are never in memory.
+    """
+    if kernel is None:
+        return psd_func(data, **kwargs)
+
+    outputs = [psd_func(kernel[start:start + block_size] @ data, **kwargs)
+               for start in range(0, kernel.shape[0], block_size)]
+
+    return (np.concatenate([out[0] for out in outputs], axis=-2),) + \
+        tuple(outputs[0][1:])
+
+
+def _psd_welch_raw(raw, picks, fmin=0, fmax=np.inf, n_fft=256, n_overlap=0,
+                   chunk_duration=60., kernel=None):
+    """Compute the Welch psd of raw data reading it by chunks.
+
+    Each chunk holds an integer number of Welch segments and the next one
+    starts at the next segment, so that the psd is the same as the one of
+    the whole time series. As raw.compute_psd, the segments overlapping
+    BAD_* annotations are excluded from the average. If kernel is not None,
+    the psd of kernel @ data is computed, e.g. of the sources with an
+    imaging kernel.
+    """
+    n_per_seg = min(n_fft, raw.n_times)
+    step = n_per_seg - n_overlap
+    n_segs = (raw.n_times - n_per_seg) // step + 1
+    n_segs_per_chunk = max(int(chunk_duration * raw.info['sfreq']) // step,
+                           1)
+
+    psds = 0.
+    n_good_segs = 0
+    for first_seg in range(0, n_segs, n_segs_per_chunk):
+        last_seg = min(first_seg + n_segs_per_chunk, n_segs)
+        start = first_seg * step
+        stop = (last_seg - 1) * step + n_per_seg
+        data = raw.get_data(picks, start=start, stop=stop,
+                            reject_by_annotation='NaN')
+        psds_sum, n_chunk_segs, freqs = _apply_kernel_psd(
+            _psd_welch, data, kernel, sfreq=raw.info['sfreq'], fmin=fmin,
+            fmax=fmax, n_fft=n_fft, n_overlap=n_overlap, average=False)
+        psds = psds + psds_sum
+        n_good_segs += n_chunk_segs
+
+    if n_good_segs == 0:
+        raise ValueError('Error, all the segments of the psd overlap BAD '
+                         'annotations')
+    print(('*** psd averaged over {} of {} segments ***'.format(
+        n_good_segs, n_segs)))
+
+    return psds / n_good_segs, freqs
+
+
+def _psd_epochs(epochs, picks, psd_func, chunk_duration=60., kernel=None,
+                **kwargs):
+    """Compute the psd of each epoch, reading the epochs by chunks.
+
+    If kernel is not None, the psd of kernel @ data is computed.
+    """
+    n_epochs_per_chunk = max(
+        int(chunk_duration * epochs.info['sfreq']) // len(epochs.times), 1)
+
+    psds = list()
+    for start in range(0, len(epochs), n_epochs_per_chunk):
+        data = epochs[start:start + n_epochs_per_chunk].get_data(picks)
+        chunk_psds, freqs = _apply_kernel_psd(
+            psd_func, data, kernel, sfreq=epochs.info['sfreq'], **kwargs)
+        psds.append(chunk_psds)
+
+    return np.concatenate(psds), freqs
+
+
+def _psd_multitaper(data, sfreq, fmin=0, fmax=np.inf, bandwidth=None):
+    """Compute the multitaper PSD of data along the last axis.
+
+    Same as mne psd_array_multitaper (non adaptive, normalization='length')
+    but the DPSS tapers are taken from the kernel cache, so that they are
+    computed once for all the files with the same length.
+
+    Parameters
+    ----------
+    data : array, shape (..., n_times)
+        The time series
+    sfreq : float
+        The sampling frequency
+    fmin, fmax : float
+        The frequency range
+    bandwidth : float | None
+        The bandwidth of the multitaper windowing function in Hz
+
+    Returns
+    -------
+    psds : array, shape (..., n_freqs)
+        The power spectral density
+    freqs : array, shape (n_freqs,)
+        The frequencies
+    """
+    n_times = data.shape[-1]
+    dpss, eigvals = _get_dpss_windows(n_times, sfreq, bandwidth)
+    weights = np.sqrt(eigvals)[:, np.newaxis]
+
+    x_mt, freqs = _mt_spectra(data, dpss, sfreq)
+    freq_mask = (freqs >= fmin) & (freqs <= fmax)
+
+    psds = _psd_from_mt(x_mt[..., freq_mask], weights)
+
+    return psds, freqs[freq_mask]
+
+
 def _compute_and_save_src_psd_old(data_fname, sfreq, fmin=0, fmax=120,
                                   is_epoched=False,
                                   n_fft=256, n_overlap=0,
-                                  n_jobs=1, verbose=None):
-    """Load epochs/raw from file, compute psd and save the result."""
-    data_path, basename, ext = split_filename(data_fname)
-    if ext == '.npy':
-        src_data = np.load(data_fname)
-    elif ext == '.hdf5':
-        src_data = _read_hdf5(data_fname, dataset_name='stc_data')
+                                  n_jobs=1, verbose=None, mmap=True,
+                                  block_size=1000, dtype=np.float64,
+                                  container=False, save_img=False):
+    """Load epochs/raw from file, compute psd and save the result.
+
+    If mmap is True the source time series are memory-mapped (.npy) or read
+    by chunks (.hdf5) and the psd is computed on blocks of block_size
+    vertices, so that the whole source space is never loaded in memory.
+    Each block is computed by a single call to welch along the time axis;
+    the blocks are processed by n_jobs threads (all the CPUs if -1) and
+    converted to dtype (e.g. np.float32 to halve the memory of the blocks
+    and of the psd).
+    If container is True the psd is saved in a -psds.hdf5 container. The
+    image of the psd is saved only if save_img is True.
+    """
+    src_data = _read_ts(data_fname, dataset_name='stc_data', mmap=mmap)
+
     dim = src_data.shape
     if len(dim) == 3 and dim[0] == 1:
-        src_data = np.squeeze(src_data)
-    print(('src data dim: {}'.format(src_data.shape)))
+        prefix = (0,)
+        dim = dim[1:]
+    else:
+        prefix = ()
+    print(('src data dim: {}'.format(dim)))
 
-    if n_fft > src_data.shape[1]:
-        nperseg = src_data.shape[1]
+    if n_fft > dim[1]:
+        nperseg = dim[1]
     else:
         nperseg = n_fft
 
-    n_freqs = nperseg // 2 + 1
-    psds = np.empty([src_data.shape[0], n_freqs])
-    for i in range(src_data.shape[0]):
-        freqs, Pxx = welch(src_data[i, :], fs=sfreq, window='hamming',
-                           nperseg=nperseg, noverlap=n_overlap, nfft=None)
-        psds[i, :] = Pxx
+    freqs = np.fft.rfftfreq(nperseg, 1. / sfreq)
+    psds = np.empty([dim[0], len(freqs)], dtype=dtype)
 
-    psds_fname = _save_psd(data_fname, psds, freqs)
-    _save_psd_img(data_fname, psds, freqs, is_epoched)
+    def _compute_block_psd(start):
+        block = slice(start, min(start + block_size, dim[0]))
+        block_data = np.asarray(src_data[prefix + (block,)], dtype=dtype)
+        _, psds[block] = welch(block_data, fs=sfreq, window='hamming',
+                               nperseg=nperseg, noverlap=n_overlap,
+                               nfft=None, axis=-1)
+
+    # scipy FFTs release the GIL, the blocks are computed in parallel
+    with ThreadPoolExecutor(max_workers=_get_n_threads(n_jobs)) as executor:
+        list(executor.map(_compute_block_psd,
+                          range(0, dim[0], block_size)))
+
+    psds_fname = _save_psd(data_fname, psds, freqs, container=container,
+                           method='welch', sfreq=sfreq, n_fft=n_fft,
+                           n_overlap=n_overlap)
+    if save_img:
+        _save_psd_img(data_fname, psds, freqs, is_epoched)
 
     return psds_fname
 
@@ -81,8 +293,13 @@ def _compute_and_save_src_psd_old(data_fname, sfreq, fmin=0, fmax=120,
 def _compute_and_save_src_psd(data_fname, sfreq, inv_file, fmin=0, fmax=120,
                               is_epoched=False, inv_method='MNE', snr=3.0,
                               n_fft=256, n_overlap=0,
-                              n_jobs=1, verbose=None):
-    """Load epochs/raw from file, compute psd and save the result."""
+                              n_jobs=1, verbose=None, container=False,
+                              save_img=False):
+    """Load epochs/raw from file, compute psd and save the result.
+
+    If container is True the psd is saved in a -psds.hdf5 container. The
+    image of the psd is saved only if save_img is True.
+    """
     data_path, basename, ext = split_filename(data_fname)
 
     raw = read_raw_fif(data_fname, preload=True)
@@ -103,46 +320,218 @@ def _compute_and_save_src_psd(data_fname, sfreq, inv_file, fmin=0, fmax=120,
     freqs = stc.times
     psds = stc.data
 
-    psds_fname = _save_psd(data_fname, psds, freqs)
-    _save_psd_img(data_fname, psds, freqs, is_epoched)
+    psds_fname = _save_psd(data_fname, psds, freqs, container=container,
+                           method=inv_method, sfreq=sfreq, n_fft=n_fft,
+                           n_overlap=n_overlap, snr=snr)
+    if save_img:
+        _save_psd_img(data_fname, psds, freqs, is_epoched)
 
     return psds_fname
 
 
-def _compute_mean_band_psd(psds_file, freq_bands):
-    """Compute mean band psd."""
-    npzfile = np.load(psds_file)
-    print(('the .npz file contain {} \n'.format(npzfile.files)))
+def _compute_and_save_src_kernel_psd(data_fname, inv_file, fmin=0, fmax=120,
+                                     method='welch', is_epoched=False,
+                                     inv_method='MNE', snr=3.0, n_fft=256,
+                                     n_overlap=0, labels=None,
+                                     label_mode='mean_flip', sbj_id=None,
+                                     parc=None,
+                                     chunk_duration=60., container=False,
+                                     save_img=False):
+    """Compute the psd of the sources or of the labels with a kernel.
+
+    The imaging kernel of the inverse solution (normal orientation) is
+    applied to the sensor data read by chunks, as for the sensor space psd,
+    instead of computing the stc of the whole recording with
+    compute_source_psd. If labels is not None, the kernel is collapsed to
+    the labels by the label projection (see _get_label_projection, cached
+    next to inv_file), so that the psd is computed on n_labels signals only;
+    otherwise the psd of all the sources is computed by blocks of sources.
+
+    Parameters
+    ----------
+    data_fname : str
+        The raw (or epochs if is_epoched) .fif file
+    inv_file : str
+        The inverse operator file
+    labels : list of Label | None
+        The labels of the ROIs; if None the psd of all the sources is
+        computed
+    label_mode : str
+        'mean' or 'mean_flip', the mode of the label projection
+    sbj_id : str | None
+        The subject of the labels, used to name the cached projection
+    parc : str | None
+        The parcellation of the labels, used to name the cached projection
+    container : bool
+        If True the psd is saved in a -psds.hdf5 container with the label
+        names
+
+    Returns
+    -------
+    psds_fname : str
+        The name of the file with the psd of shape (n_labels, n_freqs) or
+        (n_sources, n_freqs), with a first n_epochs axis if is_epoched
+    """
+    if is_epoched:
+        inst = read_epochs(data_fname, preload=False)
+    else:
+        inst = read_raw_fif(data_fname, preload=False)
 
-    # is a matrix with dim n_channels(n_voxel) x n_freqs
-    psds = npzfile['psds']
-    print(('psds is a matrix {} \n'.format(psds.shape)))
+    inverse_operator = read_inverse_operator(inv_file)
+    kernel, sel = _make_inverse_kernel(inverse_operator, inst,
+                                       1.0 / snr ** 2, inv_method,
+                                       pick_ori='normal')
+
+    ch_names = None
+    if labels is not None:
+        proj = _get_label_projection(labels, inverse_operator['src'],
+                                     mode=label_mode, sbj_id=sbj_id,
+                                     parc=parc, fwd_filename=inv_file)
+        kernel = proj @ kernel
+        ch_names = [label.name for label in labels]
+        ch_names += ['vol-{}'.format(i) for i in
+                     range(kernel.shape[0] - len(labels))]
+    print(('*** kernel psd of {} signals ***'.format(kernel.shape[0])))
+
+    sfreq = inst.info['sfreq']
+    if method == 'welch' and not is_epoched:
+        psds, freqs = _psd_welch_raw(inst, sel, fmin=fmin, fmax=fmax,
+                                     n_fft=n_fft, n_overlap=n_overlap,
+                                     chunk_duration=chunk_duration,
+                                     kernel=kernel)
+    elif method == 'welch':
+        psds, freqs = _psd_epochs(inst, sel, _psd_welch, chunk_duration,
+                                  kernel=kernel, fmin=fmin, fmax=fmax,
+                                  n_fft=n_fft, n_overlap=n_overlap)
+    elif method == 'multitaper' and not is_epoched:
+        psds, freqs = _apply_kernel_psd(_psd_multitaper, inst.get_data(sel),
+                                        kernel, sfreq=sfreq, fmin=fmin,
+                                        fmax=fmax)
+    elif method == 'multitaper':
+        psds, freqs = _psd_epochs(inst, sel, _psd_multitaper,
+                                  chunk_duration, kernel=kernel, fmin=fmin,
+                                  fmax=fmax)
+    else:
+        raise Exception('nonexistent method for psd computation')
+
+    psds_fname = _save_psd(data_fname, psds, freqs, container=container,
+                           ch_names=ch_names, method=method,
+                           inv_method=inv_method, sfreq=sfreq, n_fft=n_fft,
+                           n_overlap=n_overlap, snr=snr,
+                           is_epoched=is_epoched)
+    if save_img:
+        _save_psd_img(data_fname, psds, freqs, is_epoched, method)
+
+    return psds_fname
+
+
+def _get_band_weights(freqs, freq_bands, mode='mean'):
+    """Build the sparse matrix reducing the psd frequencies to bands.
+
+    Parameters
+    ----------
+    freqs : array, shape (n_freqs,)
+        The increasing frequencies of the psd
+    freq_bands : list
+        The [fmin, fmax] frequency bands, both bounds included
+    mode : str
+        'mean' averages the psd in each band, 'integral' integrates it with
+        the trapezoidal rule; for 'median' the weights select the frequencies
+        of the bands
+
+    Returns
+    -------
+    weights : scipy.sparse.csc_matrix, shape (n_freqs, n_bands)
+        The weights of each frequency in each band
+    """
+    if mode not in ('mean', 'median', 'integral'):
+        raise ValueError("mode must be 'mean', 'median' or 'integral', got "
+                         "{}".format(mode))
+
+    rows, cols, values = list(), list(), list()
+    for band, (fmin, fmax) in enumerate(freq_bands):
+        print(('*** frequency band [{}, {}] ***\n'.format(fmin, fmax)))
+        start = np.searchsorted(freqs, fmin, side='left')
+        stop = np.searchsorted(freqs, fmax, side='right')
+        band_freqs = freqs[start:stop]
+
+        if mode == 'integral':
+            band_weights = np.zeros(len(band_freqs))
+            band_weights[:-1] += np.diff(band_freqs) / 2.
+            band_weights[1:] += np.diff(band_freqs) / 2.
+        elif mode == 'mean':
+            band_weights = np.full(len(band_freqs), 1. / max(stop - start, 1))
+        else:
+            band_weights = np.ones(len(band_freqs))
+
+        rows.append(np.arange(start, stop))
+        cols.append(np.full(len(band_freqs), band))
+        values.append(band_weights)
+
+    return sparse.csc_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(freqs), len(freq_bands)))
+
+
+def _reduce_psd_bands(psds, freqs, freq_bands, mode='mean'):
+    """Reduce the last (frequency) axis of psds to frequency bands.
+
+    The psds can have any number of dimensions, e.g. (n_channels, n_freqs)
+    or (n_epochs, n_channels, n_freqs), and be memory-mapped: the mean and
+    the integral are computed by a single product with the weights matrix.
+    The bands without any frequency are set to NaN.
+
+    Returns
+    -------
+    m_px : array, shape (..., n_bands)
+        The psd in each band
+    """
+    weights = _get_band_weights(freqs, freq_bands, mode=mode)
+    psds_2d = psds.reshape(-1, psds.shape[-1])
+
+    if mode == 'median':
+        m_px = np.full((psds_2d.shape[0], len(freq_bands)), np.nan)
+        for band in range(len(freq_bands)):
+            band_freqs = weights.indices[weights.indptr[band]:
+                                         weights.indptr[band + 1]]
+            if len(band_freqs):
+                m_px[:, band] = np.median(psds_2d[:, band_freqs], axis=-1)
+    else:
+        m_px = np.asarray(psds_2d @ weights)
+        m_px[:, np.diff(weights.indptr) == 0] = np.nan
+
+    return m_px.reshape(psds.shape[:-1] + (len(freq_bands),))
 
-    # list of frequencies in which psds was computed;
-    # its length = columns of psds
-    freqs = npzfile['freqs']
-    print(('freqs contains {} frequencies \n'.format(len(freqs))))
 
-    n_row, _ = psds.shape
-    n_fr = len(freq_bands)
+def _compute_mean_band_psd(psds_file, freq_bands, mode='mean', mmap=True):
+    """Compute mean band psd.
 
-    m_px = np.empty([n_row, n_fr])
+    The psds of the .npz file or container, shape (n_channels, n_freqs) or
+    (n_epochs, n_channels, n_freqs), are memory-mapped if mmap is True (.npz
+    only) and reduced to the frequency bands by _reduce_psd_bands.
+    """
+    if _is_container(psds_file):
+        container = read_container(psds_file, mmap=False)
+        psds, freqs = container['data'], container['freqs']
+    else:
+        psds = _read_npz_array(psds_file, 'psds', mmap=mmap)
+        # list of frequencies in which psds was computed;
+        # its length = last dimension of psds
+        freqs = _read_npz_array(psds_file, 'freqs', mmap=False)
+    print(('psds is a matrix {} \n'.format(psds.shape)))
+    print(('freqs contains {} frequencies \n'.format(len(freqs))))
 
-    for f in range(n_fr):
-        min_fr = freq_bands[f][0]
-        max_fr = freq_bands[f][1]
-        print(('*** frequency band [{}, {}] ***\n'.format(min_fr, max_fr)))
-        m_px[:, f] = np.mean(psds[:, (freqs >= min_fr) * (freqs <= max_fr)], 1)
+    m_px = _reduce_psd_bands(psds, freqs, freq_bands, mode=mode)
 
-    psds_mean_fname = _save_m_px(psds_file, m_px)
+    psds_mean_fname = _save_m_px(psds_file, m_px, mode=mode)
 
     return psds_mean_fname
 
 
-def _save_m_px(psds_file, m_px):
+def _save_m_px(psds_file, m_px, mode='mean'):
     data_path, basename, ext = split_filename(psds_file)
 
-    psds_mean_fname = basename + '-mean_band.npy'
+    psds_mean_fname = basename + '-{}_band.npy'.format(mode)
     psds_mean_fname = os.path.abspath(psds_mean_fname)
     print((m_px.shape))
     np.save(psds_mean_fname, m_px)
@@ -150,9 +539,16 @@ def _save_m_px(psds_file, m_px):
     return psds_mean_fname
 
 
-def _save_psd(data_fname, psds, freqs):
+def _save_psd(data_fname, psds, freqs, container=False, ch_names=None,
+              ch_coords=None, **attrs):
     data_path, basename, ext = split_filename(data_fname)
 
+    if container:
+        print((psds.shape))
+        return write_container(basename + '-psds.hdf5', psds, freqs=freqs,
+                               ch_names=ch_names, ch_coords=ch_coords,
+                               source_file=data_fname, **attrs)
+
     psds_fname = basename + '-psds.npz'
     psds_fname = os.path.abspath(psds_fname)
     print((psds.shape))
@@ -163,14 +559,20 @@ def _save_psd(data_fname, psds, freqs):
 
 
 def _save_psd_img(data_fname, psds, freqs, is_epoched=False, method=''):
-    import matplotlib.pyplot as plt
+    """Save the mean and std over channels of the psd in dB as .png.
+
+    The figure is created without pyplot, so that it is not kept by the
+    pyplot state machine of long running processes.
+    """
+    from matplotlib.figure import Figure
 
     data_path, basename, ext = split_filename(data_fname)
     psds_img_fname = basename + '-psds.png'
     psds_img_fname = os.path.abspath(psds_img_fname)
 
     # save PSD as img
-    f, ax = plt.subplots()
+    f = Figure()
+    ax = f.subplots()
     psds = 10 * np.log10(psds)
     if is_epoched:
         psds_mean = psds.mean(0).mean(0)
@@ -186,4 +588,27 @@ def _save_psd_img(data_fname, psds, freqs, is_epoched=False, method=''):
            ylabel='Power Spectral Density (dB)')
 
     print(('*** save {} ***'.format(psds_img_fname)))
-    plt.savefig(psds_img_fname)
+    f.savefig(psds_img_fname)
+
+    return psds_img_fname
+
+
+def _plot_psd_file(psds_file, is_epoched=False, method=''):
+    """Save the image of the psd of a -psds.npz file or container.
+
+    This allows plotting the psds after the fact, e.g. only for some of
+    the subjects of a batch run.
+    """
+    _, basename, _ = split_filename(psds_file)
+    if basename.endswith('-psds'):
+        basename = basename[:-len('-psds')]
+
+    if _is_container(psds_file):
+        container = read_container(psds_file, mmap=False)
+        psds, freqs = container['data'], container['freqs']
+        method = container['attrs'].get('method', method)
+    else:
+        with np.load(psds_file) as npzfile:
+            psds, freqs = npzfile['psds'], npzfile['freqs']
+
+    return _save_psd_img(basename, psds, freqs, is_epoched, method)
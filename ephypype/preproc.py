@@ -12,7 +12,7 @@ import glob
 import os.path as op
 
 from mne import pick_types, read_epochs, Epochs, read_events, find_events
-from mne import write_evokeds, set_bipolar_reference
+from mne import write_evokeds, read_evokeds, set_bipolar_reference
 from mne.io import read_raw_fif, read_raw_brainvision, read_raw_eeglab
 from mne.preprocessing import ICA
 from mne.preprocessing import create_ecg_epochs, create_eog_epochs
@@ -22,12 +22,12 @@ from mne.channels import read_custom_montage, make_standard_montage
 
 from nipype.utils.filemanip import split_filename
 
+from .fif2array import _save_raw_array
 
-def _preprocess_fif(
-        fif_file, data_type='fif', l_freq=None, h_freq=None, down_sfreq=None,
-        montage=None, misc=None, eog_ch=None, ecg_ch=None, ch_new_names=None,
-        bipolar=None):
-    """Filter and downsample data."""
+
+def _read_raw(fif_file, data_type='fif', montage=None, misc=None,
+              eog_ch=None, ecg_ch=None, ch_new_names=None, bipolar=None):
+    """Read raw data and set the EEG montage and channel types."""
     _, basename, ext = split_filename(fif_file)
 
     if data_type == 'fif':
@@ -73,6 +73,14 @@ def _preprocess_fif(
             except:
                 pass
 
+    return raw, basename, ext
+
+
+def _filter_raw(raw, l_freq=None, h_freq=None, down_sfreq=None):
+    """Filter and downsample raw data in place.
+
+    Returns the suffix of the preprocessed file name.
+    """
     filt_str, down_str = '', ''
 
 #    select_sensors = pick_types(raw.info, meg=True, ref_meg=False, eeg=False)
@@ -86,14 +94,36 @@ def _preprocess_fif(
         raw.resample(sfreq=down_sfreq, npad=0)
         down_str = '_dsamp'
 
-    savename = os.path.abspath(basename + filt_str + down_str + ext)
+    return filt_str + down_str
+
+
+def _preprocess_fif(
+        fif_file, data_type='fif', l_freq=None, h_freq=None, down_sfreq=None,
+        montage=None, misc=None, eog_ch=None, ecg_ch=None, ch_new_names=None,
+        bipolar=None):
+    """Filter and downsample data."""
+    raw, basename, ext = _read_raw(
+        fif_file, data_type, montage=montage, misc=misc, eog_ch=eog_ch,
+        ecg_ch=ecg_ch, ch_new_names=ch_new_names, bipolar=bipolar)
+
+    suffix = _filter_raw(raw, l_freq=l_freq, h_freq=h_freq,
+                         down_sfreq=down_sfreq)
+
+    savename = os.path.abspath(basename + suffix + ext)
     raw.save(savename)
     return savename
 
 
 def _compute_ica(fif_file, raw_fif_file, data_type,
-                 ecg_ch_name, eog_ch_name, n_components, reject):
-    """Compute ica solution."""
+                 ecg_ch_name, eog_ch_name, n_components, reject,
+                 method='fastica', decim=None, fit_tmax=None,
+                 fit_annotations=None, n_jobs=1, make_report=True,
+                 fast_report=False):
+    """Compute ica solution.
+
+    See _fit_ica for the ICA fit parameters. If make_report is False, the
+    report can be generated later with _generate_ica_report.
+    """
     subj_path, basename, ext = split_filename(fif_file)
     try:
         raw = read_raw_fif(fif_file, preload=True)
@@ -102,6 +132,35 @@ def _compute_ica(fif_file, raw_fif_file, data_type,
         raw = read_epochs(fif_file)
         orig_raw = read_epochs(raw_fif_file)
 
+    ica = _fit_ica(raw, orig_raw, data_type, n_components, reject,
+                   method=method, decim=decim, fit_tmax=fit_tmax,
+                   fit_annotations=fit_annotations, n_jobs=n_jobs)
+    del orig_raw
+    ica_ts_file, report_file, ica_scores_file, ica_evoked_file = \
+        _find_ica_artifacts(raw, ica, fif_file, basename, ecg_ch_name,
+                            eog_ch_name, make_report=make_report,
+                            fast_report=fast_report)
+
+    ica_sol_file = os.path.abspath(basename + '_ica_solution.fif')
+    ica.save(ica_sol_file)
+    raw_ica = ica.apply(raw)
+    raw_ica_file = os.path.abspath(basename + '_ica' + ext)
+    raw_ica.save(raw_ica_file, overwrite=True)
+
+    return (raw_ica_file, ica_sol_file, ica_ts_file, report_file,
+            ica_scores_file, ica_evoked_file)
+
+
+def _fit_ica(raw, orig_raw, data_type, n_components, reject,
+             method='fastica', decim=None, fit_tmax=None,
+             fit_annotations=None, n_jobs=1):
+    """Fit ICA on the sensors of raw, using orig_raw data.
+
+    orig_raw is filtered in place at 1 Hz before fitting the ICA. To speed
+    up the fit, ICA can be fitted on the first fit_tmax seconds or on the
+    segments annotated with the descriptions fit_annotations, taking one
+    sample every decim samples.
+    """
     # select sensors
     if data_type == 'eeg':
         select_sensors = pick_types(raw.info, eeg=True, exclude='bads')
@@ -110,27 +169,56 @@ def _compute_ica(fif_file, raw_fif_file, data_type,
         select_sensors = pick_types(
             raw.info, meg=True, ref_meg=False, exclude='bads')
 
+    # select the fit segments before filtering, so that only them are
+    # filtered
+    if isinstance(orig_raw, mne.io.BaseRaw):
+        if fit_annotations:
+            orig_raw = mne.concatenate_raws(orig_raw.crop_by_annotations(
+                [annot for annot in orig_raw.annotations
+                 if annot['description'] in fit_annotations]))
+        if fit_tmax is not None and fit_tmax < orig_raw.times[-1]:
+            orig_raw.crop(tmax=fit_tmax)
+
     # 1) Fit ICA model using the FastICA algorithm
-    # Other available choices are `infomax` or `extended-infomax`
+    # Other available choices are `picard`, `infomax` or `extended-infomax`
     # We pass a float value between 0 and 1 to select n_components based on the
     # percentage of variance explained by the PCA components.
-    orig_raw.filter(l_freq=1., h_freq=None)
+    orig_raw.filter(l_freq=1., h_freq=None, picks=select_sensors,
+                    n_jobs=n_jobs)
 
     flat = dict(mag=1e-13, grad=1e-13)
 
     if n_components > 1:
         n_components = int(n_components)
-    ica = ICA(n_components=n_components, method='fastica', max_iter='auto',
-              random_state=0)
+    if method == 'extended-infomax':
+        method, fit_params = 'infomax', dict(extended=True)
+    else:
+        fit_params = None
+    ica = ICA(n_components=n_components, method=method, max_iter='auto',
+              fit_params=fit_params, random_state=0)
     ica.fit(
-        orig_raw, picks=select_sensors, reject=reject,
+        orig_raw, picks=select_sensors, reject=reject, decim=decim,
         flat=flat, reject_by_annotation=True)
-    del orig_raw
+
+    return ica
+
+
+def _find_ica_artifacts(raw, ica, fif_file, basename, ecg_ch_name,
+                        eog_ch_name, save_ica_ts=True, make_report=True,
+                        fast_report=False):
+    """Exclude the ICA components related to ECG/EOG and make a report.
+
+    The artifact scores and the ECG/EOG evoked are saved, so that the
+    report can also be generated later by _generate_ica_report.
+    """
     # -------------------- Save ica timeseries ---------------------------- #
-    ica_ts_file = os.path.abspath(basename + "_ica-tseries.fif")
-    ica_src = ica.get_sources(raw)
-    ica_src.save(ica_ts_file, overwrite=True)
-    ica_src = None
+    if save_ica_ts or make_report:
+        ica_src = ica.get_sources(raw)
+    if save_ica_ts:
+        ica_ts_file = os.path.abspath(basename + "_ica-tseries.fif")
+        ica_src.save(ica_ts_file, overwrite=True)
+    else:
+        ica_ts_file = None
     # --------------------------------------------------------------------- #
 
     # 2) identify bad components by analyzing latent sources.
@@ -140,6 +228,10 @@ def _compute_ica(fif_file, raw_fif_file, data_type,
     n_max_ecg = 3
     n_max_eog = 3
 
+    # sensors used to fit ICA
+    select_sensors = mne.pick_channels(raw.info['ch_names'], ica.ch_names,
+                                       ordered=True)
+
     # check if ecg_ch_name is in the raw channels
     if ecg_ch_name in raw.info['ch_names']:
         raw.set_channel_types({ecg_ch_name: 'ecg'})
@@ -189,24 +281,162 @@ def _compute_ica(fif_file, raw_fif_file, data_type,
         print('*** NO EOG CHANNELS FOUND!!! ***')
         eog_inds = eog_scores = eog_evoked = None
 
-    report_file = _generate_report(raw=raw, ica=ica, subj_name=fif_file,
+    ica_scores_file, ica_evoked_file = _save_ica_artifacts(
+        basename, ecg_evoked, ecg_scores, ecg_inds, eog_evoked, eog_scores,
+        eog_inds)
+
+    if make_report:
+        report_file = _generate_report(ica=ica, ica_src=ica_src,
+                                       basename=basename,
+                                       ecg_evoked=ecg_evoked,
+                                       ecg_scores=ecg_scores,
+                                       ecg_inds=ecg_inds,
+                                       eog_evoked=eog_evoked,
+                                       eog_scores=eog_scores,
+                                       eog_inds=eog_inds,
+                                       fast=fast_report)
+        report_file = os.path.abspath(report_file)
+    else:
+        report_file = None
+
+    return ica_ts_file, report_file, ica_scores_file, ica_evoked_file
+
+
+def _save_ica_artifacts(basename, ecg_evoked, ecg_scores, ecg_inds,
+                        eog_evoked, eog_scores, eog_inds):
+    """Save the ECG/EOG scores in .npz file and evoked in -ave.fif file."""
+    ica_scores_file = os.path.abspath(basename + '_ica-scores.npz')
+    np.savez(ica_scores_file, ecg_scores=np.asarray(ecg_scores),
+             ecg_inds=np.asarray(ecg_inds, dtype=int),
+             has_eog=eog_scores is not None,
+             eog_scores=np.asarray(eog_scores if eog_scores is not None
+                                   else []),
+             eog_inds=np.asarray(eog_inds if eog_inds is not None else [],
+                                 dtype=int))
+
+    evokeds = list()
+    for comment, evoked in [('ECG', ecg_evoked), ('EOG', eog_evoked)]:
+        if isinstance(evoked, mne.Evoked):
+            evoked.comment = comment
+            evokeds.append(evoked)
+    if evokeds:
+        ica_evoked_file = os.path.abspath(basename + '_ica-artifacts-ave.fif')
+        write_evokeds(ica_evoked_file, evokeds, overwrite=True)
+    else:
+        ica_evoked_file = None
+
+    return ica_scores_file, ica_evoked_file
+
+
+def _generate_ica_report(ica_sol_file, ica_ts_file, ica_scores_file=None,
+                         ica_evoked_file=None, fast=True, tmax=None):
+    """Generate the report of a saved ica solution.
+
+    Only the time span plotted is read from the ICs time series file. If
+    the scores and evoked files saved with the ica solution are given, the
+    ECG/EOG sections of the report are also generated.
+    """
+    from mne.preprocessing import read_ica
+
+    _, basename, _ = split_filename(ica_sol_file)
+    basename = basename.replace('_ica_solution', '')
+
+    ica = read_ica(ica_sol_file)
+    ica_src = read_raw_fif(ica_ts_file, preload=not fast)
+
+    ecg_evoked = eog_evoked = None
+    ecg_scores, ecg_inds = [], []
+    eog_scores = eog_inds = None
+    if ica_scores_file:
+        with np.load(ica_scores_file) as scores:
+            ecg_scores, ecg_inds = scores['ecg_scores'], scores['ecg_inds']
+            if scores['has_eog']:
+                eog_scores = scores['eog_scores']
+                eog_inds = list(scores['eog_inds'])
+    if ica_evoked_file:
+        for evoked in read_evokeds(ica_evoked_file):
+            if evoked.comment == 'ECG':
+                ecg_evoked = evoked
+            elif evoked.comment == 'EOG':
+                eog_evoked = evoked
+
+    if ecg_evoked is None:
+        ecg_scores = []
+    if eog_evoked is None:
+        eog_scores = None
+
+    report_file = _generate_report(ica=ica, ica_src=ica_src,
                                    basename=basename,
                                    ecg_evoked=ecg_evoked,
                                    ecg_scores=ecg_scores,
-                                   ecg_inds=ecg_inds,
-                                   ecg_ch_name=ecg_ch_name,
+                                   ecg_inds=list(ecg_inds),
                                    eog_evoked=eog_evoked,
                                    eog_scores=eog_scores,
                                    eog_inds=eog_inds,
-                                   eog_ch_name=eog_ch_name)
-    report_file = os.path.abspath(report_file)
+                                   fast=fast, tmax=tmax)
+
+    return os.path.abspath(report_file)
+
+
+def _preprocess_ica_fif_to_ts(
+        fif_file, data_type='fif', l_freq=None, h_freq=None, down_sfreq=None,
+        ecg_ch_name='', eog_ch_name=[], n_components=0.95, reject=None,
+        montage=None, misc=None, ch_new_names=None, bipolar=None,
+        save_fif=False, save_ica_ts=False, method='fastica', decim=None,
+        fit_tmax=None, fit_annotations=None, n_jobs=1, make_report=True,
+        fast_report=False):
+    """Filter, downsample, clean with ICA and export raw data to array.
+
+    Same as _preprocess_fif, _compute_ica and _get_raw_array in a row, but
+    the raw data are read once and kept in memory: the ICA is fitted on a
+    1 Hz high-pass filtered copy of the original data and the cleaned data
+    are only saved as .npy array (and as .fif file if save_fif is True).
+    See _fit_ica for the ICA fit parameters.
+    """
+    raw, basename, ext = _read_raw(
+        fif_file, data_type, montage=montage, misc=misc, eog_ch=eog_ch_name,
+        ecg_ch=ecg_ch_name, ch_new_names=ch_new_names, bipolar=bipolar)
+
+    # as in the pipeline, ICA is fitted on the original MEG data and on the
+    # preprocessed EEG data
+    if data_type != 'eeg':
+        orig_raw = raw.copy()
+    basename += _filter_raw(raw, l_freq=l_freq, h_freq=h_freq,
+                            down_sfreq=down_sfreq)
+    if data_type == 'eeg':
+        orig_raw = raw.copy()
+
+    ica = _fit_ica(raw, orig_raw, data_type, n_components, reject,
+                   method=method, decim=decim, fit_tmax=fit_tmax,
+                   fit_annotations=fit_annotations, n_jobs=n_jobs)
+    del orig_raw
+    ica_ts_file, report_file, ica_scores_file, ica_evoked_file = \
+        _find_ica_artifacts(raw, ica, fif_file, basename, ecg_ch_name,
+                            eog_ch_name, save_ica_ts=save_ica_ts,
+                            make_report=make_report,
+                            fast_report=fast_report)
+
     ica_sol_file = os.path.abspath(basename + '_ica_solution.fif')
-    ica.save(ica_sol_file)
-    raw_ica = ica.apply(raw)
-    raw_ica_file = os.path.abspath(basename + '_ica' + ext)
-    raw_ica.save(raw_ica_file, overwrite=True)
+    ica.save(ica_sol_file, overwrite=True)
+    ica.apply(raw)
+
+    if save_fif:
+        raw_ica_file = os.path.abspath(basename + '_ica' + ext)
+        raw.save(raw_ica_file, overwrite=True)
+    else:
+        raw_ica_file = None
+
+    if data_type == 'eeg':
+        select_sensors = pick_types(raw.info, eeg=True, exclude='bads')
+    else:
+        select_sensors = None
+    array_file, channel_coords_file, channel_names_file, sfreq = \
+        _save_raw_array(raw, basename + '_ica',
+                        select_sensors=select_sensors)
 
-    return raw_ica_file, ica_sol_file, ica_ts_file, report_file
+    return (array_file, channel_coords_file, channel_names_file, sfreq,
+            ica_sol_file, ica_ts_file, report_file, raw_ica_file,
+            ica_scores_file, ica_evoked_file)
 
 
 def _preprocess_set_ica_comp_fif_to_ts(fif_file, subject_id, n_comp_exclude,
@@ -361,17 +591,71 @@ def _create_reject_dict(raw_info, data_type='meg'):
     return reject
 
 
-def _generate_report(raw, ica, subj_name, basename,
-                     ecg_evoked, ecg_scores, ecg_inds, ecg_ch_name,
-                     eog_evoked, eog_scores, eog_inds, eog_ch_name):
-    """Generate report for ica solution."""
+def _plot_ic_sources(ica_src, picks, tmin=0., tmax=None, fast=False,
+                     title=None, n_points=1000):
+    """Plot the time series of the ICs of ica_src between tmin and tmax.
+
+    If fast is True, the time series are decimated to about n_points
+    samples and plotted in a static figure instead of the raw browser.
+    """
+    import matplotlib.pyplot as plt
+
+    if tmax is None or tmax > ica_src.times[-1]:
+        tmax = ica_src.times[-1]
+
+    if not fast:
+        return ica_src.plot(picks=picks, start=tmin, duration=tmax - tmin,
+                            n_channels=len(picks), title=title,
+                            show=False)
+
+    start, stop = ica_src.time_as_index([tmin, tmax])
+    step = max((stop - start) // n_points, 1)
+    data = ica_src.get_data(picks, start=start, stop=stop)[:, ::step]
+    times = ica_src.times[start:stop:step]
+
+    fig, axes = plt.subplots(len(picks), 1, sharex=True, squeeze=False,
+                             figsize=(8, 0.6 * len(picks) + 1))
+    for ax, pick, ts in zip(axes[:, 0], picks, data):
+        ax.plot(times, ts, color='k', linewidth=0.5)
+        ax.set_yticks([])
+        ax.set_ylabel(ica_src.ch_names[pick], rotation=0, ha='right')
+    axes[-1, 0].set_xlabel('Time (s)')
+    if title is not None:
+        fig.suptitle(title)
+
+    return fig
+
+
+def _add_figures(report, figs, titles, section):
+    """Add the figures to the report and close them."""
     import matplotlib.pyplot as plt
 
+    for fig, title in zip(figs, titles):
+        print(title)
+        report.add_figure(fig, title=title, section=section)
+        for f in (fig if isinstance(fig, list) else [fig]):
+            plt.close(f)
+
+
+def _generate_report(ica, ica_src, basename,
+                     ecg_evoked, ecg_scores, ecg_inds,
+                     eog_evoked, eog_scores, eog_inds,
+                     fast=False, tmax=None):
+    """Generate report for ica solution.
+
+    The time series are plotted from ica_src, the ICs time series. If fast
+    is True, the time series are decimated thumbnails of the first tmax
+    seconds (30 s by default) and the topographies have a lower resolution.
+    """
     report = Report()
 
     ica_title = 'Sources related to %s artifacts (red)'
     is_show = False
 
+    res = 32 if fast else 64
+    if fast and tmax is None:
+        tmax = 30.
+
     # ------------------- Generate report for ECG ------------------------ #
     if len(ecg_scores) > 0:
         fig_ecg_scores = ica.plot_scores(ecg_scores,
@@ -383,13 +667,13 @@ def _generate_report(raw, ica, subj_name, basename,
         show_picks = np.abs(ecg_scores).argsort()[::-1][:5]
 
         # Plot estimated latent sources given the unmixing matrix.
-        fig_ecg_ts = ica.plot_sources(raw, show_picks,
-                                      title=ica_title % 'ecg' + ' in 30s',
-                                      start=0, stop=30, show=is_show)
+        fig_ecg_ts = _plot_ic_sources(ica_src, show_picks, tmin=0,
+                                      tmax=30, fast=fast,
+                                      title=ica_title % 'ecg' + ' in 30s')
 
         # topoplot of unmixing matrix columns
         fig_ecg_comp = ica.plot_components(show_picks,
-                                           title=ica_title % 'ecg',
+                                           title=ica_title % 'ecg', res=res,
                                            colorbar=True, show=is_show)
 
         # plot ECG sources + selection
@@ -399,22 +683,17 @@ def _generate_report(raw, ica, subj_name, basename,
                   'Time Series plots of ICs (ECG)',
                   'TopoMap of ICs (ECG)',
                   'Time-locked ECG sources']
-        for fig, title in zip(figs, titles):
-            print(title)
-            report.add_figure(fig,
-                              title=title,
-                              section='ICA - ECG')
+        _add_figures(report, figs, titles, section='ICA - ECG')
     # -------------------- end generate report for ECG ---------------------- #
 
     # -------------------------- Generate report for EoG -------------------- #
     # check how many EoG ch we have
-    if set(eog_ch_name).issubset(set(raw.info['ch_names'])) and eog_ch_name:
+    if eog_scores is not None:
         fig_eog_scores = ica.plot_scores(eog_scores, exclude=eog_inds,
                                          title=ica_title % 'eog', show=is_show)
 
-        report.add_figure(fig_eog_scores,
-                          title='Scores of ICs related to EOG',
-                          section='ICA - EOG')
+        _add_figures(report, [fig_eog_scores],
+                     ['Scores of ICs related to EOG'], section='ICA - EOG')
 
         n_eogs = np.shape(eog_scores)
         if len(n_eogs) > 1:
@@ -424,38 +703,36 @@ def _generate_report(raw, ica, subj_name, basename,
             for i in range(n_eog0):
                 fig_eog_comp = ica.plot_components(show_picks[i][:],
                                                    title=ica_title % 'eog',
-                                                   colorbar=True, show=is_show)
+                                                   res=res, colorbar=True,
+                                                   show=is_show)
 
-                fig = [fig_eog_comp]
-                report.add_figure(fig,
-                                  title='Scores of EoG ICs',
-                                  section='ICA - EOG')
+                _add_figures(report, [fig_eog_comp], ['Scores of EoG ICs'],
+                             section='ICA - EOG')
         else:
             show_picks = np.abs(eog_scores).argsort()[::-1][:5]
             fig_eog_comp = ica.plot_components(show_picks,
                                                title=ica_title % 'eog',
-                                               colorbar=True, show=is_show)
+                                               res=res, colorbar=True,
+                                               show=is_show)
 
-            fig = [fig_eog_comp]
-            report.add_figure(fig, title='TopoMap of ICs (EOG)',
-                                       section='ICA - EOG')
+            _add_figures(report, [fig_eog_comp], ['TopoMap of ICs (EOG)'],
+                         section='ICA - EOG')
 
         fig_eog_src = ica.plot_sources(eog_evoked,
                                        show=is_show)
 
-        fig = [fig_eog_src]
-        report.add_figure(fig, title='Time-locked EOG sources',
-                                   section='ICA - EOG')
+        _add_figures(report, [fig_eog_src], ['Time-locked EOG sources'],
+                     section='ICA - EOG')
     # ----------------- end generate report for EoG ---------- #
     ic_nums = list(range(ica.n_components_))
-    fig = ica.plot_components(picks=ic_nums, show=False)
-    report.add_figure(fig, title='All IC topographies',
-                               section='ICA - muscles')
+    fig = ica.plot_components(picks=ic_nums, res=res, show=False)
+    _add_figures(report, [fig], ['All IC topographies'],
+                 section='ICA - muscles')
 
-    fig = ica.plot_sources(raw, start=0, stop=None, show=False,
+    fig = _plot_ic_sources(ica_src, ic_nums, tmin=0, tmax=tmax, fast=fast,
                            title='All IC time series')
-    report.add_figure(fig, title='All IC time series',
-                               section='ICA - muscles')
+    _add_figures(report, [fig], ['All IC time series'],
+                 section='ICA - muscles')
 
     '''
     psds_fig = []
@@ -487,26 +764,77 @@ def _generate_report(raw, ica, subj_name, basename,
     return report_filename
 
 
-def _create_events(raw, epoch_length):
-    """Create events to split raw into epochs."""
+def _create_events(raw, epoch_length, overlap=0.):
+    """Create events to split raw into epochs.
+
+    The epochs start every epoch_length - overlap seconds.
+    """
     file_length = raw.n_times
     first_samp = raw.first_samp
     sfreq = raw.info['sfreq']
     n_samp_in_epoch = int(epoch_length * sfreq)
+    n_samp_in_stride = n_samp_in_epoch - int(overlap * sfreq)
 
-    n_epochs = int(file_length // n_samp_in_epoch)
+    if n_samp_in_stride <= 0:
+        raise ValueError('overlap {} should be smaller than the epoch '
+                         'length {}'.format(overlap, epoch_length))
 
-    events = []
-    for i_epoch in range(n_epochs):
-        events.append([first_samp + i_epoch * n_samp_in_epoch, int(0), int(0)])
-    events = np.array(events)
+    n_epochs = max((file_length - n_samp_in_epoch) // n_samp_in_stride + 1, 0)
+
+    events = np.zeros((n_epochs, 3), dtype=int)
+    events[:, 0] = first_samp + np.arange(n_epochs) * n_samp_in_stride
     return events
 
 
-def _create_epochs(fif_file, ep_length):
+def _write_epochs_npy(raw, events, n_times, picks, savename,
+                      chunk_size=100):
+    """Write the epochs of raw in a .npy file, chunk_size epochs at a time.
+
+    Only the raw segment covering the epochs of a chunk is read, so that
+    the epochs are never all in memory. As Epochs, the epochs exceeding the
+    raw data or overlapping BAD_* annotations are dropped.
+    """
+    samples = events[:, 0] - raw.first_samp
+    samples = samples[samples + n_times <= raw.n_times]
+
+    annot = raw.annotations
+    bad = np.array([descr.lower().startswith('bad')
+                    for descr in annot.description], dtype=bool)
+    if bad.any():
+        sfreq = raw.info['sfreq']
+        onsets = annot.onset[bad] - raw.first_time
+        ends = onsets + annot.duration[bad]
+        is_bad = np.any((onsets < (samples[:, np.newaxis] + n_times) / sfreq) &
+                        (ends > samples[:, np.newaxis] / sfreq), axis=1)
+        print(('*** {} epochs dropped by BAD annotations ***'.format(
+            is_bad.sum())))
+        samples = samples[~is_bad]
+
+    epochs_data = np.lib.format.open_memmap(
+        savename, mode='w+', dtype=np.float64,
+        shape=(len(samples), len(picks), n_times))
+
+    for start in range(0, len(samples), chunk_size):
+        chunk_samples = samples[start:start + chunk_size]
+        data = raw.get_data(picks, start=chunk_samples[0],
+                            stop=chunk_samples[-1] + n_times)
+        idx = (chunk_samples - chunk_samples[0])[:, np.newaxis] + \
+            np.arange(n_times)
+        epochs_data[start:start + len(chunk_samples)] = \
+            data[:, idx].transpose(1, 0, 2)
+
+    epochs_data.flush()
+    del epochs_data
+
+
+def _create_epochs(fif_file, ep_length, overlap=0., lazy=False,
+                   chunk_size=100):
     """Split raw .fif file into epochs.
 
     Splitted epochs have a length ep_length with rejection criteria.
+    If lazy is True, the epochs are written in a -epo.npy file of shape
+    (n_epochs, n_channels, n_times), chunk_size epochs at a time, instead
+    of being preloaded and saved in a -epo.fif file.
     """
     flat = None
     reject = None
@@ -514,15 +842,23 @@ def _create_epochs(fif_file, ep_length):
     raw = read_raw_fif(fif_file)
     picks = pick_types(raw.info, meg=True, ref_meg=False, eeg=False)
     if raw.times[-1] >= ep_length:
-        events = _create_events(raw, ep_length)
+        events = _create_events(raw, ep_length, overlap)
     else:
         raise Exception('File {} is too short!'.format(fif_file))
 
+    _, base, ext = split_filename(fif_file)
+    if lazy:
+        # same samples and epochs as Epochs with tmin=0 and tmax=ep_length
+        n_times = int(np.round(ep_length * raw.info['sfreq'])) + 1
+        savename = os.path.abspath(base + '-epo.npy')
+        _write_epochs_npy(raw, events, n_times, picks, savename,
+                          chunk_size=chunk_size)
+        return savename
+
     epochs = Epochs(raw, events=events, tmin=0, tmax=ep_length,
                     preload=True, picks=picks, proj=False,
                     flat=flat, reject=reject, baseline=None)
 
-    _, base, ext = split_filename(fif_file)
     savename = os.path.abspath(base + '-epo' + ext)
     epochs.save(savename, overwrite=True)
     return savename
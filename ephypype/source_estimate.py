@@ -8,45 +8,79 @@ import mne
 import numpy as np
 import os.path as op
 
+from types import GeneratorType
+
 from mne import get_volume_labels_from_src
 
-from .import_data import write_hdf5
-from .source_space import _create_MNI_label_files
+from .import_data import _HDF5Writer, write_container
+from .source_space import _create_MNI_label_files, _get_label_projection
 
 
 def _process_stc(stc, basename, sbj_id, subjects_dir, parc, forward,
-                 aseg, is_fixed, all_src_space=False, ROIs_mean=True):
-    if not isinstance(stc, list):
+                 aseg, is_fixed, all_src_space=False, ROIs_mean=True,
+                 compression=None, fwd_filename=None, kernel=None,
+                 container=False):
+    """Save the source time series of all sources and/or of the ROIs.
+
+    If kernel is not None, stc is the sensor data (an array or a list or
+    generator of arrays of shape (n_channels, n_times)) and the source time
+    series are given by the imaging kernel, kernel @ data.
+
+    If container is True, the ROI time series, the label names and
+    coordinates are saved in a single _ROI_ts.hdf5 container (see
+    write_container), whose name is returned for all the files.
+    """
+    if isinstance(stc, list):
         print('***')
-        print(('stc dim ' + str(stc.shape)))
+        print(('len stc %d' % len(stc)))
+        print('***')
+    elif isinstance(stc, GeneratorType):
+        # stcs computed one at a time, e.g. by apply_inverse_epochs with
+        # return_generator=True: the stcs are consumed in a single pass
+        print('***')
+        print('stc generator')
         print('***')
-
-        stc = [stc]
     else:
         print('***')
-        print(('len stc %d' % len(stc)))
+        print(('stc dim ' + str(stc.shape)))
         print('***')
 
+        stc = [stc]
+
     print('**************************************************************')
     print('all_src_space: {}'.format(all_src_space))
     print('ROIs_mean: {}'.format(ROIs_mean))
     print('**************************************************************')
     if all_src_space:
-        stc_data = list()
         stc_file = op.abspath(basename + '_stc.hdf5')
 
-        for i in range(len(stc)):
-            stc_data.append(stc[i].data)
+        # the stc of each epoch is appended to the file, so that the data
+        # of all epochs are never copied together in memory
+        writer = _HDF5Writer(stc_file, dataset_name='stc_data',
+                             compression=compression)
+        stc = _iter_stc_to_hdf5(stc, writer, kernel=kernel)
 
-        write_hdf5(stc_file, stc_data, dataset_name='stc_data')
+        if not ROIs_mean:
+            for _ in stc:
+                pass
 
     if ROIs_mean:
-        label_ts, labels_file, label_names_file, label_coords_file = \
-            _compute_mean_ROIs(stc, sbj_id, subjects_dir, parc,
-                               forward, aseg, is_fixed)
-
-        ts_file = op.abspath(basename + '_ROI_ts.npy')
-        np.save(ts_file, label_ts)
+        label_ts, labels = _compute_mean_ROIs(
+            stc, sbj_id, subjects_dir, parc, forward, aseg, is_fixed,
+            fwd_filename=fwd_filename, kernel=kernel, container=container)
+
+        if container:
+            ts_file = write_container(
+                basename + '_ROI_ts.hdf5', label_ts,
+                ch_names=labels['ch_names'], ch_coords=labels['ch_coords'],
+                extra={name: labels[name] for name in
+                       ('colors', 'mni_coords', 'mni_coords_index')},
+                subject=sbj_id, parc=parc)
+            labels_file = label_names_file = label_coords_file = ts_file
+        else:
+            labels_file, label_names_file, label_coords_file = labels
+            ts_file = op.abspath(basename + '_ROI_ts.npy')
+            np.save(ts_file, label_ts)
 
     else:
         ts_file = stc_file
@@ -57,8 +91,20 @@ def _process_stc(stc, basename, sbj_id, subjects_dir, parc, forward,
     return ts_file, labels_file, label_names_file, label_coords_file
 
 
+def _iter_stc_to_hdf5(stc, writer, kernel=None):
+    """Yield the stcs after appending their data to the hdf5 writer."""
+    with writer:
+        for this_stc in stc:
+            if kernel is None:
+                writer.append(this_stc.data)
+            else:
+                writer.append(kernel @ this_stc)
+            yield this_stc
+
+
 def _compute_mean_ROIs(stc, sbj_id, subjects_dir, parc,
-                       forward, aseg, is_fixed):
+                       forward, aseg, is_fixed, fwd_filename=None,
+                       kernel=None, container=False):
     # these coo are in MRI space and we have to convert them to MNI space
     labels_cortex = mne.read_labels_from_annot(sbj_id, parc=parc,
                                                subjects_dir=subjects_dir)
@@ -75,10 +121,19 @@ def _compute_mean_ROIs(stc, sbj_id, subjects_dir, parc,
     else:
         mode = 'mean'
 
-    label_ts = mne.extract_label_time_course(stc, labels_cortex, src,
-                                             mode=mode,
-                                             allow_empty=True,
-                                             return_generator=False)
+    # the label time courses are given by a sparse (n_labels, n_sources)
+    # projection, computed once and cached next to the forward solution;
+    # they are extracted as the stcs are produced, only the (n_epochs,
+    # n_labels, n_times) result is kept in memory
+    proj = _get_label_projection(labels_cortex, src, mode=mode,
+                                 sbj_id=sbj_id, parc=parc,
+                                 fwd_filename=fwd_filename)
+    if kernel is None:
+        label_ts = np.array([proj @ this_stc.data for this_stc in stc])
+    else:
+        # the kernel collapsed to the labels is applied to the sensor data
+        label_kernel = proj @ kernel
+        label_ts = np.array([label_kernel @ data for data in stc])
 
     # save results in .npy file that will be the input for spectral node
     print('\n*** SAVE ROI TS ***\n')
@@ -95,8 +150,8 @@ def _compute_mean_ROIs(stc, sbj_id, subjects_dir, parc,
     print((labels[0].pos))
     print((len(labels)))
 
-    labels_file, label_names_file, label_coords_file = \
-        _create_MNI_label_files(forward, labels_cortex, labels_aseg,
-                                sbj_id, subjects_dir)
+    # the label files, or the labels dict if container is True
+    labels = _create_MNI_label_files(forward, labels_cortex, labels_aseg,
+                                     sbj_id, subjects_dir, container=container)
 
-    return label_ts, labels_file, label_names_file, label_coords_file
+    return label_ts, labels
@@ -4,11 +4,19 @@
 #
 # License: BSD (3-clause)
 
+import os
 import mne
 import pickle
+import hashlib
+import tempfile
 import numpy as np
 import os.path as op
 
+from nipype.utils.filemanip import split_filename as split_f
+from scipy import sparse
+
+from .import_data import read_container, _is_container
+
 
 def get_roi(labels_cortex, vertno_left, vertno_right):
     """Get roi."""
@@ -147,8 +155,14 @@ def create_label_files(labels):
 
 
 def _create_MNI_label_files(fwd, labels_cortex, labels_aseg, sbj,
-                            subjects_dir):
-    """Create MNI label files."""
+                            subjects_dir, container=False):
+    """Create MNI label files.
+
+    If container is True, nothing is written: the label names (ch_names),
+    centroids (ch_coords), colors and MNI coordinates (mni_coords, split by
+    mni_coords_index) are returned in a dict, to be saved with the ROI time
+    series in a single container (see write_container).
+    """
     print(('*** n labels cortex: {} ***'.format(len(labels_cortex))))
     if labels_aseg:
         print(('*** n labels aseg: {} ***'.format(len(labels_aseg))))
@@ -181,15 +195,26 @@ def _create_MNI_label_files(fwd, labels_cortex, labels_aseg, sbj,
         roi_aseg_mni_coords = []
         roi_aseg_color = []
 
-    # ROI names
     roi_names = roi_cortex_name + roi_aseg_name
+    roi_coords = roi_cortex_mni_coords + roi_aseg_mni_coords
+    roi_colors = roi_cortex_color + roi_aseg_color
+
+    if container:
+        return dict(
+            ch_names=roi_names,
+            ch_coords=np.array([np.mean(coo, axis=0) for coo in roi_coords]),
+            colors=np.array([(np.nan,) * 4 if color is None else color
+                             for color in roi_colors], dtype=float),
+            mni_coords=np.vstack(roi_coords),
+            mni_coords_index=np.cumsum([len(coo) for coo in roi_coords]))
+
+    # ROI names
     for name in roi_names:
         label_names.append(name)
     np.savetxt(label_names_file, np.array(label_names, dtype=str),
                fmt="%s")
 
     # ROI centroids
-    roi_coords = roi_cortex_mni_coords + roi_aseg_mni_coords
     for coo in roi_coords:
         label_centroids.append(np.mean(coo, axis=0))
     np.savetxt(label_centroid_file, np.array(label_centroids, dtype=float),
@@ -200,8 +225,6 @@ def _create_MNI_label_files(fwd, labels_cortex, labels_aseg, sbj,
     np.savetxt(label_coords_file, np.array(label_coo_mni_matrix, dtype=float),
                fmt="%f %f %f")
 
-    roi_colors = roi_cortex_color + roi_aseg_color
-
     roi = dict(ROI_names=roi_names, ROI_coords=roi_coords,
                ROI_colors=roi_colors)
 
@@ -211,3 +234,150 @@ def _create_MNI_label_files(fwd, labels_cortex, labels_aseg, sbj,
         pickle.dump(roi, f)
 
     return labels_file, label_names_file, label_coords_file
+
+
+def _read_labels_file(labels_file):
+    """Read the labels saved by _create_MNI_label_files.
+
+    Returns the dict with ROI_names, ROI_coords and ROI_colors keys of the
+    pickle, also for an _ROI_ts.hdf5 container.
+    """
+    if not _is_container(labels_file):
+        with open(labels_file, 'rb') as f:
+            return pickle.load(f)
+
+    labels = read_container(labels_file, mmap=False)
+    colors = [None if np.isnan(color).any() else tuple(color.tolist())
+              for color in labels['colors']]
+    roi_coords = np.split(labels['mni_coords'],
+                          labels['mni_coords_index'][:-1])
+
+    return dict(ROI_names=labels['ch_names'], ROI_coords=roi_coords,
+                ROI_colors=colors)
+
+
+def _make_label_projection(labels, src, mode='mean'):
+    """Create the sparse matrix projecting the sources on the labels.
+
+    The time courses of the labels are given by proj @ stc.data, with the
+    same result as mne.extract_label_time_course with allow_empty=True: the
+    rows of the labels without vertices in the source space are zero and, for
+    mixed source spaces, the time courses of the volume source spaces are
+    appended after the ones of the labels.
+
+    Parameters
+    ----------
+    labels : list of Label
+        The cortical labels
+    src : SourceSpaces
+        The source space (e.g. forward['src'])
+    mode : str
+        'mean' or 'mean_flip'
+
+    Returns
+    -------
+    proj : sparse matrix, shape (n_labels, n_sources)
+        The projection matrix, in csr format
+    """
+    if mode not in ('mean', 'mean_flip'):
+        raise ValueError('mode should be "mean" or "mean_flip", got '
+                         '{}'.format(mode))
+
+    vertno = [s['vertno'] for s in src]
+    nvert = [len(vn) for vn in vertno]
+
+    rows, cols, weights = list(), list(), list()
+    for li, label in enumerate(labels):
+        sub_labels = [label.lh, label.rh] if label.hemi == 'both' else [label]
+
+        label_vertidx = list()
+        for slabel in sub_labels:
+            if slabel.hemi == 'lh':
+                this_vertno = np.intersect1d(vertno[0], slabel.vertices)
+                vertidx = np.searchsorted(vertno[0], this_vertno)
+            elif slabel.hemi == 'rh':
+                this_vertno = np.intersect1d(vertno[1], slabel.vertices)
+                vertidx = nvert[0] + np.searchsorted(vertno[1], this_vertno)
+            label_vertidx.append(vertidx)
+        label_vertidx = np.concatenate(label_vertidx)
+
+        if len(label_vertidx) == 0:
+            print('*** no vertices for label {} ***'.format(label.name))
+            continue
+
+        weight = np.full(len(label_vertidx), 1. / len(label_vertidx))
+        if mode == 'mean_flip':
+            weight *= mne.label_sign_flip(label, src[:2])
+
+        rows.append(np.full(len(label_vertidx), li))
+        cols.append(label_vertidx)
+        weights.append(weight)
+
+    # mixed source space: mean over each volume source space
+    offset = sum(nvert[:2])
+    for i, nv in enumerate(nvert[2:]):
+        if nv != 0:
+            rows.append(np.full(nv, len(labels) + i))
+            cols.append(np.arange(offset, offset + nv))
+            weights.append(np.full(nv, 1. / nv))
+            offset += nv
+
+    shape = (len(labels) + len(nvert[2:]), sum(nvert))
+    if len(rows) == 0:
+        return sparse.csr_matrix(shape)
+
+    proj = sparse.coo_matrix(
+        (np.concatenate(weights), (np.concatenate(rows),
+                                   np.concatenate(cols))), shape=shape)
+
+    return proj.tocsr()
+
+
+def _get_label_projection(labels, src, mode='mean', sbj_id=None, parc=None,
+                          fwd_filename=None):
+    """Get the label projection matrix, cached next to the forward solution.
+
+    The projection is saved in a .npz file in the directory of fwd_filename,
+    whose name depends on the subject, the parcellation, the mode and the
+    source space, so that it is computed once for all the runs using the
+    same forward solution. If fwd_filename is None the projection is not
+    cached.
+    """
+    if fwd_filename is None:
+        return _make_label_projection(labels, src, mode)
+
+    # the vertices (and the normals used by the sign flip) of the src and
+    # the labels identify the projection
+    key = hashlib.sha1()
+    key.update('{}_{}_{}'.format(sbj_id, parc, mode).encode())
+    for s in src:
+        key.update(np.ascontiguousarray(s['vertno']).tobytes())
+        if mode == 'mean_flip':
+            key.update(np.ascontiguousarray(s['nn'][s['vertno']]).tobytes())
+    for label in labels:
+        key.update(label.name.encode())
+        key.update(np.ascontiguousarray(label.vertices).tobytes())
+
+    fwd_path, fwd_basename, _ = split_f(fwd_filename)
+    proj_fname = op.join(fwd_path, '{}-{}-{}-{}-proj.npz'.format(
+        fwd_basename, parc, mode, key.hexdigest()[:12]))
+
+    if op.isfile(proj_fname):
+        print(('*** read label projection {} ***'.format(proj_fname)))
+        return sparse.load_npz(proj_fname).tocsr()
+
+    proj = _make_label_projection(labels, src, mode)
+
+    try:
+        # write in a temporary file and rename it, so that concurrent
+        # pipelines never read a partially written file
+        fd, tmp_fname = tempfile.mkstemp(dir=fwd_path, suffix='.npz')
+        os.close(fd)
+        sparse.save_npz(tmp_fname, proj)
+        os.replace(tmp_fname, proj_fname)
+        print(('*** label projection saved in {} ***'.format(proj_fname)))
+    except OSError:
+        print(('*** label projection can not be saved in {} ***'.format(
+            fwd_path)))
+
+    return proj
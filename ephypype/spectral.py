@@ -7,15 +7,29 @@
 import os
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+
+from scipy.fft import rfftfreq
 from scipy.io import savemat
 
 from nipype.utils.filemanip import split_filename
 
-from mne import read_epochs
+from mne import read_epochs, pick_types, pick_info
+from mne.time_frequency.multitaper import _mt_spectra
+from mne.time_frequency.tfr import cwt
 from mne_connectivity import spectral_connectivity_epochs
 from mne_connectivity.viz import plot_connectivity_circle
 from mne.viz import circular_layout
-from mne.time_frequency import tfr_morlet, write_tfrs
+from mne.time_frequency import write_tfrs
+
+from .aux_tools import _get_n_threads
+from .kernel_cache import _get_dpss_windows, _get_morlet_wavelets
+from .import_data import write_container, _HDF5Writer
+
+try:
+    from mne.time_frequency import AverageTFRArray
+except ImportError:  # mne < 1.7
+    from mne.time_frequency import AverageTFR as AverageTFRArray
 
 
 def _compute_spectral_connectivity(data, con_method, sfreq, fmin, fmax,
@@ -32,7 +46,14 @@ def _compute_spectral_connectivity(data, con_method, sfreq, fmin, fmax,
             raise ValueError("{} only work with epoched time series".format(
                              con_method))
 
-    if mode == 'multitaper':
+    if mode == 'multitaper' and data.shape[0] == 1 and \
+            con_method in _BATCHED_CON_METHODS:
+        # a single epoch: use the batched engine that reuses cached tapers
+        con_matrix = _compute_batched_spectral_connectivity(
+            data, con_method, sfreq, fmin, fmax,
+            gathering_method=gathering_method)[0]
+
+    elif mode == 'multitaper':
         if gathering_method == "mean":
             conn = spectral_connectivity_epochs(
                 data, method=con_method, sfreq=sfreq, fmin=fmin,
@@ -42,21 +63,22 @@ def _compute_spectral_connectivity(data, con_method, sfreq, fmin, fmax,
             con_matrix = conn.get_data(output='dense')[:, :, 0]
             print(f'************************ {con_matrix.shape}')
         elif gathering_method == "max":
-            con_matrix = spectral_connectivity_epochs(
+            conn = spectral_connectivity_epochs(
                 data, method=con_method, sfreq=sfreq, fmin=fmin,
                 fmax=fmax, faverage=False, tmin=None, mode='multitaper',
                 mt_adaptive=False, n_jobs=1)
 
-            con_matrix = np.amax(
-                conn.get_data(output='dense')[:, :, 0], axis=2)
+            con_matrix = np.amax(conn.get_data(output='dense'), axis=2)
 
         elif gathering_method == "none":
 
-            con_matrix = spectral_connectivity_epochs(
+            conn = spectral_connectivity_epochs(
                 data, method=con_method, sfreq=sfreq, fmin=fmin,
                 fmax=fmax, faverage=False, tmin=None, mode='multitaper',
                 mt_adaptive=False, n_jobs=1)
 
+            con_matrix = conn.get_data(output='dense')
+
         else:
             raise ValueError('Unknown gathering method')
 
@@ -67,7 +89,7 @@ def _compute_spectral_connectivity(data, con_method, sfreq, fmin, fmax,
 
         print(data)
 
-        con_matrix = spectral_connectivity_epochs(
+        conn = spectral_connectivity_epochs(
             data, method=con_method, sfreq=sfreq, faverage=True,
             tmin=None, mode='cwt_morlet', cwt_frequencies=frequencies,
             cwt_n_cycles=n_cycles, n_jobs=1)
@@ -83,66 +105,220 @@ def _compute_spectral_connectivity(data, con_method, sfreq, fmin, fmax,
     return con_matrix
 
 
+def _get_conmat_file(fname, save_dir=None):
+    """Return the path where a connectivity file is saved."""
+    if save_dir is not None:
+        return os.path.join(save_dir, fname)
+    else:
+        return os.path.abspath(fname)
+
+
+def _save_conmat(con_matrix, con_method, index=0, export_to_matlab=False,
+                 save_dir=None, container=False, **attrs):
+    """Save a connectivity matrix in .npy (and .mat) format.
+
+    If container is True the matrix is saved in a .hdf5 container (see
+    write_container) with attrs as provenance attributes.
+    """
+    if container:
+        conmat_file = write_container(_get_conmat_file(
+            "conmat_{}_{}.hdf5".format(index, con_method), save_dir),
+            con_matrix, con_method=con_method, **attrs)
+    else:
+        conmat_file = _get_conmat_file(
+            "conmat_{}_{}.npy".format(index, con_method), save_dir)
+
+        np.save(conmat_file, con_matrix)
+
+    if export_to_matlab:
+        conmat_matfile = _get_conmat_file(
+            "conmat_{}_{}.mat".format(index, con_method), save_dir)
+
+        savemat(conmat_matfile, {
+            "conmat": con_matrix + np.transpose(con_matrix)})
+
+    return conmat_file
+
+
 def _compute_and_save_spectral_connectivity(data, con_method, sfreq, fmin, fmax,  # noqa
                                             index=0, mode='cwt_morlet',
                                             export_to_matlab=False,
                                             gathering_method="mean",
-                                            save_dir=None):
+                                            save_dir=None, container=False):
     """Compute and save spectral connectivity."""
     con_matrix = _compute_spectral_connectivity(data, con_method, sfreq, fmin,
                                                 fmax, mode, gathering_method)
 
-    if save_dir is not None:
-        conmat_file = os.path.join(save_dir, "conmat_{}_{}.npy".format(
-            index, con_method))
-    else:
-        conmat_file = os.path.abspath("conmat_{}_{}.npy".format(
-            index, con_method))
+    conmat_file = _save_conmat(con_matrix, con_method, index=index,
+                               export_to_matlab=export_to_matlab,
+                               save_dir=save_dir, container=container,
+                               sfreq=sfreq, fmin=fmin, fmax=fmax, mode=mode)
+
+    return conmat_file
 
-    np.save(conmat_file, con_matrix)
 
-    if export_to_matlab:
+# connectivity methods that the batched multitaper engine can compute; each
+# sample is handled as a single epoch, as spectral_connectivity_epochs does
+_BATCHED_CON_METHODS = ('coh', 'cohy', 'imcoh', 'plv', 'pli', 'wpli')
+
+
+def _compute_batched_spectral_connectivity(all_data, con_method, sfreq, fmin,
+                                           fmax, gathering_method="mean",
+                                           mt_bandwidth=None, batch_size=10):
+    """Compute multitaper connectivity for all samples in a vectorized pass.
+
+    The DPSS tapers are taken from the kernel cache and the tapered FFTs of a
+    block of
+    batch_size samples are computed together. Each sample is considered as
+    a single epoch, i.e. the result for all_data[i] is the same as the one
+    of _compute_spectral_connectivity on all_data[i][np.newaxis] with
+    mode='multitaper'.
+
+    Parameters
+    ----------
+    all_data : array, shape (n_samples, n_nodes, n_times)
+        Time series of all samples
+    con_method : str
+        Connectivity measure, one of _BATCHED_CON_METHODS
+    sfreq : float
+        Sampling frequency
+    fmin, fmax : float
+        Frequency band
+    gathering_method : str
+        How to handle the values over the frequency band: "mean", "max"
+        or "none"
+    mt_bandwidth : float | None
+        The bandwidth of the multitaper windowing function in Hz
+    batch_size : int
+        Number of samples whose spectra are computed together
+
+    Returns
+    -------
+    con_matrices : array, shape (n_samples, n_nodes, n_nodes)
+        Lower triangular connectivity matrices; if gathering_method is
+        "none" the last dimension holds the frequencies,
+        i.e. (n_samples, n_nodes, n_nodes, n_freqs)
+    """
+    if con_method not in _BATCHED_CON_METHODS:
+        raise ValueError('{} is not supported by the batched engine'.format(
+            con_method))
+    if gathering_method not in ("mean", "max", "none"):
+        raise ValueError('Unknown gathering method')
+
+    n_samples, n_nodes, n_times = all_data.shape
+
+    # the tapers are the same for all samples
+    window_fun, eigvals = _get_dpss_windows(n_times, sfreq, mt_bandwidth)
+    weights = np.sqrt(eigvals)[np.newaxis, np.newaxis, :, np.newaxis]
+    norm = 2. / np.sum(eigvals)
+
+    freqs = rfftfreq(n_times, 1. / sfreq)
+    freq_mask = (freqs >= fmin) & (freqs <= fmax)
+    if not np.any(freq_mask):
+        raise ValueError('There are no frequency points between {}Hz and '
+                         '{}Hz'.format(fmin, fmax))
+
+    dtype = complex if con_method == 'cohy' else float
+    if gathering_method == "none":
+        out_shape = (n_samples, n_nodes, n_nodes, np.sum(freq_mask))
+    else:
+        out_shape = (n_samples, n_nodes, n_nodes)
+    con_matrices = np.zeros(out_shape, dtype=dtype)
+
+    tril = np.tril_indices(n_nodes, k=-1)
+
+    for start in range(0, n_samples, batch_size):
+        batch = slice(start, min(start + batch_size, n_samples))
+
+        # x_mt: (n_batch, n_nodes, n_tapers, n_freqs)
+        x_mt, _ = _mt_spectra(all_data[batch], window_fun, sfreq)
+        x_mt = x_mt[..., freq_mask] * weights
+
+        # cross spectra as one matmul over tapers: (n_batch, n_freqs, i, j)
+        x_mt = x_mt.transpose(0, 3, 1, 2)
+        csd = np.matmul(x_mt, x_mt.conj().swapaxes(-1, -2)) * norm
+
+        # keep only the lower triangular part: (n_batch, n_freqs, n_cons)
+        csd_xy = csd[..., tril[0], tril[1]]
+
+        if con_method in ('coh', 'cohy', 'imcoh'):
+            psd = np.diagonal(csd, axis1=-2, axis2=-1).real
+            psd_xy = np.sqrt(psd[..., tril[0]] * psd[..., tril[1]])
+            if con_method == 'coh':
+                con = np.abs(csd_xy) / psd_xy
+            elif con_method == 'cohy':
+                con = csd_xy / psd_xy
+            else:
+                con = np.imag(csd_xy) / psd_xy
+        elif con_method == 'plv':
+            con = np.abs(csd_xy / np.abs(csd_xy))
+        elif con_method == 'pli':
+            con = np.abs(np.sign(np.imag(csd_xy)))
+        elif con_method == 'wpli':
+            im_csd = np.abs(np.imag(csd_xy))
+            con = np.divide(im_csd, im_csd, out=np.zeros_like(im_csd),
+                            where=im_csd != 0)
 
-        if save_dir is not None:
-            conmat_matfile = os.path.join(
-                save_dir, "conmat_{}_{}.mat".format(index, con_method))
+        if gathering_method == "mean":
+            con = np.mean(con, axis=1)
+        elif gathering_method == "max":
+            con = np.amax(con, axis=1)
         else:
-            conmat_matfile = os.path.abspath(
-                "conmat_{}_{}.mat".format(index, con_method))
+            con = con.swapaxes(1, 2)
 
-        savemat(conmat_matfile, {
-            "conmat": con_matrix + np.transpose(con_matrix)})
+        con_matrices[batch, tril[0], tril[1]] = con
 
-    return conmat_file
+    return con_matrices
 
 
 def _compute_and_save_multi_spectral_connectivity(all_data, con_method, sfreq,
                                                   fmin, fmax, mode='cwt_morlet',  # noqa
                                                   export_to_matlab=False,
                                                   gathering_method="mean",
-                                                  save_dir=None):
-    """Compute and save multi-spectral connectivity."""
+                                                  save_dir=None,
+                                                  save_stack=False,
+                                                  batch_size=10,
+                                                  container=False):
+    """Compute and save multi-spectral connectivity.
+
+    In multitaper mode the connectivity matrices of all samples are computed
+    by the batched engine. Each matrix is saved in its own file; if
+    save_stack is True all matrices are also saved stacked in a single
+    conmat_stack_<con_method>.npy file of shape (n_samples, n_nodes, n_nodes).
+    If container is True the matrices (and the stack) are saved in .hdf5
+    containers instead (see write_container).
+    """
     assert len(all_data.shape) == 3, ("Error, \
         all_data should have several samples")
 
-    conmat_files = []
-
-    for i in range(all_data.shape[0]):
-
-        cur_data = all_data[i, :, :]
-
-        print((cur_data.shape))
-
-        data = cur_data.reshape(1, cur_data.shape[0], cur_data.shape[1])
-
-        print((data.shape))
-
-        conmat_file = _compute_and_save_spectral_connectivity(
-            data, con_method, sfreq, fmin, fmax, index=i,
-            mode=mode, export_to_matlab=export_to_matlab,
-            gathering_method=gathering_method, save_dir=save_dir)
-
-        conmat_files.append(conmat_file)
+    if mode == 'multitaper' and con_method in _BATCHED_CON_METHODS:
+        conmat_stack = _compute_batched_spectral_connectivity(
+            all_data, con_method, sfreq, fmin, fmax,
+            gathering_method=gathering_method, batch_size=batch_size)
+    else:
+        conmat_stack = np.array([
+            _compute_spectral_connectivity(
+                all_data[i][np.newaxis], con_method, sfreq, fmin, fmax,
+                mode, gathering_method)
+            for i in range(all_data.shape[0])])
+
+    print(conmat_stack.shape)
+
+    attrs = dict(sfreq=sfreq, fmin=fmin, fmax=fmax, mode=mode)
+    if save_stack and container:
+        write_container(_get_conmat_file(
+            "conmat_stack_{}.hdf5".format(con_method), save_dir),
+            conmat_stack, con_method=con_method, **attrs)
+    elif save_stack:
+        conmat_stack_file = _get_conmat_file(
+            "conmat_stack_{}.npy".format(con_method), save_dir)
+        np.save(conmat_stack_file, conmat_stack)
+
+    conmat_files = [
+        _save_conmat(con_matrix, con_method, index=i,
+                     export_to_matlab=export_to_matlab, save_dir=save_dir,
+                     container=container, **attrs)
+        for i, con_matrix in enumerate(conmat_stack)]
 
     return conmat_files
 
@@ -190,18 +366,97 @@ def _plot_circular_connectivity(conmat, label_names, node_colors=None,
     return plot_conmat_file
 
 
-def _compute_tfr_morlet(epo_fpath, freqs, n_cycles):
-
+def _compute_tfr_morlet(epo_fpath, freqs, n_cycles, decim=3, n_jobs=1,
+                        average=True, dtype=np.float64, chunk_size=10,
+                        compression=None):
+    """Compute and save the Morlet TFR of epochs.
+
+    Same as tfr_morlet(use_fft=True, decim=decim) but the wavelets are taken
+    from the kernel cache. The epochs are read and transformed by blocks of
+    chunk_size epochs, the blocks being computed in parallel by n_jobs
+    threads (all the CPUs if -1), so that only the TFR of n_jobs *
+    chunk_size epochs is in memory.
+
+    If average is True, the power averaged over epochs is saved in a -tfr.h5
+    file (see mne.time_frequency.write_tfrs). Otherwise the TFR of each
+    epoch is appended to the 'data' dataset, shape (n_epochs, n_channels,
+    n_freqs, n_times), of a -tfr.hdf5 container (see write_container), so
+    that the single trial TFRs are never all in memory. The TFR is the power
+    if dtype is real (e.g. np.float32) and the complex coefficients if it is
+    complex (e.g. np.complex64, single trial only).
+    """
     assert os.path.exists(epo_fpath)
 
-    epochs = read_epochs(epo_fpath)
-
-    power = tfr_morlet(epochs, freqs=freqs, n_cycles=n_cycles,
-                       use_fft=True, return_itc=False, decim=3, n_jobs=1)
+    dtype = np.dtype(dtype)
+    is_complex = np.issubdtype(dtype, np.complexfloating)
+    if is_complex and average:
+        raise ValueError('Error, the complex TFR can not be averaged, '
+                         'set average to False')
+
+    epochs = read_epochs(epo_fpath, preload=False)
+
+    picks = pick_types(epochs.info, meg=True, eeg=True, seeg=True, ecog=True,
+                       exclude='bads')
+    sfreq = epochs.info['sfreq']
+    Ws = _get_morlet_wavelets(sfreq, freqs, n_cycles=n_cycles)
+    times = epochs.times[::decim].copy()
+
+    def _compute_block_tfr(data):
+        # one cwt call on the signals of all the epochs and channels
+        tfr = cwt(data.reshape(-1, data.shape[-1]), Ws, use_fft=True,
+                  mode='same', decim=decim)
+        tfr = tfr.reshape(data.shape[:2] + tfr.shape[1:])
+        if not is_complex:
+            tfr = (tfr.real ** 2 + tfr.imag ** 2)
+        return tfr.astype(dtype, copy=False)
 
     data_path, basename, ext = split_filename(epo_fpath)
+    if average:
+        tfr_fname = os.path.abspath(basename + '-tfr.h5')
+        tfr_data = np.zeros((len(picks), len(freqs), len(times)))
+    else:
+        tfr_fname = os.path.abspath(basename + '-tfr.hdf5')
+        writer = _HDF5Writer(tfr_fname, dataset_name='data', dtype=dtype,
+                             compression=compression)
+
+    n_epochs = len(epochs)
+    n_jobs = _get_n_threads(n_jobs)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for start in range(0, n_epochs, chunk_size * n_jobs):
+            stop = min(start + chunk_size * n_jobs, n_epochs)
+            print(('*** TFR of epochs {}-{} / {} ***'.format(
+                start, stop, n_epochs)))
+
+            # the epochs are read in the main thread
+            data = epochs[start:stop].get_data(picks)
+            blocks = [data[idx:idx + chunk_size]
+                      for idx in range(0, len(data), chunk_size)]
+            for tfr in executor.map(_compute_block_tfr, blocks):
+                if average:
+                    tfr_data += tfr.sum(0)
+                else:
+                    for epoch_tfr in tfr:
+                        writer.append(epoch_tfr)
+
+    if not average:
+        writer.close()
+        info = pick_info(epochs.info, picks)
+        return write_container(
+            tfr_fname, ch_names=info['ch_names'],
+            ch_coords=np.array([ch['loc'][:3] for ch in info['chs']]),
+            freqs=np.asarray(freqs), extra=dict(times=times), mode='a',
+            method='morlet', sfreq=sfreq / decim, decim=decim,
+            n_cycles=n_cycles, source_file=epo_fpath)
+
+    info = epochs.info.copy()
+    with info._unlock():
+        info['sfreq'] = sfreq / decim
+    power = AverageTFRArray(info=pick_info(info, picks),
+                            data=(tfr_data / n_epochs).astype(dtype),
+                            times=times, freqs=freqs,
+                            nave=n_epochs, method='morlet',
+                            comment='tfr_morlet')
 
-    tfr_fname = os.path.abspath(basename + '-tfr.h5')
     print((power.data.shape))
     print(('*** save {} ***'.format(tfr_fname)))
     write_tfrs(tfr_fname, power, overwrite=True)
@@ -0,0 +1,43 @@
+"""Test aux_tools."""
+import os
+import time
+import pytest
+import os.path as op
+
+from multiprocessing import Pool
+
+from ephypype.aux_tools import _file_lock, _get_n_threads
+
+
+def _create_file(fname):
+    """Create the file if it does not exist, return True if created."""
+    with _file_lock(fname, poll_interval=0.01):
+        if op.isfile(fname):
+            return False
+        time.sleep(0.2)
+        with open(fname, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+
+
+def test_file_lock(tmpdir):
+    """Test that only one process creates a shared file."""
+    fname = str(tmpdir.join('bem-sol.fif'))
+
+    with Pool(4) as pool:
+        is_created = pool.map(_create_file, [fname] * 4)
+
+    assert sum(is_created) == 1
+    assert op.isfile(fname)
+
+
+def test_get_n_threads(monkeypatch):
+    """Test the number of threads given by n_jobs."""
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    assert _get_n_threads(None) == 1
+    assert _get_n_threads(3) == 3
+    assert _get_n_threads(-1) == 8
+    assert _get_n_threads(-3) == 6
+    assert _get_n_threads(-20) == 1
+    with pytest.raises(ValueError, match='cannot be 0'):
+        _get_n_threads(0)
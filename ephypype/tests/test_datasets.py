@@ -0,0 +1,121 @@
+"""Test datasets fetchers."""
+
+import os
+import io
+import re
+import json
+import hashlib
+import tarfile
+import threading
+
+import pytest
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from ephypype.datasets import fetch_manifest, _fetch_file
+
+
+class _RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files supporting the Range header of the requests."""
+
+    def send_head(self):
+        fname = self.translate_path(self.path)
+        match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if not os.path.isfile(fname) or match is None:
+            return super().send_head()
+
+        f = open(fname, 'rb')
+        file_size = os.path.getsize(fname)
+        start = int(match.group(1))
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+            start, file_size - 1, file_size))
+        self.send_header('Content-Length', str(file_size - start))
+        self.end_headers()
+        return f
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmpdir):
+    """Serve the files of a directory with a local HTTP server."""
+    served_dir = tmpdir.mkdir('served')
+    handler = partial(_RangeRequestHandler, directory=str(served_dir))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield served_dir, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_manifest(tmpdir, http_server):
+    """Test concurrent download, checksum and extraction of a manifest."""
+    served_dir, url = http_server
+
+    data = os.urandom(100000)
+    served_dir.join('data.bin').write_binary(data)
+
+    tar_fname = str(served_dir.join('archive.tar.gz'))
+    with tarfile.open(tar_fname, 'w:gz') as tf:
+        for name in ['sub-01/meg.dat', 'sub-02/meg.dat']:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+    with open(tar_fname, 'rb') as f:
+        tar_sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    manifest = [
+        dict(url=url + 'data.bin', fname='data.bin',
+             sha256=hashlib.sha256(data).hexdigest()),
+        dict(url=url + 'archive.tar.gz', fname='archive.tar.gz',
+             sha256=tar_sha256, extract_dir='dataset')]
+    manifest_fname = str(tmpdir.join('manifest.json'))
+    with open(manifest_fname, 'w') as f:
+        json.dump(manifest, f)
+
+    base_path = tmpdir.mkdir('data')
+    paths = fetch_manifest(manifest_fname, str(base_path), n_jobs=2)
+
+    assert paths == [str(base_path.join('data.bin')),
+                     str(base_path.join('dataset'))]
+    assert base_path.join('data.bin').read_binary() == data
+    assert base_path.join('dataset', 'sub-02', 'meg.dat').read_binary() == \
+        data
+    assert not base_path.join('archive.tar.gz').check()
+
+    # checksum mismatch
+    manifest[0]['sha256'] = hashlib.sha256(b'').hexdigest()
+    base_path.join('data.bin').remove()
+    with pytest.raises(RuntimeError, match='checksum'):
+        fetch_manifest(manifest[:1], str(base_path))
+
+
+def test_fetch_file_resume(tmpdir, http_server):
+    """Test resuming a partial download with a range request."""
+    served_dir, url = http_server
+
+    data = os.urandom(100000)
+    served_dir.join('data.bin').write_binary(data)
+
+    file_name = str(tmpdir.join('data.bin'))
+    tmpdir.join('data.bin.part').write_binary(data[:30000])
+
+    _fetch_file(url + 'data.bin', file_name,
+                sha256=hashlib.sha256(data).hexdigest())
+    assert tmpdir.join('data.bin').read_binary() == data
+
+    # a corrupted partial file is downloaded again from scratch
+    tmpdir.join('data.bin').remove()
+    tmpdir.join('data.bin.part').write_binary(b'0' * 30000)
+    _fetch_file(url + 'data.bin', file_name,
+                sha256=hashlib.sha256(data).hexdigest())
+    assert tmpdir.join('data.bin').read_binary() == data
@@ -0,0 +1,64 @@
+"""Test fixed-length epoching."""
+import mne
+import numpy as np
+
+from ephypype.preproc import _create_events, _create_epochs
+
+
+def _make_raw_fname(tmpdir):
+    """Save a raw file of random MEG and EEG data."""
+    info = mne.create_info(['MEG001', 'MEG002', 'MEG003', 'EEG001'], 100.,
+                           ['mag', 'mag', 'mag', 'eeg'])
+    data = np.random.RandomState(0).randn(4, 1234) * 1e-12
+    raw = mne.io.RawArray(data, info, first_samp=17)
+
+    raw_fname = str(tmpdir.join('test_raw.fif'))
+    raw.save(raw_fname)
+    return raw_fname
+
+
+def test_create_events(tmpdir):
+    """Test events of fixed-length epochs."""
+    raw = mne.io.read_raw_fif(_make_raw_fname(tmpdir))
+
+    events = _create_events(raw, 2.5)
+    assert events.shape == (4, 3)
+    np.testing.assert_array_equal(events[:, 0], 17 + 250 * np.arange(4))
+    assert not np.any(events[:, 1:])
+
+    events = _create_events(raw, 2., overlap=1.5)
+    assert events.shape == (21, 3)
+    np.testing.assert_array_equal(events[:2, 0], [17, 67])
+
+
+def test_create_epochs_lazy(tmpdir):
+    """Test lazy epoching gives the same epochs as mne.Epochs."""
+    raw_fname = _make_raw_fname(tmpdir)
+
+    with tmpdir.as_cwd():
+        epo_fname = _create_epochs(raw_fname, 1., overlap=0.5)
+        epo_ts_fname = _create_epochs(raw_fname, 1., overlap=0.5, lazy=True,
+                                      chunk_size=4)
+
+    epochs_data = mne.read_epochs(epo_fname).get_data()
+    lazy_epochs_data = np.load(epo_ts_fname)
+    assert lazy_epochs_data.shape == (23, 3, 101)
+    np.testing.assert_allclose(lazy_epochs_data, epochs_data)
+
+
+def test_create_epochs_lazy_annotations(tmpdir):
+    """Test lazy epoching drops the epochs overlapping BAD annotations."""
+    raw = mne.io.read_raw_fif(_make_raw_fname(tmpdir))
+    raw.set_annotations(mne.Annotations(
+        [2.3, 7., 9.5], [1.1, 0.5, 0.], ['BAD_segment', 'good', 'bad blink'],
+        orig_time=raw.annotations.orig_time))
+    raw_fname = str(tmpdir.join('test_annot_raw.fif'))
+    raw.save(raw_fname)
+
+    with tmpdir.as_cwd():
+        epo_fname = _create_epochs(raw_fname, 1.)
+        epo_ts_fname = _create_epochs(raw_fname, 1., lazy=True, chunk_size=3)
+
+    epochs = mne.read_epochs(epo_fname)
+    assert len(epochs) == 9
+    np.testing.assert_allclose(np.load(epo_ts_fname), epochs.get_data())
@@ -0,0 +1,253 @@
+"""Test inverse solution of raw and epoched data."""
+import os
+import mne
+import numpy as np
+import pytest
+
+from mne.source_space import SourceSpaces
+
+from ephypype import compute_inv_problem
+from ephypype.compute_inv_problem import (_get_inv_key, _get_inverse_operator,
+                                          _compute_inverse_solution,
+                                          _make_inverse_kernel)
+
+
+def _make_subject(tmpdir, n_vertices=(60, 50)):
+    """Create a synthetic subject with surfaces, parcellation and MRI."""
+    import nibabel as nib
+
+    subjects_dir = tmpdir.mkdir('subjects')
+    subject_dir = subjects_dir.mkdir('sample')
+    surf_dir = subject_dir.mkdir('surf')
+    rng = np.random.RandomState(0)
+
+    src = list()
+    for hemi, hemi_id, n_vert, x in zip(('lh', 'rh'), (101, 102), n_vertices,
+                                        (-0.03, 0.03)):
+        rr = rng.randn(n_vert, 3) * 0.01 + [x, 0., 0.04]
+        nn = rng.randn(n_vert, 3)
+        nn /= np.linalg.norm(nn, axis=1)[:, np.newaxis]
+        tris = np.array([[0, 1, 2]])
+        mne.write_surface(str(surf_dir.join('{}.white'.format(hemi))),
+                          rr * 1000., tris)
+
+        vertno = np.arange(0, n_vert, 2)
+        inuse = np.zeros(n_vert, int)
+        inuse[vertno] = 1
+        src.append(dict(
+            type='surf', id=hemi_id, vertno=vertno, nn=nn, np=n_vert,
+            rr=rr, nuse=len(vertno), inuse=inuse, coord_frame=5, tris=tris,
+            ntri=1, use_tris=None, nuse_tri=0, subject_his_id='sample',
+            dist=None, dist_limit=None, nearest=None, nearest_dist=None,
+            patch_inds=None, pinfo=None))
+
+    labels = list()
+    for hemi, n_vert in zip(('lh', 'rh'), n_vertices):
+        for name, vertices in (('a', np.arange(0, n_vert // 2)),
+                               ('b', np.arange(n_vert // 2, n_vert))):
+            labels.append(mne.Label(vertices, hemi=hemi,
+                                    name='{}-{}'.format(name, hemi),
+                                    color=rng.rand(4)))
+    subject_dir.mkdir('label')
+    mne.write_labels_to_annot(labels, 'sample', 'aparc',
+                              subjects_dir=str(subjects_dir))
+
+    mri_dir = subject_dir.mkdir('mri')
+    nib.save(nib.MGHImage(np.zeros((8, 8, 8), np.uint8), np.eye(4)),
+             str(mri_dir.join('orig.mgz')))
+    mri_dir.mkdir('transforms').join('talairach.xfm').write(
+        'MNI Transform File\n\nTransform_Type = Linear;\nLinear_Transform =\n'
+        '1 0 0 0\n0 1 0 0\n0 0 1 0;\n')
+
+    return SourceSpaces(src), str(subjects_dir)
+
+
+def _make_inv_data(tmpdir):
+    """Save EEG raw data, forward solution and noise covariance."""
+    montage = mne.channels.make_standard_montage('standard_1020')
+    info = mne.create_info(montage.ch_names[:40], 200., 'eeg')
+    info.set_montage(montage)
+    raw = mne.io.RawArray(
+        np.random.RandomState(0).randn(40, 200 * 10) * 1e-6, info)
+    raw.set_eeg_reference(projection=True)
+    raw_fname = str(tmpdir.join('sample_raw.fif'))
+    raw.save(raw_fname)
+
+    src, subjects_dir = _make_subject(tmpdir)
+    sphere = mne.make_sphere_model('auto', 'auto', raw.info, verbose=False)
+    fwd = mne.make_forward_solution(raw.info, None, src, sphere,
+                                    verbose=False)
+    fwd_fname = str(tmpdir.mkdir('fwd').join('sample-fwd.fif'))
+    mne.write_forward_solution(fwd_fname, fwd)
+
+    cov_fname = str(tmpdir.join('sample-cov.fif'))
+    mne.make_ad_hoc_cov(raw.info).save(cov_fname)
+
+    return raw, raw_fname, fwd_fname, cov_fname, subjects_dir
+
+
+def test_get_inverse_operator_cache(tmpdir, monkeypatch):
+    """Test the inverse operators cached by key."""
+    raw, _, fwd_fname, cov_fname, _ = _make_inv_data(tmpdir)
+    fwd = mne.read_forward_solution(fwd_fname)
+    cov = mne.read_cov(cov_fname)
+    inv_kwargs = dict(loose=0.2, depth=0.8, fixed=False)
+    cache_dir = tmpdir.mkdir('cache')
+
+    # no cache by default
+    inv_fname = str(tmpdir.join('sample-inv.fif'))
+    inv = _get_inverse_operator(inv_fname, raw.info, fwd, cov, fwd_fname,
+                                cov_fname, **inv_kwargs)
+    assert os.path.isfile(inv_fname)
+    assert os.listdir(str(tmpdir.join('fwd'))) == ['sample-fwd.fif']
+
+    _get_inverse_operator(inv_fname, raw.info, fwd, cov, fwd_fname,
+                          cov_fname, cache_dir=str(cache_dir), **inv_kwargs)
+    assert len(cache_dir.listdir()) == 1
+
+    # the second call reads the cached inverse operator
+    def _fail(*args, **kwargs):
+        raise RuntimeError('inverse operator should be read from the cache')
+
+    monkeypatch.setattr(compute_inv_problem, 'make_inverse_operator', _fail)
+    inv_fname = str(tmpdir.join('sample_cached-inv.fif'))
+    inv_cached = _get_inverse_operator(
+        inv_fname, raw.info, fwd, cov, fwd_fname, cov_fname,
+        cache_dir=str(cache_dir), **inv_kwargs)
+    assert os.path.isfile(inv_fname)
+
+    # equal to the freshly made inverse operator (saved in single precision)
+    for key in ('eigen_leads', 'eigen_fields', 'source_cov', 'noise_cov'):
+        np.testing.assert_allclose(inv_cached[key]['data'], inv[key]['data'],
+                                   rtol=1e-6, atol=1e-6 * np.abs(
+                                       inv[key]['data']).max())
+    np.testing.assert_allclose(inv_cached['sing'], inv['sing'], rtol=1e-6)
+    assert inv_cached['info']['ch_names'] == inv['info']['ch_names']
+
+    # the key depends on the bads, projs, cov and inverse parameters
+    inv_key = _get_inv_key(fwd_fname, cov_fname, raw.info, **inv_kwargs)
+    keys = {inv_key}
+
+    info = raw.info.copy()
+    info['bads'] = ['Fp1']
+    keys.add(_get_inv_key(fwd_fname, cov_fname, info, **inv_kwargs))
+
+    info = raw.copy().del_proj().info
+    keys.add(_get_inv_key(fwd_fname, cov_fname, info, **inv_kwargs))
+
+    cov2_fname = str(tmpdir.join('sample2-cov.fif'))
+    mne.make_ad_hoc_cov(raw.info, std=dict(eeg=1e-6)).save(cov2_fname)
+    keys.add(_get_inv_key(fwd_fname, cov2_fname, raw.info, **inv_kwargs))
+
+    for param, value in (('loose', 1.), ('depth', None), ('fixed', True)):
+        keys.add(_get_inv_key(fwd_fname, cov_fname, raw.info,
+                              **dict(inv_kwargs, **{param: value})))
+
+    assert len(keys) == 7
+    assert _get_inv_key(fwd_fname, cov_fname, raw.info.copy(),
+                        **inv_kwargs) == inv_key
+
+
+def test_compute_inverse_solution_generator(tmpdir):
+    """Test the ROIs time series of the epochs streamed one at a time."""
+    raw, _, fwd_fname, cov_fname, subjects_dir = _make_inv_data(tmpdir)
+    epochs = mne.make_fixed_length_epochs(raw, duration=1.)
+    epo_fname = str(tmpdir.join('sample-epo.fif'))
+    epochs.save(epo_fname)
+
+    for is_fixed in (False, True):
+        roi_ts = list()
+        for return_generator in (False, True):
+            with tmpdir.mkdir('gen_{}_{}'.format(
+                    is_fixed, return_generator)).as_cwd():
+                ts_file, _, label_names_file, _, _ = \
+                    _compute_inverse_solution(
+                        epo_fname, 'sample', subjects_dir, fwd_fname,
+                        cov_fname, is_epoched=True, events_id={},
+                        inv_method='dSPM', is_fixed=is_fixed,
+                        return_generator=return_generator)
+                roi_ts.append(np.load(ts_file))
+                assert list(np.loadtxt(label_names_file, dtype=str)) == \
+                    ['a-lh', 'a-rh', 'b-lh', 'b-rh']
+
+        assert roi_ts[0].shape == (10, 4, 200)
+        np.testing.assert_allclose(roi_ts[1], roi_ts[0])
+
+    # the ROIs time series are those of the list of stcs
+    inv = mne.minimum_norm.make_inverse_operator(
+        epochs.info, mne.read_forward_solution(fwd_fname),
+        mne.read_cov(cov_fname), loose=0, depth=None, fixed=True)
+    stcs = mne.minimum_norm.apply_inverse_epochs(epochs, inv, 1., 'dSPM')
+    labels = mne.read_labels_from_annot('sample', 'aparc',
+                                        subjects_dir=subjects_dir)
+    label_ts = mne.extract_label_time_course(stcs, labels, inv['src'],
+                                             mode='mean_flip')
+    np.testing.assert_allclose(roi_ts[1], label_ts, rtol=1e-5,
+                               atol=1e-6 * np.abs(label_ts).max())
+
+
+@pytest.mark.parametrize('inv_method', ['MNE', 'dSPM', 'sLORETA'])
+@pytest.mark.parametrize('fixed, pick_ori', [(True, None), (False, 'normal')])
+def test_make_inverse_kernel(tmpdir, inv_method, fixed, pick_ori):
+    """Test the imaging kernel against apply_inverse_raw/epochs."""
+    from mne.minimum_norm import (make_inverse_operator, apply_inverse_raw,
+                                  apply_inverse_epochs)
+
+    raw, _, fwd_fname, cov_fname, _ = _make_inv_data(tmpdir)
+    raw.info['bads'] = ['Fp1']
+    inv = make_inverse_operator(raw.info, mne.read_forward_solution(fwd_fname),
+                                mne.read_cov(cov_fname),
+                                loose=0. if fixed else 0.2, depth=0.8,
+                                fixed=fixed)
+    lambda2 = 1. / 9.
+
+    kernel, sel = _make_inverse_kernel(inv, raw, lambda2, inv_method,
+                                       pick_ori=pick_ori)
+    assert kernel.shape == (55, 39)
+    assert raw.ch_names.index('Fp1') not in sel
+    stc = apply_inverse_raw(raw, inv, lambda2, inv_method, pick_ori=pick_ori)
+    np.testing.assert_allclose(kernel @ raw.get_data()[sel], stc.data,
+                               rtol=1e-7, atol=1e-7 * np.abs(stc.data).max())
+
+    epochs = mne.make_fixed_length_epochs(raw, duration=1.)
+    kernel, sel = _make_inverse_kernel(inv, epochs, lambda2, inv_method,
+                                       pick_ori=pick_ori)
+    stcs = apply_inverse_epochs(epochs, inv, lambda2, inv_method,
+                                pick_ori=pick_ori)
+    for epo, stc in zip(epochs, stcs):
+        np.testing.assert_allclose(kernel @ epo[sel], stc.data, rtol=1e-7,
+                                   atol=1e-7 * np.abs(stc.data).max())
+
+    # the EEG average reference projection is mandatory
+    raw.del_proj()
+    with pytest.raises(ValueError, match='EEG average reference'):
+        _make_inverse_kernel(inv, raw, lambda2, inv_method,
+                             pick_ori=pick_ori)
+
+
+def test_compute_inverse_solution_container(tmpdir):
+    """Test the ROIs time series and labels saved in a single container."""
+    from ephypype.import_data import read_container
+    from ephypype.source_space import _read_labels_file
+
+    _, raw_fname, fwd_fname, cov_fname, subjects_dir = _make_inv_data(tmpdir)
+
+    roi_ts = list()
+    for container in (False, True):
+        with tmpdir.mkdir('container_{}'.format(container)).as_cwd():
+            ts_file, labels_file, label_names_file, label_coords_file, _ = \
+                _compute_inverse_solution(
+                    raw_fname, 'sample', subjects_dir, fwd_fname, cov_fname,
+                    is_epoched=False, inv_method='MNE', is_fixed=True,
+                    container=container)
+            if container:
+                assert ts_file == labels_file == label_names_file == \
+                    label_coords_file
+                assert not os.path.exists('labels.hdf5')
+                roi_ts.append(read_container(ts_file, mmap=False)['data'])
+            else:
+                roi_ts.append(np.load(ts_file))
+            roi = _read_labels_file(labels_file)
+            assert roi['ROI_names'] == ['a-lh', 'a-rh', 'b-lh', 'b-rh']
+
+    np.testing.assert_allclose(roi_ts[1], roi_ts[0])
@@ -0,0 +1,34 @@
+"""Test kernel cache."""
+
+import os
+import numpy as np
+
+from ephypype.kernel_cache import _KernelCache
+
+
+def test_kernel_cache(tmpdir):
+    """Test LRU eviction and .npz tier of the kernel cache."""
+    cache = _KernelCache(maxsize=2, cache_dir=str(tmpdir))
+
+    def _compute():
+        return np.arange(10.), np.ones(3)
+
+    kernel = cache.get('test', dict(n_times=10), _compute)
+    assert cache.n_misses == 1
+    assert len(os.listdir(str(tmpdir))) == 1
+
+    assert cache.get('test', dict(n_times=10), _compute) is kernel
+    assert cache.n_hits == 1
+
+    # fill the cache so that the first kernel is evicted
+    cache.get('test', dict(n_times=20), _compute)
+    cache.get('test', dict(n_times=30), _compute)
+    assert len(cache._kernels) == 2
+
+    # the evicted kernel is read from the .npz file
+    def _fail():
+        raise RuntimeError('kernel should be read from disk')
+
+    kernel_disk = cache.get('test', dict(n_times=10), _fail)
+    assert all(np.array_equal(a, b) for a, b in zip(kernel, kernel_disk))
+    assert not kernel_disk[0].flags.writeable
@@ -0,0 +1,121 @@
+"""Test single-pass preprocessing."""
+import os
+import time
+import mne
+import numpy as np
+
+from ephypype.preproc import (_preprocess_fif, _compute_ica,
+                              _preprocess_ica_fif_to_ts, _fit_ica,
+                              _generate_ica_report)
+
+import matplotlib
+matplotlib.use('Agg')  # for testing don't use X server
+
+
+def test_preprocess_ica_fif_to_ts(tmpdir):
+    """Test fused preprocessing gives the same data as PreprocFif+CompIca."""
+    ch_names = ['Fp1', 'Fp2', 'F3', 'F4', 'C3', 'C4', 'P3', 'P4', 'O1',
+                'O2', 'Fz', 'Cz', 'Pz']
+    info = mne.create_info(ch_names, 250., 'eeg')
+    rng = np.random.RandomState(0)
+    sources = rng.laplace(size=(len(ch_names), 250 * 60))
+    raw = mne.io.RawArray(rng.randn(len(ch_names), len(ch_names)) @
+                          sources * 1e-6, info)
+    raw_fname = str(tmpdir.join('sub_raw.fif'))
+    raw.save(raw_fname)
+
+    kwargs = dict(l_freq=1., h_freq=40., down_sfreq=125,
+                  montage='standard_1020')
+
+    with tmpdir.mkdir('sequential').as_cwd():
+        filt_fname = _preprocess_fif(raw_fname, 'eeg', eog_ch=[], ecg_ch='',
+                                     **kwargs)
+        raw_ica_fname = _compute_ica(filt_fname, filt_fname, 'eeg', '', [],
+                                     0.99, None)[0]
+
+    with tmpdir.mkdir('fused').as_cwd():
+        output = _preprocess_ica_fif_to_ts(raw_fname, 'eeg', n_components=0.99,
+                                           **kwargs)
+
+    array_file, _, channel_names_file, sfreq = output[:4]
+    assert sfreq == 125.
+    assert os.path.isfile(output[4])  # ica solution
+    assert output[5] is None and output[7] is None  # no fif file saved
+    assert list(np.loadtxt(channel_names_file, dtype=str)) == ch_names
+
+    data = mne.io.read_raw_fif(raw_ica_fname).get_data()
+    np.testing.assert_allclose(np.load(array_file), data,
+                               atol=1e-6 * np.abs(data).max())
+
+
+def _make_blink_raw(sfreq=500., duration=300.):
+    """Create EEG data with blinks recorded by an EOG channel."""
+    ch_names = mne.channels.make_standard_montage('standard_1020').ch_names
+    ch_names = ch_names[:32]
+    n_times = int(sfreq * duration)
+    rng = np.random.RandomState(0)
+
+    sources = rng.laplace(size=(len(ch_names), n_times))
+    blinks = np.zeros(n_times)
+    for onset in rng.choice(n_times - 200, 150, replace=False):
+        blinks[onset:onset + 200] += np.hanning(200) * 20
+    sources[0] = blinks + 0.1 * rng.randn(n_times)
+    mixing = rng.randn(len(ch_names), len(ch_names))
+
+    data = np.vstack([mixing @ sources, blinks + 0.5 * rng.randn(n_times)])
+    info = mne.create_info(ch_names + ['EOG'], sfreq,
+                           ['eeg'] * len(ch_names) + ['eog'])
+    raw = mne.io.RawArray(data * 1e-6, info)
+    raw.set_montage('standard_1020')
+    raw.set_annotations(mne.Annotations([10., 150.], [60., 60.],
+                                        ['rest', 'rest']))
+
+    return raw, mixing[:, 0]
+
+
+def test_fit_ica_decim():
+    """Benchmark ICA fitted on decimated segments against the full fit."""
+    raw, blink_topo = _make_blink_raw()
+
+    excluded_topos = dict()
+    for name, fit_params in [
+            ('full', dict()),
+            ('decim', dict(decim=5, fit_tmax=60.)),
+            ('annot', dict(decim=5, fit_annotations=['rest'],
+                           method='infomax'))]:
+        t0 = time.time()
+        ica = _fit_ica(raw, raw.copy(), 'eeg', 0.99, None, **fit_params)
+        print('*** ICA {} fit in {:.2f} s'.format(name, time.time() - t0))
+
+        eog_inds, _ = ica.find_bads_eog(raw, ch_name='EOG')
+        assert len(eog_inds) > 0
+        excluded_topos[name] = ica.get_components()[:, eog_inds[0]]
+
+    # the blink component is excluded by all the fits
+    for name, topo in excluded_topos.items():
+        assert abs(np.corrcoef(topo, blink_topo)[0, 1]) > 0.99, name
+        assert abs(np.corrcoef(topo, excluded_topos['full'])[0, 1]) > 0.99
+
+
+def test_generate_ica_report(tmpdir):
+    """Test generating the ICA report after the ICA node."""
+    raw, _ = _make_blink_raw(sfreq=250., duration=60.)
+    raw_fname = str(tmpdir.join('sub_raw.fif'))
+    raw.save(raw_fname)
+
+    with tmpdir.as_cwd():
+        output = _compute_ica(raw_fname, raw_fname, 'eeg', '', ['EOG'], 0.99,
+                              None, make_report=False)
+        raw_ica_fname, ica_sol_fname, ica_ts_fname, report_fname = output[:4]
+        ica_scores_fname, ica_evoked_fname = output[4:]
+        assert report_fname is None
+
+        t0 = time.time()
+        report_fname = _generate_ica_report(
+            ica_sol_fname, ica_ts_fname, ica_scores_fname, ica_evoked_fname,
+            fast=True)
+        print('*** fast ICA report in {:.2f} s'.format(time.time() - t0))
+
+    assert os.path.isfile(report_fname)
+    with open(report_fname) as f:
+        assert 'Time-locked EOG sources' in f.read()
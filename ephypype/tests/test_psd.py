@@ -0,0 +1,246 @@
+"""Test power spectral density of sensor and source data."""
+import h5py
+import mne
+import numpy as np
+import pytest
+
+from mne.minimum_norm import (apply_inverse_raw, make_inverse_operator,
+                              write_inverse_operator)
+from mne.source_space import SourceSpaces
+from mne.time_frequency import psd_array_welch
+from scipy.integrate import trapezoid
+from scipy.signal import welch
+
+from ephypype.import_data import read_container
+from ephypype.power import (_compute_and_save_psd,
+                            _compute_and_save_src_psd_old,
+                            _compute_mean_band_psd, _plot_psd_file,
+                            _compute_and_save_src_kernel_psd)
+
+import matplotlib
+matplotlib.use('Agg')  # for testing don't use X server
+
+
+def _make_raw_fname(tmpdir, annotations=None):
+    """Save a raw file of random MEG and EEG data with a bad channel."""
+    ch_names = ['MEG001', 'MEG002', 'MEG003', 'EEG001', 'EEG002', 'STI001']
+    info = mne.create_info(ch_names, 200., ['mag'] * 3 + ['eeg'] * 2 +
+                           ['stim'])
+    info['bads'] = ['MEG002']
+    data = np.random.RandomState(0).randn(len(ch_names), 20123) * 1e-12
+    raw = mne.io.RawArray(data, info)
+    if annotations is not None:
+        raw.set_annotations(annotations)
+
+    raw_fname = str(tmpdir.join('test_raw.fif'))
+    raw.save(raw_fname)
+    return raw_fname
+
+
+@pytest.mark.parametrize('chunk_duration', [1., 7.3, 60.])
+def test_compute_and_save_psd(tmpdir, chunk_duration):
+    """Test the Welch psd of raw data streamed by chunks."""
+    raw_fname = _make_raw_fname(tmpdir)
+
+    with tmpdir.as_cwd():
+        psds_fname = _compute_and_save_psd(raw_fname, fmin=1., fmax=40.,
+                                           n_fft=256, n_overlap=128,
+                                           chunk_duration=chunk_duration)
+        ch_names = np.loadtxt('correct_channel_names.txt', dtype=str)
+
+    # all data channels but the bad ones
+    assert list(ch_names) == ['MEG001', 'MEG003', 'EEG001', 'EEG002']
+
+    raw = mne.io.read_raw_fif(raw_fname)
+    psds, freqs = psd_array_welch(raw.get_data([0, 2, 3, 4]), 200.,
+                                  fmin=1., fmax=40., n_fft=256,
+                                  n_overlap=128)
+
+    with np.load(psds_fname) as npzfile:
+        np.testing.assert_allclose(npzfile['freqs'], freqs)
+        np.testing.assert_allclose(npzfile['psds'], psds, rtol=1e-10)
+
+
+@pytest.mark.parametrize('chunk_duration', [1., 60.])
+def test_compute_and_save_psd_bad_annotations(tmpdir, chunk_duration):
+    """Test the segments overlapping BAD annotations are excluded."""
+    annotations = mne.Annotations([10.3, 50.], [5., 2.],
+                                  ['BAD_segment', 'rest'])
+    raw_fname = _make_raw_fname(tmpdir, annotations=annotations)
+
+    with tmpdir.as_cwd():
+        psds_fname = _compute_and_save_psd(raw_fname, fmin=1., fmax=40.,
+                                           n_fft=256, n_overlap=128,
+                                           chunk_duration=chunk_duration)
+
+    # the Welch segments that do not overlap the BAD annotation
+    data = mne.io.read_raw_fif(raw_fname).get_data([0, 2, 3, 4])
+    starts = np.arange(0, data.shape[1] - 256 + 1, 128)
+    good = (starts + 256 <= 10.3 * 200) | (starts >= 15.3 * 200)
+    assert 0 < good.sum() < len(starts)
+    segments = np.array([data[:, start:start + 256]
+                         for start in starts[good]])
+    psds, freqs = psd_array_welch(segments, 200., fmin=1., fmax=40.,
+                                  n_fft=256)
+
+    with np.load(psds_fname) as npzfile:
+        np.testing.assert_allclose(npzfile['freqs'], freqs)
+        np.testing.assert_allclose(npzfile['psds'], psds.mean(0),
+                                   rtol=1e-10)
+
+
+def test_compute_and_save_src_psd_old(tmpdir):
+    """Test the Welch psd of source data computed by blocks."""
+    src_data = np.random.RandomState(0).randn(1, 2345, 1000)
+    npy_fname = str(tmpdir.join('src_data.npy'))
+    np.save(npy_fname, src_data)
+    hdf5_fname = str(tmpdir.join('src_data.hdf5'))
+    with h5py.File(hdf5_fname, 'w') as f:
+        f.create_dataset('stc_data', data=src_data[0], chunks=(100, 1000))
+
+    freqs, psds = welch(src_data[0], fs=100., window='hamming', nperseg=256,
+                        noverlap=128)
+
+    with tmpdir.as_cwd():
+        for fname, kwargs in [
+                (npy_fname, dict()),
+                (npy_fname, dict(block_size=500, n_jobs=2, dtype=np.float32)),
+                (hdf5_fname, dict(block_size=300, n_jobs=4)),
+                (hdf5_fname, dict(block_size=300, n_jobs=-1))]:
+            psds_fname = _compute_and_save_src_psd_old(
+                fname, 100., n_fft=256, n_overlap=128, **kwargs)
+
+            with np.load(psds_fname) as npzfile:
+                assert npzfile['psds'].dtype == kwargs.get('dtype', np.float64)
+                np.testing.assert_allclose(npzfile['freqs'], freqs)
+                np.testing.assert_allclose(npzfile['psds'], psds, rtol=1e-5)
+
+
+def test_compute_mean_band_psd(tmpdir):
+    """Test reducing epoched psds to frequency bands."""
+    psds = np.random.RandomState(0).rand(5, 4, 65)
+    freqs = np.linspace(0., 64., 65)
+    psds_fname = str(tmpdir.join('sub-psds.npz'))
+    np.savez(psds_fname, psds=psds, freqs=freqs)
+
+    freq_bands = [[1., 3.5], [4., 8.], [8., 12.], [100., 120.]]
+    with tmpdir.as_cwd():
+        for mode, reduce_band in [('mean', np.mean), ('median', np.median),
+                                  ('integral', None)]:
+            m_px = np.load(_compute_mean_band_psd(psds_fname, freq_bands,
+                                                  mode=mode))
+            assert m_px.shape == (5, 4, 4)
+            assert np.isnan(m_px[..., -1]).all()
+
+            for band, (fmin, fmax) in enumerate(freq_bands[:-1]):
+                mask = (freqs >= fmin) * (freqs <= fmax)
+                if mode == 'integral':
+                    expected = trapezoid(psds[..., mask], freqs[mask])
+                else:
+                    expected = reduce_band(psds[..., mask], axis=-1)
+                np.testing.assert_allclose(m_px[..., band], expected)
+
+
+def test_compute_and_save_psd_container(tmpdir):
+    """Test saving the psd of raw data in a container."""
+    raw_fname = _make_raw_fname(tmpdir)
+
+    with tmpdir.as_cwd():
+        psds_fname = _compute_and_save_psd(raw_fname, fmin=1., fmax=40.,
+                                           container=True)
+        assert not tmpdir.join('correct_channel_names.txt').check()
+        m_px = np.load(_compute_mean_band_psd(psds_fname, [[1., 4.]]))
+
+    container = read_container(psds_fname, mmap=False)
+    assert container['ch_names'] == ['MEG001', 'MEG003', 'EEG001', 'EEG002']
+    assert container['ch_coords'].shape == (4, 3)
+    assert container['attrs']['method'] == 'welch'
+
+    mask = (container['freqs'] >= 1.) * (container['freqs'] <= 4.)
+    np.testing.assert_allclose(m_px[:, 0],
+                               container['data'][:, mask].mean(-1))
+
+
+def test_plot_psd_file(tmpdir):
+    """Test the image of the psd is only saved on demand."""
+    import matplotlib.pyplot as plt
+
+    raw_fname = _make_raw_fname(tmpdir)
+
+    with tmpdir.as_cwd():
+        for container in (False, True):
+            psds_fname = _compute_and_save_psd(raw_fname, fmin=1., fmax=40.,
+                                               container=container)
+            assert not tmpdir.join('test_raw-psds.png').check()
+
+            psds_img_fname = _plot_psd_file(psds_fname)
+            assert psds_img_fname == str(tmpdir.join('test_raw-psds.png'))
+            tmpdir.join('test_raw-psds.png').remove()
+
+    # no figure is left open
+    assert not plt.get_fignums()
+
+
+def _make_inv_fname(tmpdir, raw):
+    """Save the inverse operator of a small synthetic source space."""
+    rng = np.random.RandomState(0)
+    src = list()
+    for hemi_id, n_use, x in ((101, 30, -0.03), (102, 25, 0.03)):
+        vertno = np.arange(0, 2 * n_use, 2)
+        nn = rng.randn(2 * n_use, 3)
+        nn /= np.linalg.norm(nn, axis=1)[:, np.newaxis]
+        inuse = np.zeros(2 * n_use, int)
+        inuse[vertno] = 1
+        src.append(dict(
+            type='surf', id=hemi_id, vertno=vertno, nn=nn, np=2 * n_use,
+            rr=rng.randn(2 * n_use, 3) * 0.01 + [x, 0., 0.04],
+            nuse=n_use, inuse=inuse, coord_frame=5, tris=None, ntri=0,
+            use_tris=None, nuse_tri=0, subject_his_id='sample', dist=None,
+            dist_limit=None, nearest=None, nearest_dist=None,
+            patch_inds=None, pinfo=None))
+
+    sphere = mne.make_sphere_model('auto', 'auto', raw.info, verbose=False)
+    fwd = mne.make_forward_solution(raw.info, None, SourceSpaces(src),
+                                    sphere, verbose=False)
+    inv = make_inverse_operator(raw.info, fwd, mne.make_ad_hoc_cov(raw.info),
+                                loose=0.2, depth=0.8, verbose=False)
+
+    inv_fname = str(tmpdir.join('sample-inv.fif'))
+    write_inverse_operator(inv_fname, inv, verbose=False)
+    return inv_fname, inv
+
+
+def test_compute_and_save_src_kernel_psd(tmpdir):
+    """Test the psd of the labels computed with the imaging kernel."""
+    montage = mne.channels.make_standard_montage('standard_1020')
+    info = mne.create_info(montage.ch_names[:40], 200., 'eeg')
+    info.set_montage(montage)
+    raw = mne.io.RawArray(
+        np.random.RandomState(0).randn(40, 200 * 30) * 1e-6, info)
+    raw.set_eeg_reference(projection=True)
+    raw_fname = str(tmpdir.join('sample_raw.fif'))
+    raw.save(raw_fname)
+
+    inv_fname, inv = _make_inv_fname(tmpdir, raw)
+    labels = [mne.Label(np.arange(0, 20), hemi='lh', name='a-lh'),
+              mne.Label(np.arange(10, 50), hemi='rh', name='b-rh')]
+
+    stc = apply_inverse_raw(raw, inv, 1. / 9., 'dSPM', pick_ori='normal')
+    label_ts = mne.extract_label_time_course(stc, labels, inv['src'],
+                                             mode='mean_flip')
+
+    with tmpdir.as_cwd():
+        psds_fname = _compute_and_save_src_kernel_psd(
+            raw_fname, inv_fname, fmin=1., fmax=40., inv_method='dSPM',
+            labels=labels, chunk_duration=7., container=True)
+        container = read_container(psds_fname, mmap=False)
+        assert container['ch_names'] == ['a-lh', 'b-rh']
+        psds, freqs = psd_array_welch(label_ts, 200., fmin=1., fmax=40.)
+        np.testing.assert_allclose(container['data'], psds, rtol=1e-5)
+
+        # psd of all the sources
+        psds_fname = _compute_and_save_src_kernel_psd(
+            raw_fname, inv_fname, fmin=1., fmax=40., inv_method='dSPM')
+        psds, freqs = psd_array_welch(stc.data, 200., fmin=1., fmax=40.)
+        with np.load(psds_fname) as npzfile:
+            np.testing.assert_allclose(npzfile['psds'], psds, rtol=1e-5)
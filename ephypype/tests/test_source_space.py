@@ -0,0 +1,54 @@
+"""Test source space."""
+import os
+import mne
+import numpy as np
+
+from mne.source_space import SourceSpaces
+
+from ephypype.source_space import (_make_label_projection,
+                                   _get_label_projection)
+
+
+def _make_src(rng):
+    """Create a surface source space with random normals."""
+    src = list()
+    for hemi_id, n_use in ((101, 30), (102, 25)):
+        vertno = np.arange(0, 2 * n_use, 2)
+        nn = np.zeros((2 * n_use, 3))
+        nn[vertno] = rng.randn(n_use, 3)
+        nn[vertno] /= np.linalg.norm(nn[vertno], axis=1)[:, np.newaxis]
+        inuse = np.zeros(2 * n_use, int)
+        inuse[vertno] = 1
+        src.append(dict(type='surf', id=hemi_id, vertno=vertno, nn=nn,
+                        rr=rng.randn(2 * n_use, 3), np=2 * n_use,
+                        nuse=n_use, inuse=inuse, coord_frame=5))
+    return SourceSpaces(src)
+
+
+def test_label_projection(tmpdir):
+    """Test label projection against mne.extract_label_time_course."""
+    rng = np.random.RandomState(42)
+    src = _make_src(rng)
+    labels = [mne.Label(np.arange(0, 20), hemi='lh', name='a-lh'),
+              mne.Label(np.arange(10, 50), hemi='rh', name='b-rh'),
+              mne.Label(np.array([1, 3]), hemi='lh', name='empty-lh')]
+    stc = mne.SourceEstimate(rng.randn(55, 40),
+                             [s['vertno'] for s in src], 0, 0.01)
+
+    fwd_filename = str(tmpdir.join('sample-fwd.fif'))
+    for mode in ('mean', 'mean_flip'):
+        label_ts = mne.extract_label_time_course(
+            stc, labels, src, mode=mode, allow_empty='ignore')
+
+        proj = _make_label_projection(labels, src, mode=mode)
+        np.testing.assert_allclose(proj @ stc.data, label_ts)
+
+        # computed then read from the cache file next to the forward
+        for _ in range(2):
+            proj = _get_label_projection(labels, src, mode=mode,
+                                         sbj_id='sample', parc='aparc',
+                                         fwd_filename=fwd_filename)
+            np.testing.assert_allclose(proj @ stc.data, label_ts)
+
+    assert len([f for f in os.listdir(str(tmpdir))
+                if f.endswith('-proj.npz')]) == 2
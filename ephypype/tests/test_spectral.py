@@ -1,13 +1,19 @@
 """Test spectral."""
 import os
 import shutil
+import mne
 import numpy as np
 import glob
 
+from mne.time_frequency import read_tfrs, tfr_array_morlet
+
+from ephypype.import_data import read_container
 from ephypype.spectral import (_compute_spectral_connectivity,
                                _compute_and_save_spectral_connectivity,
                                _compute_and_save_multi_spectral_connectivity,
-                               _plot_circular_connectivity)  # noqa
+                               _compute_batched_spectral_connectivity,
+                               _plot_circular_connectivity,
+                               _compute_tfr_morlet)  # noqa
 
 import pytest
 
@@ -92,8 +98,81 @@ def test_compute_and_save_multi_spectral_connectivity():
         files".format(os.listdir(tmp_dir)))
 
 
+def test_compute_batched_spectral_connectivity():
+    """Test batched engine gives the same matrices as one call per sample."""
+    all_data = ts_mat_trials[:5, :, :1000]
+
+    for con_method in ["coh", "imcoh", "wpli"]:
+        conmat_stack = _compute_batched_spectral_connectivity(
+            all_data, con_method=con_method, sfreq=sfreq, fmin=fmin,
+            fmax=fmax, gathering_method='mean', batch_size=2)
+
+        assert conmat_stack.shape == (5, nb_ROI, nb_ROI)
+
+        for i in range(all_data.shape[0]):
+            con_matrix = _compute_spectral_connectivity(
+                data=all_data[i][np.newaxis], con_method=con_method,
+                mode="multitaper", fmin=fmin, fmax=fmax, sfreq=sfreq,
+                gathering_method='mean')
+
+            assert np.allclose(conmat_stack[i], con_matrix)
+
+    _compute_and_save_multi_spectral_connectivity(
+        all_data=all_data, con_method="imcoh", mode="multitaper", fmin=fmin,
+        fmax=fmax, sfreq=sfreq, gathering_method='mean', save_dir=tmp_dir,
+        save_stack=True)
+
+    conmat_stack = np.load(os.path.join(tmp_dir, "conmat_stack_imcoh.npy"))
+    assert conmat_stack.shape == (5, nb_ROI, nb_ROI)
+
+
 def test_plot_circular_connectivity():
     """test _plot_circular_connectivity"""
     _plot_circular_connectivity(conmat, label_names=labels, save_dir=tmp_dir)
 
     assert os.path.exists(os.path.join(tmp_dir, "circle__def.png")), "Error"
+
+
+def test_compute_tfr_morlet(tmpdir):
+    """Test the Morlet TFR computed by blocks of epochs."""
+    info = mne.create_info(['EEG%02d' % i for i in range(8)] + ['STI'], 250.,
+                           ['eeg'] * 8 + ['stim'])
+    info['bads'] = ['EEG03']
+    data = np.random.RandomState(0).randn(23, 9, 500) * 1e-6
+    epo_fname = str(tmpdir.join('sub-epo.fif'))
+    mne.EpochsArray(data, info).save(epo_fname)
+
+    freqs = np.arange(4., 40., 4.)
+    picks = [0, 1, 2, 4, 5, 6, 7]
+    tfr = tfr_array_morlet(data[:, picks], 250., freqs, n_cycles=freqs / 2.,
+                           decim=3, output='complex')
+
+    with tmpdir.as_cwd():
+        tfr_fname = _compute_tfr_morlet(epo_fname, freqs, freqs / 2.,
+                                        n_jobs=2, chunk_size=4)
+        power = read_tfrs(tfr_fname)
+        power = power[0] if isinstance(power, list) else power
+        np.testing.assert_allclose(power.data, (np.abs(tfr) ** 2).mean(0),
+                                   rtol=1e-6)
+
+        # single trial TFR appended to a container
+        tfr_fname = _compute_tfr_morlet(epo_fname, freqs, freqs / 2.,
+                                        n_jobs=2, chunk_size=4, average=False,
+                                        dtype=np.complex64)
+        container = read_container(tfr_fname, mmap=False)
+        assert container['data'].dtype == np.complex64
+        assert container['ch_names'] == power.ch_names
+        np.testing.assert_allclose(container['data'], tfr, rtol=1e-4,
+                                   atol=1e-4 * np.abs(tfr).max())
+
+        # n_jobs=-1 uses all the CPUs
+        tfr_fname = _compute_tfr_morlet(epo_fname, freqs, freqs / 2.,
+                                        n_jobs=-1, chunk_size=4)
+        power = read_tfrs(tfr_fname)
+        power = power[0] if isinstance(power, list) else power
+        np.testing.assert_allclose(power.data, (np.abs(tfr) ** 2).mean(0),
+                                   rtol=1e-6)
+
+        with pytest.raises(ValueError, match='averaged'):
+            _compute_tfr_morlet(epo_fname, freqs, freqs / 2.,
+                                dtype=np.complex64)
@@ -0,0 +1,79 @@
+"""Test import_data."""
+import numpy as np
+
+from ephypype.import_data import (write_hdf5, _read_hdf5, _read_ts,
+                                  _EpochsView, _HDF5Writer, write_container,
+                                  read_container, _read_ch_names,
+                                  _is_container)
+
+from numpy.testing import assert_array_equal
+
+
+def test_read_ts_epochs_view(tmpdir):
+    """Test memory-mapped time series split in epochs."""
+    data = np.random.randn(1, 5, 1030)
+    epoch_length = 100
+
+    # epochs as computed by np.array_split on the time series in memory
+    epochs = np.array(np.array_split(data[0, :, :1000], 10, axis=1))
+
+    npy_fname = str(tmpdir.join('ts.npy'))
+    np.save(npy_fname, data)
+    hdf5_fname = str(tmpdir.join('ts.hdf5'))
+    write_hdf5(hdf5_fname, data, dataset_name='stc_data', dtype='d')
+
+    for fname in (npy_fname, hdf5_fname):
+        ts = _read_ts(fname, dataset_name='stc_data', mmap=True)
+        assert not isinstance(ts, np.ndarray) or isinstance(ts, np.memmap)
+
+        epo_view = _EpochsView(ts, epoch_length)
+        assert epo_view.shape == epochs.shape
+        assert_array_equal(np.asarray(epo_view), epochs)
+        assert_array_equal(epo_view[2:5], epochs[2:5])
+        assert_array_equal(epo_view[-1], epochs[-1])
+        assert_array_equal(np.array([epo for epo in epo_view]), epochs)
+
+
+def test_hdf5_writer(tmpdir):
+    """Test appending epochs to a hdf5 file and reading part of them."""
+    data = np.random.randn(4, 50, 30).astype(np.float32)
+
+    for compression in (None, 'lzf', 'gzip'):
+        fname = str(tmpdir.join('stc_{}.hdf5'.format(compression)))
+        with _HDF5Writer(fname, dataset_name='stc_data',
+                         compression=compression, chunk_bytes=1000) as writer:
+            for epo_data in data:
+                writer.append(epo_data)
+            assert writer.shape == data.shape
+
+        assert_array_equal(_read_hdf5(fname, dataset_name='stc_data'), data)
+        assert_array_equal(
+            _read_hdf5(fname, dataset_name='stc_data', epoch_range=(1, 3),
+                       vertex_range=(10, 20)), data[1:3, 10:20])
+        assert_array_equal(
+            _read_hdf5(fname, dataset_name='stc_data', vertex_range=(5, 8)),
+            data[:, 5:8])
+
+
+def test_container(tmpdir):
+    """Test writing and reading a container in one call."""
+    psds = np.random.randn(2, 3, 50)
+    coords = np.random.randn(3, 3)
+    fname = write_container(str(tmpdir.join('sub-psds.hdf5')), psds,
+                            freqs=np.arange(50.), ch_names=['MEG1', 'EEG1',
+                                                            'EEG2'],
+                            ch_coords=coords, method='welch', n_fft=256)
+
+    container = read_container(fname)
+    assert container['ch_names'] == ['MEG1', 'EEG1', 'EEG2']
+    assert container['attrs']['method'] == 'welch'
+    assert container['attrs']['n_fft'] == 256
+    assert 'ephypype_version' in container['attrs']
+    # the datasets are sliced lazily
+    assert_array_equal(container['data'][1, :, 10:20], psds[1, :, 10:20])
+    assert_array_equal(container['ch_coords'][()], coords)
+
+    # the readers of the time series and of the channel names accept it
+    assert_array_equal(_read_ts(fname, mmap=False), psds)
+    assert _read_ch_names(fname) == ['MEG1', 'EEG1', 'EEG2']
+    assert not _is_container(str(tmpdir.join('sub-psds.npy')))